@@ -5,4 +5,6 @@ config = {
     "batch_size": 128,
     "num_epochs": 400,
     "save_interval": 5,
+    "eval_images": 1000,
+    "keep_checkpoints": 5,
 }
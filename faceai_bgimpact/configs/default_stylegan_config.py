@@ -4,11 +4,20 @@ config = {
     "glr": 0.001,
     "mlr": 0.00001,
     "loss": "r1",
+    "r1_interval": 1,
+    "fused_d": False,
+    "reuse_fakes": False,
+    "d_steps": 1,
+    "ema_beta": 0.999,
+    "async_fid": True,
+    "eval_images": 1000,
+    "keep_checkpoints": 5,
     "latent_dim": 256,
     "w_dim": 256,
     "style_layers": 6,
     "save_interval": 2,
     "image_interval": 50,
+    "cache_dataset": False,
     "level_epochs": {
         0: {
             "transition": 0,
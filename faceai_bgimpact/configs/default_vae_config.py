@@ -6,4 +6,7 @@ config = {
     "num_epochs": 400,
     "save_interval": 2,
     "image_interval": 100,
+    "async_fid": True,
+    "eval_images": 1000,
+    "keep_checkpoints": 5,
 }
@@ -1,64 +1,108 @@
+import os
+import time
 import cv2
 import numpy as np
 from pathlib import Path
+from functools import partial
+from multiprocessing import Pool
 from tqdm import tqdm
-from zipfile import ZipFile, ZIP_DEFLATED
+from contextlib import ExitStack
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
 from faceai_bgimpact.data_processing.paths import raw_folder_name, mask_folder_name, blur_folder_name, grey_folder_name
 
+# Formats that are already compressed, and are stored in archives without compressing them again
+stored_suffixes = {".png", ".jpg", ".jpeg"}
+
 # Ensure the output directories exist
 Path(blur_folder_name).mkdir(parents=True, exist_ok=True)
 Path(grey_folder_name).mkdir(parents=True, exist_ok=True)
 
 
+def _blend(foreground, background, mask):
+    """
+    Blend two uint8 images with a uint8 mask, in 16-bit fixed point.
+
+    Computes round((foreground * mask + background * (255 - mask)) / 255) exactly, without going through floats.
+    """
+    mask = mask[:, :, None].astype(np.uint16)
+    blended = foreground * mask + background * (255 - mask) + 128
+    # Exact rounded division by 255 for values up to 65535
+    return ((blended + (blended >> 8)) >> 8).astype(np.uint8)
+
+
 def apply_blur(raw_image, mask):
     """Apply a Gaussian blur to the image."""
     # Blur the entire image
     blurred_image = cv2.GaussianBlur(raw_image, (31, 31), 0)
     # Blend the raw image and the blurred image using the mask
-    return raw_image * mask[:, :, None] + blurred_image * (1 - mask[:, :, None])
+    return _blend(raw_image, blurred_image, mask)
 
 
 def apply_grey(raw_image, mask):
     """Apply a grey background to the image."""
     # Create a solid grey image
-    grey_background = np.full_like(raw_image, (128, 128, 128))
+    grey_background = np.full_like(raw_image, 128)
     # Blend the raw image and the grey image using the mask
-    return raw_image * mask[:, :, None] + grey_background * (1 - mask[:, :, None])
-
-
-def create_blurred_and_grey_images():
-    """Create blurred and grey images."""
-    files = list(Path(mask_folder_name).glob("*.png"))
-    for mask_file in tqdm(files, desc="Applying masks"):
-        # Corresponding raw image path
-        raw_image_path = Path(raw_folder_name) / mask_file.name
-        # Load the original image and the mask
-        raw_image = cv2.imread(str(raw_image_path))
-        mask = cv2.imread(str(mask_file), cv2.IMREAD_UNCHANGED) / 255.0  # Load mask as float and normalize
-
-        # Apply the mask to create blurred and grey background images
-        blurred_image = apply_blur(raw_image, mask)
-        grey_image = apply_grey(raw_image, mask)
-
-        # Save the processed images
-        blurred_image_path = Path(blur_folder_name) / mask_file.name
-        grey_image_path = Path(grey_folder_name) / mask_file.name
-        cv2.imwrite(str(blurred_image_path), blurred_image)
-        cv2.imwrite(str(grey_image_path), grey_image)
-
-
-def compress_folder(folder_name):
-    """Compress a folder."""
-    # Create a zip file
-    zip_file_name = f"{folder_name}.zip"
-    zip_file = ZipFile(zip_file_name, "w", ZIP_DEFLATED)
-
-    # Add all files in the folder to the zip file
-    for file in tqdm(Path(folder_name).glob("*"), desc=f"Compressing {folder_name}"):
-        zip_file.write(file, file.name)
-
-    # Close the zip file
-    zip_file.close()
+    return _blend(raw_image, grey_background, mask)
+
+
+def _process_image(name, png_compression, return_data=False):
+    """
+    Create the blurred and grey versions of one image, decoding the raw image and its mask only once.
+
+    If return_data is True, also return the encoded PNG files, so that they can be added to an archive.
+    """
+    raw_image = cv2.imread(str(Path(raw_folder_name) / name))
+    mask = cv2.imread(str(Path(mask_folder_name) / name), cv2.IMREAD_GRAYSCALE)
+
+    params = [cv2.IMWRITE_PNG_COMPRESSION, png_compression]
+    outputs = []
+    for folder_name, image in [
+        (blur_folder_name, apply_blur(raw_image, mask)),
+        (grey_folder_name, apply_grey(raw_image, mask)),
+    ]:
+        data = cv2.imencode(".png", image, params)[1].tobytes()
+        (Path(folder_name) / name).write_bytes(data)
+        outputs.append(data if return_data else None)
+    return name, outputs
+
+
+def create_blurred_and_grey_images(num_workers=None, png_compression=1, zip_=False):
+    """
+    Create blurred and grey images.
+
+    Parameters:
+    ----------
+    num_workers : int
+        Number of worker processes. Defaults to the number of CPUs.
+    png_compression : int
+        PNG compression level, from 0 (fastest, largest files) to 9 (slowest, smallest files).
+    zip_ : bool
+        Whether to also write the images to a zip archive of each output folder, as they are created.
+    """
+    names = [mask_file.name for mask_file in Path(mask_folder_name).glob("*.png")]
+    process_image = partial(_process_image, png_compression=png_compression, return_data=zip_)
+    folder_names = [blur_folder_name, grey_folder_name]
+
+    start = time.perf_counter()
+    with ExitStack() as stack:
+        # The archives are closed even if processing fails, so their central directory is always written
+        archives = (
+            [stack.enter_context(ZipFile(f"{folder_name}.zip", "w")) for folder_name in folder_names] if zip_ else []
+        )
+        pool = stack.enter_context(Pool(num_workers or os.cpu_count()))
+        results = pool.imap_unordered(process_image, names, chunksize=64)
+        for name, outputs in tqdm(results, total=len(names), desc="Applying masks"):
+            for folder_name, archive, data in zip(folder_names, archives, outputs):
+                _add_to_archive(archive, Path(folder_name) / name, data)
+    elapsed = time.perf_counter() - start
+    print(f"Processed {len(names)} images in {elapsed:.1f}s ({len(names) / max(elapsed, 1e-9):.1f} images/s)")
+
+
+def _add_to_archive(archive, file, data):
+    """Add a file, already read, to a zip archive. Already-compressed image formats are stored as-is."""
+    compress_type = ZIP_STORED if file.suffix.lower() in stored_suffixes else ZIP_DEFLATED
+    archive.writestr(ZipInfo.from_file(file, file.name), data, compress_type=compress_type)
 
 
 if __name__ == "__main__":
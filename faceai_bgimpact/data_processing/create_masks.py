@@ -1,33 +1,65 @@
+import os
+from multiprocessing import Pool
 from pathlib import Path
 from tqdm import tqdm
 from rembg import remove, new_session
 from faceai_bgimpact.data_processing.paths import raw_folder_name, mask_folder_name
 
+# rembg session of the current worker process, created once by _init_worker
+_session = None
 
-def create_masks():
-    """Create cutout masks for the images."""
-    # Initialize rembg session
-    session = new_session("u2net_human_seg")
+
+def _init_worker(threads_per_worker):
+    """Create the rembg session of a worker process."""
+    global _session
+    # Split the cores between the workers, instead of every ONNX session using all of them.
+    # rembg reads this variable when creating the session options.
+    os.environ["OMP_NUM_THREADS"] = str(threads_per_worker)
+    _session = new_session("u2net_human_seg")
+
+
+def _create_mask(paths):
+    """Create the mask of one image."""
+    input_path, output_path = paths
+    with open(input_path, "rb") as i:
+        output_data = remove(i.read(), session=_session, only_mask=True)
+
+    # Write to a temporary file first, so that an interrupted run never leaves a truncated mask behind
+    tmp_path = output_path.with_suffix(".tmp")
+    with open(tmp_path, "wb") as o:
+        o.write(output_data)
+    os.replace(tmp_path, output_path)
+
+
+def create_masks(num_workers=None):
+    """
+    Create cutout masks for the images.
+
+    Masks that already exist are skipped, so an interrupted run can be resumed.
+
+    Parameters:
+    ----------
+    num_workers : int
+        Number of worker processes, each with its own rembg session. Defaults to the number of CPUs.
+    """
+    num_workers = num_workers or os.cpu_count()
 
     # Ensure the mask_folder_name directory exists
     mask_folder_path = Path(mask_folder_name)
     mask_folder_path.mkdir(parents=True, exist_ok=True)
 
-    # Get all the png files from raw_folder_name
-    files = list(Path(raw_folder_name).glob("*.png"))
-
-    # Initialize tqdm progress bar
-    for file in tqdm(files, desc="Creating masks"):
-        input_path = file
-        output_path = mask_folder_path / (file.stem + ".png")
-
-        if output_path.exists():
-            continue
-        with open(input_path, "rb") as i:
-            with open(output_path, "wb") as o:
-                input_data = i.read()
-                output_data = remove(input_data, session=session, only_mask=True)
-                o.write(output_data)
+    # List the existing masks once, instead of checking every output path
+    existing_masks = set(os.listdir(mask_folder_path))
+    files = [file for file in Path(raw_folder_name).glob("*.png") if file.stem + ".png" not in existing_masks]
+    print(f"{len(existing_masks)} masks already exist, {len(files)} left to create.")
+    if not files:
+        return
+
+    tasks = [(file, mask_folder_path / (file.stem + ".png")) for file in files]
+    threads_per_worker = max(1, os.cpu_count() // num_workers)
+    with Pool(num_workers, initializer=_init_worker, initargs=(threads_per_worker,)) as pool:
+        for _ in tqdm(pool.imap_unordered(_create_mask, tasks, chunksize=16), total=len(tasks), desc="Creating masks"):
+            pass
 
 
 if __name__ == "__main__":
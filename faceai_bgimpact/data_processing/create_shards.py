@@ -0,0 +1,60 @@
+import os
+import json
+import tarfile
+from tqdm import tqdm
+from faceai_bgimpact.data_processing.paths import data_folder
+
+
+def shards_folder(root_dir):
+    """Return the folder holding the shards of a dataset folder."""
+    return f"{root_dir.rstrip('/')}_shards"
+
+
+def create_shards(dataset_name, shard_size=5000, other_data_folder=None):
+    """
+    Write a dataset folder as a set of sequential tar shards, for streaming.
+
+    The images are stored as-is (no re-encoding). An index.json file next to the shards records,
+    for every shard, the name, data offset and size of each image, so single images can still be read directly.
+
+    Parameters:
+    ----------
+    dataset_name : str
+        Name of the dataset folder to convert (e.g. "ffhq_blur").
+    shard_size : int
+        Number of images per shard.
+    other_data_folder : str
+        Folder containing the dataset folder. If None, use the default data folder.
+    """
+    root_dir = f"{other_data_folder or data_folder}/{dataset_name}"
+    try:
+        image_files = sorted(f for f in os.listdir(root_dir) if os.path.isfile(os.path.join(root_dir, f)))
+    except FileNotFoundError:
+        raise FileNotFoundError("Please download the data first, using the download-all-ffhq command.")
+
+    output_dir = shards_folder(root_dir)
+    os.makedirs(output_dir, exist_ok=True)
+
+    shards = []
+    for shard_idx, start in enumerate(tqdm(range(0, len(image_files), shard_size), desc=f"Sharding {dataset_name}")):
+        shard_name = f"{dataset_name}-{shard_idx:05d}.tar"
+        shard_path = os.path.join(output_dir, shard_name)
+        end = start + shard_size
+        with tarfile.open(shard_path, "w") as tar:
+            for image_file in image_files[start:end]:
+                tar.add(os.path.join(root_dir, image_file), arcname=image_file)
+
+        # Read the headers back to record where each image starts in the shard
+        with tarfile.open(shard_path, "r") as tar:
+            members = [[m.name, m.offset_data, m.size] for m in tar.getmembers() if m.isfile()]
+        shards.append({"name": shard_name, "members": members})
+
+    with open(os.path.join(output_dir, "index.json"), "w") as f:
+        json.dump({"shards": shards}, f)
+
+    print(f"Wrote {len(image_files)} images to {len(shards)} shards in {output_dir}")
+    return output_dir
+
+
+if __name__ == "__main__":
+    create_shards("ffhq_raw")
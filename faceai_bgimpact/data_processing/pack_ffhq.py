@@ -0,0 +1,58 @@
+import os
+import json
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+from faceai_bgimpact.data_processing.paths import data_folder
+
+
+def memmap_paths(root_dir):
+    """Return the paths of the packed array and of its index for a dataset folder."""
+    root_dir = root_dir.rstrip("/")
+    return f"{root_dir}.npy", f"{root_dir}_index.json"
+
+
+def pack_ffhq(dataset_name, resolution=128, other_data_folder=None):
+    """
+    Pack a dataset folder into one contiguous uint8 array of shape (N, 3, H, W), stored as a .npy file.
+
+    The file names are written, in the same order, to a JSON index next to the array.
+
+    Parameters:
+    ----------
+    dataset_name : str
+        Name of the dataset folder to pack (e.g. "ffhq_raw").
+    resolution : int
+        Resolution of the packed images.
+    other_data_folder : str
+        Folder containing the dataset folder. If None, use the default data folder.
+    """
+    root_dir = f"{other_data_folder or data_folder}/{dataset_name}"
+    try:
+        image_files = sorted(f for f in os.listdir(root_dir) if os.path.isfile(os.path.join(root_dir, f)))
+    except FileNotFoundError:
+        raise FileNotFoundError("Please download the data first, using the download-all-ffhq command.")
+
+    array_path, index_path = memmap_paths(root_dir)
+    images = np.lib.format.open_memmap(
+        array_path, mode="w+", dtype=np.uint8, shape=(len(image_files), 3, resolution, resolution)
+    )
+
+    for idx, image_file in enumerate(tqdm(image_files, desc=f"Packing {dataset_name}")):
+        image = Image.open(os.path.join(root_dir, image_file)).convert("RGB")
+        if image.size != (resolution, resolution):
+            image = image.resize((resolution, resolution), Image.BILINEAR)
+        images[idx] = np.asarray(image).transpose(2, 0, 1)
+
+    images.flush()
+    del images
+
+    with open(index_path, "w") as f:
+        json.dump({"shape": [len(image_files), 3, resolution, resolution], "files": image_files}, f)
+
+    print(f"Packed {len(image_files)} images to {array_path}")
+    return array_path
+
+
+if __name__ == "__main__":
+    pack_ffhq("ffhq_raw")
@@ -2,6 +2,9 @@ import argparse
 from faceai_bgimpact.scripts.train import train_function
 from faceai_bgimpact.scripts.create_video import create_video_function
 from faceai_bgimpact.scripts.download_all_ffhq import download_all_ffhq
+from faceai_bgimpact.scripts.pack_ffhq import pack_ffhq
+from faceai_bgimpact.scripts.create_shards import create_shards
+from faceai_bgimpact.scripts.create_fid_stats import create_fid_stats
 from faceai_bgimpact.scripts.graph_fids import graph_fids_function
 from faceai_bgimpact.data_processing.create_masks import create_masks
 from faceai_bgimpact.scripts.create_blur_and_grey import create_blur_and_grey
@@ -62,6 +65,20 @@ def main():
         default=None,
         help="Epoch number of the checkpoint to resume training from",
     )
+    train_parser.add_argument(
+        "--storage",
+        type=str,
+        choices=["folder", "memmap", "shards"],
+        default="folder",
+        help="How the dataset is read: image files, or the outputs of pack-ffhq or create-shards",
+    )
+    train_parser.add_argument(
+        "--precision",
+        type=str,
+        choices=["fp32", "fp16", "bf16"],
+        default="fp32",
+        help="Training precision: full precision, or mixed precision with float16 or bfloat16",
+    )
 
     # Subparser for the 'create-video' command
     create_video_parser = subparsers.add_parser("create-video", help="Create a video from training frames")
@@ -87,6 +104,29 @@ def main():
     download_all_ffhq_parser.add_argument("--blur", action="store_true", help="Download blurred images")
     download_all_ffhq_parser.add_argument("--grey", action="store_true", help="Download grayscale images")
 
+    # Subparser for the 'pack-ffhq' command
+    pack_ffhq_parser = subparsers.add_parser("pack-ffhq", help="Pack FFHQ images into a memory-mapped array")
+    pack_ffhq_parser.add_argument("--raw", action="store_true", help="Pack raw images")
+    pack_ffhq_parser.add_argument("--blur", action="store_true", help="Pack blurred images")
+    pack_ffhq_parser.add_argument("--grey", action="store_true", help="Pack grayscale images")
+    pack_ffhq_parser.add_argument("--resolution", type=int, default=128, help="Resolution of the packed images")
+
+    # Subparser for the 'create-shards' command
+    create_shards_parser = subparsers.add_parser("create-shards", help="Write FFHQ images to tar shards for streaming")
+    create_shards_parser.add_argument("--raw", action="store_true", help="Shard raw images")
+    create_shards_parser.add_argument("--blur", action="store_true", help="Shard blurred images")
+    create_shards_parser.add_argument("--grey", action="store_true", help="Shard grayscale images")
+    create_shards_parser.add_argument("--shard-size", type=int, default=5000, help="Number of images per shard")
+
+    # Subparser for the 'create-fid-stats' command
+    create_fid_stats_parser = subparsers.add_parser(
+        "create-fid-stats", help="Compute the FID reference statistics of FFHQ datasets at all resolutions"
+    )
+    create_fid_stats_parser.add_argument("--raw", action="store_true", help="Statistics of raw images")
+    create_fid_stats_parser.add_argument("--blur", action="store_true", help="Statistics of blurred images")
+    create_fid_stats_parser.add_argument("--grey", action="store_true", help="Statistics of grayscale images")
+    create_fid_stats_parser.add_argument("--batch-size", type=int, default=250, help="Number of images per batch")
+
     # Subparser for the 'graph-fids' command
     graph_fids_parser = subparsers.add_parser("graph-fids", help="Graph FID scores")
     graph_fids_parser.add_argument(
@@ -105,11 +145,24 @@ def main():
     )
 
     # Subparser for the 'create-masks' command
-    subparsers.add_parser("create-masks", help="Create cutout masks for the images")
+    create_masks_parser = subparsers.add_parser("create-masks", help="Create cutout masks for the images")
+    create_masks_parser.add_argument(
+        "--num-workers", type=int, default=None, help="Number of worker processes. Defaults to the number of CPUs"
+    )
 
     # Subparser for the 'create-blur-and-grey' command
     create_blur_and_grey_parser = subparsers.add_parser("create-blur-and-grey", help="Create blurred and grey datasets")
     create_blur_and_grey_parser.add_argument("--zip", action="store_true", help="Compress the output folders")
+    create_blur_and_grey_parser.add_argument(
+        "--num-workers", type=int, default=None, help="Number of worker processes. Defaults to the number of CPUs"
+    )
+    create_blur_and_grey_parser.add_argument(
+        "--png-compression",
+        type=int,
+        choices=range(10),
+        default=1,
+        help="PNG compression level, from 0 (fastest) to 9 (smallest files)",
+    )
 
     args = parser.parse_args()
 
@@ -131,6 +184,8 @@ def main():
             list_checkpoints_flag=args.list,
             checkpoint_path=args.checkpoint_path,
             checkpoint_epoch=args.checkpoint_epoch,
+            storage=args.storage,
+            precision=args.precision,
         )
     elif args.command == "create-video":
         print("\n##############" + "#" * len(f" {args.model} - {args.dataset} ") + "##################")
@@ -156,6 +211,24 @@ def main():
                 parser.parse_args(["download-all-ffhq", "-h"])
         else:
             download_all_ffhq(raw=args.raw, blur=args.blur, grey=args.grey)
+    elif args.command == "pack-ffhq":
+        # If no flag was set, pack all three datasets
+        pack_all = not args.raw and not args.blur and not args.grey
+        for flag, dataset_name in [(args.raw, "ffhq_raw"), (args.blur, "ffhq_blur"), (args.grey, "ffhq_grey")]:
+            if flag or pack_all:
+                pack_ffhq(dataset_name, resolution=args.resolution)
+    elif args.command == "create-shards":
+        # If no flag was set, shard all three datasets
+        shard_all = not args.raw and not args.blur and not args.grey
+        for flag, dataset_name in [(args.raw, "ffhq_raw"), (args.blur, "ffhq_blur"), (args.grey, "ffhq_grey")]:
+            if flag or shard_all:
+                create_shards(dataset_name, shard_size=args.shard_size)
+    elif args.command == "create-fid-stats":
+        # If no flag was set, compute the statistics of all three datasets
+        stats_all = not args.raw and not args.blur and not args.grey
+        for flag, dataset_name in [(args.raw, "ffhq_raw"), (args.blur, "ffhq_blur"), (args.grey, "ffhq_grey")]:
+            if flag or stats_all:
+                create_fid_stats(dataset_name, batch_size=args.batch_size)
     elif args.command == "graph-fids":
         print("\n##############" + "#" * len(f" {args.model} - {args.dataset} ") + "##################")
         print(f"################ {args.model} - {args.dataset} ################")
@@ -167,10 +240,10 @@ def main():
         )
     elif args.command == "create-masks":
         print("Creating masks...")
-        create_masks()
+        create_masks(num_workers=args.num_workers)
     elif args.command == "create-blur-and-grey":
         print("Creating blurred and grey images...")
-        create_blur_and_grey(zip_=args.zip)
+        create_blur_and_grey(zip_=args.zip, num_workers=args.num_workers, png_compression=args.png_compression)
 
     else:
         parser.print_help()
@@ -1,5 +1,16 @@
+import os
+import torch
 from abc import ABC, abstractmethod
 
+from faceai_bgimpact.models.checkpoint import CheckpointWriter, CheckpointIndex
+from faceai_bgimpact.models.metrics import (
+    FIDEvaluator,
+    AsyncFIDEvaluator,
+    create_fid_stats,
+    fid_stats_path,
+    metric_names,
+)
+
 
 class AbstractModel(ABC):
     """
@@ -11,6 +22,8 @@ class AbstractModel(ABC):
     def __init__(self, dataset_name):
         self.dataset_name = dataset_name
         self.epoch_losses = {"train": [], "test": []}
+        # Number of latest checkpoints kept by the retention policy (None to keep all of them)
+        self.keep_checkpoints = None
 
     @staticmethod
     def _sanitize_path(path, trailing_slash=False):
@@ -35,6 +48,73 @@ class AbstractModel(ABC):
         base_dir = self._sanitize_path(base_dir)
         return f"{base_dir}_{self.dataset_name}"
 
+    def make_fid_stats(self, device):
+        """
+        Compute the FID reference statistics of the dataset, at all the resolutions, if they do not exist yet.
+
+        Parameters
+        ----------
+        device : torch.device
+            Device to use for calculation.
+        """
+        # If device is CPU, ignore and skip
+        if str(device) == "cpu":
+            return
+
+        # The bundle is shared by all the models and levels trained on the dataset
+        if os.path.exists(fid_stats_path(self.dataset_name)):
+            return
+
+        print("Generating FID stats for the dataset...")
+        create_fid_stats(self.dataset_name, device)
+
+    def record_test_metrics(self, metrics):
+        """Record the FID of an evaluation as test loss, and its other metrics, under their names (None if missing)."""
+        self.epoch_losses["test"].append(metrics.get("fid"))
+        for name in metric_names[1:]:
+            self.epoch_losses.setdefault(name, []).append(metrics.get(name))
+
+    def checkpoint_writer(self):
+        """Background checkpoint writer of the model, whose host buffers are reused between checkpoints."""
+        writer = getattr(self, "_checkpoint_writer", None)
+        if writer is None:
+            writer = self._checkpoint_writer = CheckpointWriter()
+        return writer
+
+    def checkpoint_index(self, save_folder):
+        """Index of a checkpoint folder, with the retention policy of the model, which later scores are recorded in."""
+        self._checkpoint_index = CheckpointIndex(save_folder, keep_last=self.keep_checkpoints)
+        return self._checkpoint_index
+
+    def record_checkpoint_fid(self, epoch, fid):
+        """
+        Record the FID of the checkpoint of an epoch in the index of the saved checkpoints, once the score is known.
+
+        Parameters
+        ----------
+        epoch : int
+            Epoch of the checkpoint, i.e. the number of epochs the scored model was trained for.
+        fid : float
+            FID of the scored model, or None if it was skipped: the checkpoint is then no longer waiting for it.
+        """
+        index = getattr(self, "_checkpoint_index", None)
+        if index is not None:
+            self.checkpoint_writer().update_index(index, epoch, fid)
+
+    def fid_evaluator(self, device):
+        """FID evaluator of the model, whose Inception network stays on the device between evaluations."""
+        evaluator = getattr(self, "_fid_evaluator", None)
+        if evaluator is None or evaluator.device != torch.device(device):
+            evaluator = self._fid_evaluator = FIDEvaluator(device)
+        return evaluator
+
+    def async_fid_evaluator(self, device):
+        """Background FID evaluator of the model, with its own Inception network on the device."""
+        evaluator = getattr(self, "_async_fid_evaluator", None)
+        if evaluator is None or evaluator.evaluator.device != torch.device(device):
+            evaluator = self._async_fid_evaluator = AsyncFIDEvaluator(FIDEvaluator(device))
+        return evaluator
+
     @abstractmethod
     def train(self, num_epochs, device, save_interval):
         """Run the training loop for the model."""
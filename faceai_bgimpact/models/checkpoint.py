@@ -0,0 +1,258 @@
+import os
+import copy
+import json
+import time
+import torch
+from concurrent.futures import ThreadPoolExecutor
+
+
+class CheckpointWriter:
+    """
+    Write checkpoints on a background thread, off the training critical path.
+
+    Saving a checkpoint only copies its tensors to host memory (pinned, and reused between checkpoints, for the
+    device tensors), so the training loop can keep updating the models while the copy is serialized.
+    Each file is written to a temporary path and renamed, so a crash during a write never leaves a partial checkpoint.
+    At most one write is in flight: saving a new checkpoint first waits for the previous one.
+    Index updates run on the same thread, after the writes queued before them.
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint")
+        self.pending = None
+        self.index_updates = []
+        self._host_buffers = {}
+
+    def snapshot(self, obj, key=()):
+        """
+        Copy of a checkpoint that the training loop cannot modify.
+
+        Tensors are copied to host memory, and containers and other values are copied recursively.
+        The copies of device tensors are asynchronous: they are complete once the current stream reaches this point.
+
+        Parameters:
+        ----------
+        obj : object
+            The checkpoint, usually a dict of state dicts and training parameters.
+        key : tuple
+            Position of obj in the checkpoint, identifying the host buffer reused for each device tensor.
+        """
+        if isinstance(obj, torch.Tensor):
+            if obj.device.type != "cuda":
+                return obj.detach().clone()
+            buffer = self._host_buffers.get(key)
+            if buffer is None or buffer.shape != obj.shape or buffer.dtype != obj.dtype:
+                buffer = self._host_buffers[key] = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=True)
+            return buffer.copy_(obj.detach(), non_blocking=True)
+        if isinstance(obj, dict):
+            return type(obj)((k, self.snapshot(v, key + (k,))) for k, v in obj.items())
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self.snapshot(v, key + (i,)) for i, v in enumerate(obj))
+        return copy.deepcopy(obj)
+
+    def save(self, checkpoint, path, asynchronous=True, index=None, entry=None):
+        """
+        Save a checkpoint, after waiting for the write in flight.
+
+        Parameters:
+        ----------
+        checkpoint : dict
+            The checkpoint, as passed to torch.save.
+        path : str
+            Path of the checkpoint file.
+        asynchronous : bool
+            Whether to return as soon as the checkpoint is copied, instead of when it is written.
+        index : CheckpointIndex
+            Index of the checkpoint folder, updated once the file is written.
+        entry : dict
+            Index entry of the checkpoint (see CheckpointIndex.add).
+
+        Returns:
+        ----------
+        str: The checkpoint path.
+        """
+        # The host buffers of the previous checkpoint are reused
+        self.wait()
+        checkpoint = self.snapshot(checkpoint)
+        event = None
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            event = torch.cuda.Event()
+            event.record()
+        self.pending = self.executor.submit(self._write, checkpoint, path, event, index, entry)
+        if not asynchronous:
+            self.wait()
+        return path
+
+    @staticmethod
+    def _write(checkpoint, path, event, index, entry):
+        """Write on the background thread, once the copies to the host are complete."""
+        start = time.perf_counter()
+        if event is not None:
+            event.synchronize()
+        tmp_path = f"{path}.tmp"
+        torch.save(checkpoint, tmp_path)
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+        elapsed = time.perf_counter() - start
+        print(f"Saved checkpoint {path} ({size / 2**20:.1f} MB in {elapsed:.2f}s)")
+        if index is not None:
+            # The index only lists checkpoints which are fully written
+            index.add(path, **(entry or {}))
+        return path, size, elapsed
+
+    def update_index(self, index, epoch, fid):
+        """
+        Record the FID of the checkpoint of an epoch, once its score is known, then apply the retention policy.
+
+        Parameters:
+        ----------
+        index : CheckpointIndex
+            Index of the checkpoint folder.
+        epoch : int
+            Epoch of the checkpoint (see CheckpointIndex.add).
+        fid : float
+            FID of the model saved in the checkpoint, or None if it was skipped.
+        """
+        self.index_updates.append(self.executor.submit(index.set_fid, epoch, fid))
+
+    def wait(self):
+        """
+        Wait for the write in flight and the queued index updates, if any.
+
+        Returns:
+        ----------
+        tuple: The path, size in bytes and write time in seconds of the checkpoint, or None if nothing was in flight.
+        """
+        result = None
+        if self.pending is not None:
+            future, self.pending = self.pending, None
+            result = future.result()
+        updates, self.index_updates = self.index_updates, []
+        for update in updates:
+            update.result()
+        return result
+
+
+class CheckpointIndex:
+    """
+    JSON index of the checkpoints of a folder, and their retention policy.
+
+    The index maps each epoch to its checkpoint file, level, alpha and FID, so that resuming and listing
+    do not scan the folder. The FID of a checkpoint is the score of the model it contains, recorded with set_fid
+    once known. When keep_last is set, adding or scoring a checkpoint removes the files of the others, except for:
+    the keep_last latest ones, the one with the best FID, the latest one of each level,
+    and the ones still waiting for their score.
+
+    Parameters:
+    ----------
+    checkpoint_dir : str
+        Folder of the checkpoints and of the index.
+    keep_last : int
+        Number of latest checkpoints to keep. If None, all the checkpoints are kept.
+    """
+
+    filename = "index.json"
+
+    def __init__(self, checkpoint_dir, keep_last=None):
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = keep_last
+        self.path = os.path.join(checkpoint_dir, self.filename)
+
+    @classmethod
+    def exists(cls, checkpoint_dir):
+        """Whether a folder has an index."""
+        return os.path.exists(os.path.join(checkpoint_dir, cls.filename))
+
+    def load(self):
+        """Entries of the index, by epoch (as a string, like in the JSON file)."""
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _dump(self, entries):
+        """Write the index atomically."""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entries, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def find(self, epoch):
+        """Path of the checkpoint of an epoch, or None if it is not in the index."""
+        entry = self.load().get(str(epoch))
+        return None if entry is None else os.path.join(self.checkpoint_dir, entry["file"])
+
+    def add(self, path, epoch, level=None, alpha=None, fid=None, pending=False):
+        """
+        Record a written checkpoint, then remove the checkpoints which the retention policy does not keep.
+
+        Parameters:
+        ----------
+        path : str
+            Path of the checkpoint file, in the checkpoint folder.
+        epoch : int
+            Epoch of the checkpoint, used to resume from it.
+        level : int
+            Progressive level of the checkpoint, if any.
+        alpha : float
+            Fade-in factor of the checkpoint, if any.
+        fid : float
+            FID of the model saved in the checkpoint, if already known.
+        pending : bool
+            Whether the FID of the checkpoint will be recorded later with set_fid.
+
+        Returns:
+        ----------
+        list of str: Paths of the removed checkpoints.
+        """
+        entries = self.load()
+        entry = dict(file=os.path.basename(path), epoch=epoch, level=level, alpha=alpha, fid=fid, pending=pending)
+        entries[str(epoch)] = entry
+        return self._prune(entries)
+
+    def set_fid(self, epoch, fid):
+        """
+        Record the FID of the checkpoint of an epoch, then remove the checkpoints which the policy does not keep.
+
+        Nothing is recorded if the epoch has no checkpoint.
+
+        Returns:
+        ----------
+        list of str: Paths of the removed checkpoints.
+        """
+        entries = self.load()
+        if str(epoch) not in entries:
+            return []
+        entries[str(epoch)].update(fid=fid, pending=False)
+        return self._prune(entries)
+
+    def _prune(self, entries):
+        """Write the index without the expired entries, and remove their files."""
+        removed = [os.path.join(self.checkpoint_dir, entries.pop(key)["file"]) for key in self.expired(entries)]
+        self._dump(entries)
+        for removed_path in removed:
+            if os.path.exists(removed_path):
+                os.remove(removed_path)
+        return removed
+
+    def expired(self, entries):
+        """Epoch keys of the entries which the retention policy does not keep."""
+        if self.keep_last is None:
+            return []
+        by_epoch = sorted(entries, key=lambda key: entries[key]["epoch"])
+        keep = set(by_epoch[::-1][: self.keep_last])
+
+        scored = [key for key in by_epoch if entries[key]["fid"] is not None]
+        if scored:
+            keep.add(min(scored, key=lambda key: entries[key]["fid"]))
+            # Scores arrive in order, so the checkpoints after the last scored one may still get the best score
+
+        # A checkpoint waiting for its score may turn out to be the best one
+        keep.update(key for key in by_epoch if entries[key].get("pending"))
+
+        latest_of_level = {}
+        for key in by_epoch:
+            latest_of_level[entries[key]["level"]] = key
+        keep.update(latest_of_level.values())
+        return [key for key in by_epoch if key not in keep]
@@ -1,14 +1,42 @@
 import os
-from torch.utils.data import Dataset, DataLoader
+import io
+import json
+import random
+import bisect
+import tarfile
+import torch
+import numpy as np
+import torch.nn.functional as F
+from tqdm import tqdm
+from torch.utils.data import Dataset, IterableDataset, DataLoader, Sampler, get_worker_info
 from torchvision import transforms
+from torchvision.transforms.functional import pil_to_tensor, resize
 from PIL import Image
 from faceai_bgimpact.data_processing.paths import data_folder
+from faceai_bgimpact.data_processing.pack_ffhq import memmap_paths
+from faceai_bgimpact.data_processing.create_shards import shards_folder
+
+# Resolutions stored by the pyramid cache: the progressive levels
+pyramid_resolutions = [4, 8, 16, 32, 64, 128]
 
 
 class FFHQDataset(Dataset):
-    """FFHQ dataset that returns blended images at two resolutions."""
+    """
+    FFHQ dataset that returns images at a given resolution, optionally blended with their half-resolution version.
 
-    def __init__(self, root_dir, resolution, alpha=1.0):
+    Parameters
+    ----------
+    root_dir : str
+        Folder containing the images.
+    resolution : int
+        The resolution of the returned images.
+    alpha : float
+        The alpha value for progressive growing.
+    cache : bool
+        Whether to decode every image once and keep uint8 copies at all progressive resolutions in memory.
+    """
+
+    def __init__(self, root_dir, resolution, alpha=1.0, cache=False):
         self.root_dir = root_dir
         try:
             self.image_files = [f for f in os.listdir(root_dir) if os.path.isfile(os.path.join(root_dir, f))]
@@ -16,51 +44,453 @@ class FFHQDataset(Dataset):
             raise FileNotFoundError("Please download the data first, using the download-all-ffhq command.")
         self.resolution = resolution
         self.alpha = alpha
-        self._update_transforms()
-
-    def _update_transforms(self):
-        self.transform = transforms.Compose(
-            [
-                transforms.Resize((self.resolution, self.resolution), antialias=True),
-                transforms.ToTensor(),
-                transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
-            ]
-        )
-        self.low_res_transform = transforms.Compose(
-            [
-                transforms.Resize((self.resolution // 2, self.resolution // 2), antialias=True),
-                transforms.Resize((self.resolution, self.resolution), antialias=True),  # Scale back up
-                transforms.ToTensor(),
-                transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
-            ]
-        )
+        self.transforms = {}
+        self.pyramid = self._build_pyramid() if cache else None
+
+    def _build_pyramid(self):
+        """Decode every image once and store it as uint8 tensors at all the pyramid resolutions."""
+        # One contiguous tensor per resolution, so that forked workers share the pages
+        pyramid = {res: torch.empty(len(self), 3, res, res, dtype=torch.uint8) for res in pyramid_resolutions}
+        resizers = {res: transforms.Resize((res, res), antialias=True) for res in pyramid_resolutions}
+
+        for idx, image_file in enumerate(tqdm(self.image_files, desc="Caching image pyramid")):
+            image = Image.open(os.path.join(self.root_dir, image_file))
+            for res, resizer in resizers.items():
+                pyramid[res][idx] = pil_to_tensor(resizer(image))
+
+        return pyramid
+
+    @staticmethod
+    def _normalize(image):
+        """Convert a uint8 image tensor to a float tensor in [-1, 1]."""
+        return image.float() / 127.5 - 1.0
+
+    def _transform(self, resolution):
+        """PIL transform to a normalized tensor at the given resolution."""
+        if resolution not in self.transforms:
+            self.transforms[resolution] = transforms.Compose(
+                [
+                    transforms.Resize((resolution, resolution), antialias=True),
+                    transforms.ToTensor(),
+                    transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
+                ]
+            )
+        return self.transforms[resolution]
 
     def update_alpha(self, new_alpha):
-        """Update the alpha value for progressive growing."""
+        """
+        Update the alpha value for progressive growing.
+
+        Only used when the dataset blends images itself. Training loops should leave alpha at 1.0
+        and blend whole batches on the device with fade_in instead.
+        """
         self.alpha = new_alpha
 
     def update_resolution(self, new_resolution):
         """Update the resolution of the images."""
+        if self.pyramid is not None and new_resolution not in self.pyramid:
+            raise ValueError(f"Resolution {new_resolution} is not cached. Available: {pyramid_resolutions}")
         self.resolution = new_resolution
-        self._update_transforms()
 
-    def __getitem__(self, idx):
-        """Get the blended image at the specified index."""
+    def _load(self, idx, resolution):
+        """Load the image at the specified index and resolution."""
+        if self.pyramid is not None:
+            return self._normalize(self.pyramid[resolution][idx])
+
         image_path = os.path.join(self.root_dir, self.image_files[idx])
         image = Image.open(image_path)
+        return self._transform(resolution)(image)
 
-        high_res_image = self.transform(image)
-        low_res_image = self.low_res_transform(image)
+    def __getitem__(self, idx):
+        """
+        Get the blended image at the specified index.
 
-        blended_image = self.alpha * high_res_image + (1 - self.alpha) * low_res_image
-        return blended_image
+        The index can also be an (index, resolution, alpha) tuple, as yielded by ProgressiveBatchSampler.
+        Worker processes then follow the changes made to the dataset in the main process.
+        """
+        idx, resolution, alpha = idx if isinstance(idx, tuple) else (idx, self.resolution, self.alpha)
+        return fade_in(self._load(idx, resolution).unsqueeze(0), alpha).squeeze(0)
 
     def __len__(self):
         """Length of the dataset."""
         return len(self.image_files)
 
 
-def get_dataloader(dataset_name, batch_size, shuffle=True, resolution=128, alpha=1.0, other_data_folder=None):
+class FFHQMemmapDataset(FFHQDataset):
+    """
+    FFHQ dataset read from a memory-mapped uint8 array, built with the pack-ffhq command.
+
+    The array is shared through the page cache by all the worker processes, and every image is a zero-copy view.
+
+    Parameters
+    ----------
+    root_dir : str
+        Folder of the packed dataset. The array and its index are stored next to it.
+    resolution : int
+        The resolution of the returned images.
+    alpha : float
+        The alpha value for progressive growing.
+    """
+
+    def __init__(self, root_dir, resolution, alpha=1.0):
+        self.root_dir = root_dir
+        self.array_path, index_path = memmap_paths(root_dir)
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            raise FileNotFoundError("Please pack the data first, using the pack-ffhq command.")
+        self.image_files = index["files"]
+        self.native_resolution = index["shape"][-1]
+        self.resolution = resolution
+        self.alpha = alpha
+        self.pyramid = None
+        self._images = None
+        self.transforms = {}
+
+    @property
+    def images(self):
+        """Memory-mapped array, opened lazily so that each worker process maps it on its own."""
+        if self._images is None:
+            # Copy-on-write mode gives writable arrays (as torch expects) without ever touching the file
+            self._images = np.load(self.array_path, mmap_mode="c")
+        return self._images
+
+    def __getstate__(self):
+        """Do not pickle the mapped array, only its path."""
+        state = self.__dict__.copy()
+        state["_images"] = None
+        return state
+
+    def _load(self, idx, resolution):
+        """Load the image at the specified index and resolution."""
+        image = self._normalize(torch.from_numpy(self.images[idx]))
+        if image.shape[-1] == resolution:
+            return image
+        return resize(image, [resolution, resolution], antialias=True)
+
+
+class FFHQShardDataset(IterableDataset):
+    """
+    FFHQ dataset streamed from sequential tar shards, built with the create-shards command.
+
+    Each worker process reads its own, fixed subset of the shards from start to end, and shuffles the images
+    through a buffer. The order of the shards of each worker changes at every epoch.
+
+    Parameters
+    ----------
+    root_dir : str
+        Folder of the dataset. The shards are stored next to it.
+    resolution : int
+        The resolution of the returned images.
+    alpha : float
+        The alpha value for progressive growing.
+    shuffle : bool
+        Whether to shuffle the shards and the images.
+    shuffle_buffer : int
+        Number of images in the shuffle buffer of each worker.
+    """
+
+    def __init__(self, root_dir, resolution, alpha=1.0, shuffle=True, shuffle_buffer=1000):
+        self.shards_dir = shards_folder(root_dir)
+        try:
+            with open(os.path.join(self.shards_dir, "index.json")) as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            raise FileNotFoundError("Please shard the data first, using the create-shards command.")
+        self.shards = index["shards"]
+        # Index of the first image of each shard, for direct access
+        self.offsets = np.cumsum([0] + [len(shard["members"]) for shard in self.shards]).tolist()
+        self.resolution = resolution
+        self.alpha = alpha
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.transforms = {}
+
+    _transform = FFHQDataset._transform
+
+    def update_alpha(self, new_alpha):
+        """Update the alpha value for progressive growing."""
+        self.alpha = new_alpha
+
+    def update_resolution(self, new_resolution):
+        """Update the resolution of the images."""
+        self.resolution = new_resolution
+
+    def _decode(self, data, resolution, alpha):
+        """Decode an encoded image to a blended tensor."""
+        image = self._transform(resolution)(Image.open(io.BytesIO(data)))
+        return fade_in(image.unsqueeze(0), alpha).squeeze(0)
+
+    def _worker_shards(self):
+        """Shards read by the current worker, and a random generator for its shuffle buffer."""
+        info = get_worker_info()
+        if info is None:
+            seed, worker_id, num_workers = torch.randint(2**31, ()).item(), 0, 1
+        else:
+            seed, worker_id, num_workers = info.seed, info.id, info.num_workers
+
+        # Each worker always reads the same shards, so the number of batches of an epoch is known in advance
+        shards = [shard["name"] for shard in self.shards][worker_id::num_workers]
+        rng = random.Random(seed)
+        if self.shuffle:
+            rng.shuffle(shards)
+        return shards, rng
+
+    def num_batches(self, batch_size, num_workers):
+        """
+        Number of batches of an epoch, when loaded by a DataLoader.
+
+        Every worker batches its own shards, so each of them yields a partial last batch.
+
+        Parameters
+        ----------
+        batch_size : int
+            Number of images per batch.
+        num_workers : int
+            Number of worker processes of the DataLoader (0 to load in the main process).
+        """
+        num_readers = max(num_workers, 1)
+        sizes = [len(shard["members"]) for shard in self.shards]
+        worker_sizes = [sum(sizes[worker_id::num_readers]) for worker_id in range(num_readers)]
+        return sum((size + batch_size - 1) // batch_size for size in worker_sizes)
+
+    def _read_shards(self, shards):
+        """Yield the encoded images of the shards, in order."""
+        for shard in shards:
+            # Stream mode: one sequential read per shard
+            with tarfile.open(os.path.join(self.shards_dir, shard), "r|") as tar:
+                for member in tar:
+                    if member.isfile():
+                        yield tar.extractfile(member).read()
+
+    def __iter__(self):
+        """Yield the images of the shards assigned to the current worker."""
+        resolution, alpha = self.resolution, self.alpha
+        shards, rng = self._worker_shards()
+        images = self._read_shards(shards)
+        if not self.shuffle:
+            for data in images:
+                yield self._decode(data, resolution, alpha)
+            return
+
+        buffer = []
+        for data in images:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(data)
+                continue
+            idx = rng.randrange(len(buffer))
+            yield self._decode(buffer[idx], resolution, alpha)
+            buffer[idx] = data
+        rng.shuffle(buffer)
+        for data in buffer:
+            yield self._decode(data, resolution, alpha)
+
+    def __getitem__(self, idx):
+        """Read the image at the specified index directly from its shard."""
+        shard_idx = bisect.bisect_right(self.offsets, idx) - 1
+        _, offset, size = self.shards[shard_idx]["members"][idx - self.offsets[shard_idx]]
+        with open(os.path.join(self.shards_dir, self.shards[shard_idx]["name"]), "rb") as f:
+            f.seek(offset)
+            data = f.read(size)
+        return self._decode(data, self.resolution, self.alpha)
+
+    def __len__(self):
+        """Length of the dataset."""
+        return self.offsets[-1]
+
+
+class ProgressiveBatchSampler(Sampler):
+    """
+    Batch sampler that tags every index with the current resolution and alpha of the dataset.
+
+    The sampler runs in the main process and reads them from the main-process dataset, so changes made there
+    (or to the batch size) also reach persistent worker processes, which only ever see the tagged indices.
+
+    Parameters
+    ----------
+    dataset : FFHQDataset
+        The dataset, in the main process.
+    batch_size : int
+        Number of images per batch.
+    shuffle : bool
+        Whether to shuffle the dataset at every epoch.
+    """
+
+    def __init__(self, dataset, batch_size, shuffle):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        """Yield batches of (index, resolution, alpha) tuples."""
+        num_images = len(self.dataset)
+        indices = torch.randperm(num_images).tolist() if self.shuffle else range(num_images)
+        for start in range(0, num_images, self.batch_size):
+            end = start + self.batch_size
+            batch = indices[start:end]
+            resolution, alpha = self.dataset.resolution, self.dataset.alpha
+            yield [(idx, resolution, alpha) for idx in batch]
+
+    def __len__(self):
+        """Number of batches per epoch."""
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+
+class DevicePrefetcher:
+    """
+    Iterate over a loader, copying the next batch to the device while the current one is being used.
+
+    On CUDA, the copy runs on a side stream from pinned memory, so it overlaps with the computation.
+
+    Parameters
+    ----------
+    loader : iterable
+        Loader yielding batches of tensors.
+    device : torch.device
+        Device to copy the batches to.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+
+    def __len__(self):
+        """Number of batches."""
+        return len(self.loader)
+
+    def _copy(self, batch, stream):
+        """Start copying a batch to the device."""
+        if batch is None:
+            return None
+        if stream is None:
+            return batch.to(self.device)
+        with torch.cuda.stream(stream):
+            return batch.to(self.device, non_blocking=True)
+
+    def __iter__(self):
+        """Yield the batches, on the device."""
+        stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        batches = iter(self.loader)
+        next_batch = self._copy(next(batches, None), stream)
+
+        while next_batch is not None:
+            batch = next_batch
+            if stream is not None:
+                # Wait for the copy, and tell the allocator the batch is now used on the compute stream
+                torch.cuda.current_stream(self.device).wait_stream(stream)
+                batch.record_stream(torch.cuda.current_stream(self.device))
+            next_batch = self._copy(next(batches, None), stream)
+            yield batch
+
+
+class ProgressiveDataLoader:
+    """
+    DataLoader that is reused across the levels of progressive growing.
+
+    Its worker processes stay alive between epochs and levels (except for streamed datasets),
+    batches are pinned in host memory, and they are prefetched to the device when one is given.
+
+    Parameters
+    ----------
+    dataset : FFHQDataset or FFHQShardDataset
+        The dataset to load.
+    batch_size : int
+        The batch size to use.
+    shuffle : bool
+        Whether to shuffle the dataset.
+    device : torch.device
+        Device to prefetch the batches to. If None, batches are yielded on the CPU.
+    num_workers : int
+        Number of worker processes. Defaults to the number of CPUs.
+    prefetch_factor : int
+        Number of batches loaded in advance by each worker.
+    """
+
+    def __init__(self, dataset, batch_size, shuffle=True, device=None, num_workers=None, prefetch_factor=2):
+        self.dataset = dataset
+        self.device = device
+        self.num_workers = os.cpu_count() if num_workers is None else num_workers
+        self.prefetch_factor = prefetch_factor if self.num_workers > 0 else None
+        self.streaming = isinstance(dataset, IterableDataset)
+
+        if self.streaming:
+            # Streamed datasets are sampled by their own workers: there is no sampler to carry the resolution,
+            # so the workers are restarted at every epoch to pick up the state of the main-process dataset
+            self._batch_size = batch_size
+            self.loader = self._streaming_loader()
+        else:
+            self.batch_sampler = ProgressiveBatchSampler(dataset, batch_size, shuffle)
+            self.loader = DataLoader(
+                dataset,
+                batch_sampler=self.batch_sampler,
+                num_workers=self.num_workers,
+                pin_memory=torch.cuda.is_available(),
+                persistent_workers=self.num_workers > 0,
+                prefetch_factor=self.prefetch_factor,
+            )
+
+    def _streaming_loader(self):
+        """Build the DataLoader over a streamed dataset, with the current batch size."""
+        return DataLoader(
+            self.dataset,
+            batch_size=self._batch_size,
+            num_workers=self.num_workers,
+            pin_memory=torch.cuda.is_available(),
+            prefetch_factor=self.prefetch_factor,
+        )
+
+    @property
+    def batch_size(self):
+        """Current batch size."""
+        return self._batch_size if self.streaming else self.batch_sampler.batch_size
+
+    def update_resolution(self, new_resolution, new_batch_size=None):
+        """
+        Update the resolution (and optionally the batch size) of the next epochs.
+
+        Parameters
+        ----------
+        new_resolution : int
+            The new resolution of the images.
+        new_batch_size : int
+            The new batch size. If None, keep the current one.
+        """
+        # The batch sampler forwards the resolution of the main-process dataset to the workers
+        self.dataset.update_resolution(new_resolution)
+        if new_batch_size is None or new_batch_size == self.batch_size:
+            return
+        if self.streaming:
+            self._batch_size = new_batch_size
+            self.loader = self._streaming_loader()
+        else:
+            self.batch_sampler.batch_size = new_batch_size
+
+    def __len__(self):
+        """Number of batches per epoch."""
+        if self.streaming:
+            return self.dataset.num_batches(self._batch_size, self.num_workers)
+        return len(self.batch_sampler)
+
+    def __iter__(self):
+        """Iterate over one epoch."""
+        if self.device is None:
+            return iter(self.loader)
+        return iter(DevicePrefetcher(self.loader, self.device))
+
+
+def get_dataloader(
+    dataset_name,
+    batch_size,
+    shuffle=True,
+    resolution=128,
+    alpha=1.0,
+    other_data_folder=None,
+    cache=False,
+    storage="folder",
+    device=None,
+    num_workers=None,
+):
     """
     Create a DataLoader for the specified FFHQ dataset.
 
@@ -76,16 +506,42 @@ def get_dataloader(dataset_name, batch_size, shuffle=True, resolution=128, alpha
         The resolution of the images in the dataset.
     alpha : float
         The alpha value for progressive growing.
+    other_data_folder : str
+        Folder containing the dataset folder. If None, use the default data folder.
+    cache : bool
+        Whether to cache the decoded images at all progressive resolutions (see FFHQDataset).
+    storage : str
+        How the dataset is stored on disk.
+        "folder" reads the image files, "memmap" reads the array written by the pack-ffhq command,
+        "shards" streams the tar shards written by the create-shards command.
+    device : torch.device
+        Device to prefetch the batches to. If None, batches are yielded on the CPU.
+    num_workers : int
+        Number of worker processes. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    dataset : FFHQDataset
+        The dataset.
+    loader : ProgressiveDataLoader
+        The loader. Use its update_resolution method to change levels without restarting the workers.
     """
     # Load the dataset with blended images
     if other_data_folder is None:
         root_dir = f"{data_folder}/{dataset_name}"
     else:
         root_dir = f"{other_data_folder}/{dataset_name}"
-    dataset = FFHQDataset(root_dir=root_dir, resolution=resolution, alpha=alpha)
+    if storage == "memmap":
+        dataset = FFHQMemmapDataset(root_dir=root_dir, resolution=resolution, alpha=alpha)
+    elif storage == "shards":
+        dataset = FFHQShardDataset(root_dir=root_dir, resolution=resolution, alpha=alpha, shuffle=shuffle)
+    elif storage == "folder":
+        dataset = FFHQDataset(root_dir=root_dir, resolution=resolution, alpha=alpha, cache=cache)
+    else:
+        raise ValueError(f"Unknown storage {storage}.")
 
     # Create DataLoader
-    loader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=os.cpu_count())
+    loader = ProgressiveDataLoader(dataset, batch_size, shuffle=shuffle, device=device, num_workers=num_workers)
 
     return dataset, loader
 
@@ -98,6 +554,29 @@ inv_normalize = transforms.Compose(
 )
 
 
+def fade_in(images, alpha):
+    """
+    Blend a batch of images with their half-resolution version, for the progressive growing transition.
+
+    Parameters:
+    ----------
+    images : torch.Tensor
+        Batch of images. Shape: (batch_size, channels, height, width)
+    alpha : float
+        Blending factor. 1.0 returns the images unchanged, 0.0 returns the half-resolution version.
+
+    Returns:
+    -------
+    torch.Tensor
+        The blended images, with the same shape as the input.
+    """
+    if alpha >= 1.0:
+        return images
+    # Downscale with the same pooling as the discriminator, and upscale like the generator
+    low_res_images = F.interpolate(F.avg_pool2d(images, 2), scale_factor=2, mode="bilinear")
+    return alpha * images + (1 - alpha) * low_res_images
+
+
 def denormalize_image(tensor):
     """
     Reverses the ImageNet normalization applied to images.
@@ -11,12 +11,11 @@ import torch.optim as optim
 
 from tqdm import tqdm
 from torchvision.utils import save_image
-from pytorch_gan_metrics import get_fid
 
-from faceai_bgimpact.data_processing.paths import data_folder
 from faceai_bgimpact.models.abstract_model import AbstractModel
+from faceai_bgimpact.models.metrics import fid_stats_path, format_metrics
 from faceai_bgimpact.models.data_loader import get_dataloader, denormalize_image
-from faceai_bgimpact.models.utils import weights_init
+from faceai_bgimpact.models.utils import weights_init, MixedPrecision
 
 from faceai_bgimpact.models.dcgan_.generator import Generator
 from faceai_bgimpact.models.dcgan_.discriminator import Discriminator
@@ -52,10 +51,11 @@ class DCGAN(AbstractModel):
         self.start_epoch = 0
         self.optimizer_G_config = {}
         self.optimizer_D_config = {}
+        self.amp = MixedPrecision()
 
-    def train_init(self, lr, batch_size):
+    def train_init(self, lr, batch_size, storage="folder", device=None):
         """Initialize the training parameters and optimizer."""
-        _, self.loader = get_dataloader(self.dataset_name, batch_size)
+        _, self.loader = get_dataloader(self.dataset_name, batch_size, storage=storage, device=device)
         self.optimizer_G = optim.Adam(self.generator.parameters(), lr=lr, betas=(0.5, 0.999))
         self.optimizer_D = optim.Adam(self.discriminator.parameters(), lr=lr, betas=(0.5, 0.999))
         self.adversarial_loss = nn.BCELoss()
@@ -67,7 +67,18 @@ class DCGAN(AbstractModel):
             print("Using loaded optimizer_G state...")
             self.optimizer_G.load_state_dict(self.optimizer_G_config)
 
-    def train(self, num_epochs, lr, batch_size, device, save_interval):
+    def train(
+        self,
+        num_epochs,
+        lr,
+        batch_size,
+        device,
+        save_interval,
+        storage="folder",
+        precision="fp32",
+        eval_images=1000,
+        keep_checkpoints=None,
+    ):
         """
         Trains the DCGAN model.
 
@@ -83,9 +94,25 @@ class DCGAN(AbstractModel):
             Device to use for training.
         save_interval : int
             Number of epochs to wait before saving the models and generated images. Defaults to 10.
+        storage : str
+            How the dataset is stored on disk ("folder", "memmap" or "shards").
+        precision : str
+            Training precision: "fp32", or mixed precision with "fp16" or "bf16".
+        eval_images : int
+            Number of generated images of each evaluation (FID, KID, precision and recall).
+            The FID is skipped below 2048, the dimension of the Inception features.
+        keep_checkpoints : int
+            Number of latest checkpoints to keep besides the best FID.
+            If None, all the checkpoints are kept.
         """
+        self.keep_checkpoints = keep_checkpoints
+
         # Initialize training parameters and optimizer
-        self.train_init(lr, batch_size)
+        self.train_init(lr, batch_size, storage, device)
+        self.amp = MixedPrecision(precision, device)
+
+        # Make FID stats
+        self.make_fid_stats(device)
 
         for epoch in range(self.start_epoch, num_epochs):
             self.generator.train()
@@ -115,17 +142,18 @@ class DCGAN(AbstractModel):
 
             if ((epoch + 1) % save_interval == 0) or (epoch <= 3):
                 print(f"Saving checkpoint at epoch {epoch+1}...")
-                self.save_checkpoint(epoch)
+                self.save_checkpoint(epoch, asynchronous=True)
 
             self.generate_images(epoch, device)
 
-            # Evaluate the FID score, and log it as 'test' loss
-            # FID needs at least 2048 images to compare the final average pooling features
-            # C.f. https://github.com/mseitzer/pytorch-fid
-            # We use 2048 + batch_size to ensure that ((2048 + batch_size) // batch_size) * batch_size > 2048
-            fid_score = self.calculate_fid(2048 + batch_size, batch_size, device)
-            self.epoch_losses["test"].append(fid_score)
-            print(f"FID: {fid_score:.2f}")
+            # Evaluate the FID score, and log it as 'test' loss (with the KID, precision and recall)
+            metrics = self.calculate_fid(eval_images, batch_size, device)
+            self.record_test_metrics(metrics)
+            self.record_checkpoint_fid(epoch + 1, metrics.get("fid"))
+            print(format_metrics(metrics))
+
+        # Wait for the last checkpoint
+        self.checkpoint_writer().wait()
 
     def perform_train_step(self, real_imgs, real_labels, fake_labels, batch_size, device):
         """
@@ -146,51 +174,64 @@ class DCGAN(AbstractModel):
         """
         # Generate fake images
         z = torch.randn(batch_size, self.latent_dim).to(device)
-        fake_imgs = self.generator(z)
+        with self.amp.autocast():
+            fake_imgs = self.generator(z)
+            fake_validity = self.discriminator(fake_imgs)
 
         # Train Generator
+        # BCELoss is not autocast-safe: the losses are computed in float32, outside of autocast
         self.optimizer_G.zero_grad()
-        g_loss = self.adversarial_loss(self.discriminator(fake_imgs), real_labels)
-        g_loss.backward()
-        self.optimizer_G.step()
+        g_loss = self.adversarial_loss(fake_validity.float(), real_labels)
+        self.amp.backward(g_loss)
+        self.amp.step(self.optimizer_G)
 
         # Train Discriminator
         self.optimizer_D.zero_grad()
-        real_loss = self.adversarial_loss(self.discriminator(real_imgs), real_labels)
-        fake_loss = self.adversarial_loss(self.discriminator(fake_imgs.detach()), fake_labels)
+        with self.amp.autocast():
+            real_validity = self.discriminator(real_imgs)
+            fake_validity = self.discriminator(fake_imgs.detach())
+        real_loss = self.adversarial_loss(real_validity.float(), real_labels)
+        fake_loss = self.adversarial_loss(fake_validity.float(), fake_labels)
         d_loss = (real_loss + fake_loss) / 2
-        d_loss.backward()
-        self.optimizer_D.step()
+        self.amp.backward(d_loss)
+        self.amp.step(self.optimizer_D)
+        self.amp.update()
 
         return g_loss, d_loss
 
     def calculate_fid(self, num_images, batch_size, device):
         """
-        Calculate the FID score.
+        Calculate the FID score and the other metrics of the same features.
 
         Parameters
         ----------
+        num_images : int
+            Number of generated images.
+        batch_size : int
+            Number of images generated at once.
         device : torch.device
             Device to use for calculation.
 
         Returns
         -------
-        fid_score : float
-            Computed FID score.
+        metrics : dict
+            Computed metrics, by name (see FIDEvaluator.compute_metrics).
         """
         self.generator.eval()
-        images = []
+
+        def batches():
+            for start in range(0, num_images, batch_size):
+                z = torch.randn(min(batch_size, num_images - start), self.latent_dim, device=device)
+                yield denormalize_image(self.generator(z))
+
+        # The generated batches go straight through the Inception network, without being kept
         with torch.no_grad():
-            for _ in range(num_images // batch_size):
-                z = torch.randn(batch_size, self.latent_dim).to(device)
-                images.append(self.generator(z).detach().cpu())
+            metrics = self.fid_evaluator(device).evaluate_metrics(
+                batches(), fid_stats_path(self.dataset_name), resolution=128
+            )
 
         self.generator.train()
-        imgs = torch.cat(images, dim=0)
-        denormalized_imgs = denormalize_image(imgs)
-
-        stats_path = f"{data_folder}/{self.dataset_name}_statistics.npz"
-        return get_fid(denormalized_imgs, stats_path)
+        return metrics
 
     def generate_images(self, epoch, device, save_dir="outputs/generated_images"):
         """
@@ -224,7 +265,7 @@ class DCGAN(AbstractModel):
         denormalized_image = denormalize_image(fake_image)
         save_image(denormalized_image, os.path.join(save_folder, filename), normalize=False)
 
-    def save_checkpoint(self, epoch, save_dir="outputs/checkpoints"):
+    def save_checkpoint(self, epoch, save_dir="outputs/checkpoints", asynchronous=False):
         """
         Save a checkpoint of the current state. This includes the models, optimizers, FIDs, and training params.
 
@@ -234,6 +275,8 @@ class DCGAN(AbstractModel):
             Current epoch.
         save_dir : str
             Directory to save the checkpoint to.
+        asynchronous : bool
+            Whether to write the checkpoint in the background, and return as soon as it is copied.
         """
         save_folder = self.get_save_dir(save_dir)
         os.makedirs(save_folder, exist_ok=True)
@@ -249,8 +292,11 @@ class DCGAN(AbstractModel):
             "dataset_name": self.dataset_name,
             "latent_dim": self.latent_dim,
         }
-        torch.save(checkpoint, checkpoint_path)
-        return checkpoint_path
+        # The FID of the saved model is recorded in the index when its score arrives
+        entry = dict(epoch=epoch + 1, pending=True)
+        return self.checkpoint_writer().save(
+            checkpoint, checkpoint_path, asynchronous, index=self.checkpoint_index(save_folder), entry=entry
+        )
 
     @classmethod
     def from_checkpoint(cls, checkpoint_path, device):
@@ -0,0 +1,489 @@
+import os
+import numpy as np
+import torch
+from PIL import Image
+from tqdm import tqdm
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from torch.utils.data import Dataset, DataLoader
+from torchvision.transforms.functional import pil_to_tensor
+from pytorch_gan_metrics.core import calculate_frechet_distance
+from pytorch_gan_metrics.inception import InceptionV3
+
+from faceai_bgimpact.data_processing.paths import data_folder
+
+# Resolutions of the reference statistics: the progressive levels
+fid_resolutions = [4, 8, 16, 32, 64, 128]
+
+# Metrics of an evaluation, besides the FID when the reference features are available
+metric_names = ["fid", "kid", "precision", "recall"]
+
+
+def fid_stats_path(dataset_name, other_data_folder=None):
+    """Path of the reference statistics bundle of a dataset, shared by all the models."""
+    return f"{other_data_folder or data_folder}/{dataset_name}_fid_stats.npz"
+
+
+def format_metrics(metrics):
+    """One-line summary of the metrics of an evaluation."""
+    names = {"fid": "FID", "kid": "KID", "precision": "Precision", "recall": "Recall"}
+    return ", ".join(f"{names[name]}: {metrics[name]:.4g}" for name in metric_names if metrics.get(name) is not None)
+
+
+def kernel_inception_distance(real_features, fake_features, num_subsets=100, max_subset_size=1000, seed=0):
+    """
+    Kernel Inception Distance, the unbiased squared MMD with a cubic polynomial kernel, averaged over subsets.
+
+    Unlike the FID, the estimate is unbiased, so that it can be compared across small numbers of samples.
+
+    Parameters:
+    ----------
+    real_features : torch.Tensor
+        Features of real images.
+        Shape: (num_real, dims)
+    fake_features : torch.Tensor
+        Features of generated images, on the same device.
+        Shape: (num_fake, dims)
+    num_subsets : int
+        Number of random subsets the estimate is averaged over.
+    max_subset_size : int
+        Maximum number of samples of each set in a subset.
+    seed : int
+        Seed of the subset sampling.
+
+    Returns:
+    ----------
+    float: The KID.
+    """
+    real_features, fake_features = real_features.double(), fake_features.double()
+    dims = real_features.shape[1]
+    m = min(len(real_features), len(fake_features), max_subset_size)
+    generator = torch.Generator().manual_seed(seed)
+    total = 0.0
+    for _ in range(num_subsets):
+        x = real_features[torch.randperm(len(real_features), generator=generator)[:m].to(real_features.device)]
+        y = fake_features[torch.randperm(len(fake_features), generator=generator)[:m].to(fake_features.device)]
+        a = (x @ x.t() / dims + 1) ** 3 + (y @ y.t() / dims + 1) ** 3
+        b = (x @ y.t() / dims + 1) ** 3
+        total += ((a.sum() - a.diagonal().sum()) / (m - 1) - b.sum() * 2 / m).item() / m
+    return total / num_subsets
+
+
+def precision_recall(real_features, fake_features, k=3):
+    """
+    Improved precision and recall (Kynkaanniemi et al., 2019).
+
+    The manifold of a set of features is the union of the balls around each feature reaching its k-th nearest neighbor.
+    Precision is the fraction of generated features in the real manifold, recall the fraction of real features
+    in the generated manifold.
+
+    Parameters:
+    ----------
+    real_features : torch.Tensor
+        Features of real images.
+        Shape: (num_real, dims)
+    fake_features : torch.Tensor
+        Features of generated images, on the same device.
+        Shape: (num_fake, dims)
+    k : int
+        Neighborhood size of the manifold estimates.
+
+    Returns:
+    ----------
+    tuple of float: The precision and the recall.
+    """
+    real_features, fake_features = real_features.float(), fake_features.float()
+
+    def radii(features):
+        # The nearest neighbor of each feature is itself
+        return torch.cdist(features, features).kthvalue(k + 1, dim=1).values
+
+    distances = torch.cdist(real_features, fake_features)
+    precision = (distances <= radii(real_features)[:, None]).any(0).float().mean().item()
+    recall = (distances <= radii(fake_features)[None, :]).any(1).float().mean().item()
+    return precision, recall
+
+
+class FeatureStatistics:
+    """
+    Running mean and covariance of features, accumulated in float64 on a device.
+
+    Parameters:
+    ----------
+    dims : int
+        Dimension of the features.
+    device : torch.device
+        Device on which the statistics are accumulated.
+    """
+
+    def __init__(self, dims, device):
+        self.num_samples = 0
+        self.sum = torch.zeros(dims, dtype=torch.float64, device=device)
+        self.outer = torch.zeros(dims, dims, dtype=torch.float64, device=device)
+
+    def update(self, features):
+        """Accumulate a (batch_size, dims) batch of features."""
+        features = features.double()
+        self.sum += features.sum(0)
+        self.outer.addmm_(features.t(), features)
+        self.num_samples += features.shape[0]
+
+    def statistics(self):
+        """Mean and covariance of the accumulated features, as float64 arrays."""
+        if self.num_samples < 2:
+            raise ValueError("At least 2 samples are needed to compute the feature statistics.")
+        mu = self.sum / self.num_samples
+        sigma = (self.outer - self.num_samples * torch.outer(mu, mu)) / (self.num_samples - 1)
+        return mu.cpu().numpy(), sigma.cpu().numpy()
+
+
+class FIDEvaluator:
+    """
+    Streaming Frechet Inception Distance, and the other metrics of the same Inception features.
+
+    The Inception network stays on the device between evaluations. Generated batches go straight through it,
+    and only the running sum and second moment of their features are kept (in float64),
+    so the memory use does not depend on the number of images and no image is copied to the host.
+    The first max_features features are also kept on the device, for the KID and the precision and recall.
+
+    Parameters:
+    ----------
+    device : torch.device
+        Device on which the features are computed and accumulated.
+    dims : int
+        Dimension of the Inception features.
+    feature_extractor : torch.nn.Module
+        Network mapping images in [0, 1] to (batch_size, dims) features. Defaults to the FID InceptionV3.
+    max_features : int
+        Maximum number of features kept for the KID and the precision and recall.
+    """
+
+    def __init__(self, device, dims=2048, feature_extractor=None, max_features=2048):
+        self.device = torch.device(device)
+        self.dims = dims
+        self.max_features = max_features
+        if feature_extractor is None:
+            feature_extractor = InceptionV3([InceptionV3.BLOCK_INDEX_BY_DIM[dims]])
+        self.feature_extractor = feature_extractor.to(self.device).eval()
+        self.reset()
+
+    def reset(self):
+        """Forget the accumulated features."""
+        self.running = FeatureStatistics(self.dims, self.device)
+        self.samples = []
+
+    @property
+    def num_images(self):
+        """Number of images accumulated since the last reset."""
+        return self.running.num_samples
+
+    @torch.no_grad()
+    def features(self, images):
+        """Features of a batch of images in [0, 1]."""
+        features = self.feature_extractor(images.to(self.device, torch.float32))
+        if isinstance(features, (list, tuple)):
+            # InceptionV3 returns the list of the requested blocks
+            features = features[0]
+        return features.view(-1, self.dims)
+
+    def update(self, images):
+        """
+        Accumulate the features of a batch of images.
+
+        Parameters:
+        ----------
+        images : torch.Tensor
+            Images in [0, 1], e.g. denormalized generator outputs.
+            Shape: (batch_size, 3, height, width)
+        """
+        features = self.features(images)
+        self.running.update(features)
+        num_kept = sum(len(samples) for samples in self.samples)
+        if num_kept < self.max_features:
+            self.samples.append(features[: self.max_features - num_kept])
+
+    def statistics(self):
+        """Mean and covariance of the accumulated features, as float64 arrays."""
+        return self.running.statistics()
+
+    @staticmethod
+    def load_statistics(stats_path, resolution=None):
+        """
+        Reference mean and covariance from a stats file.
+
+        Parameters:
+        ----------
+        stats_path : str
+            Either a bundle written by create_fid_stats, or a single-resolution file written by pytorch_gan_metrics.
+        resolution : int
+            Resolution of the statistics to read from a bundle.
+        """
+        with np.load(stats_path) as f:
+            if resolution is not None and f"mu_{resolution}" in f:
+                return f[f"mu_{resolution}"][:], f[f"sigma_{resolution}"][:]
+            if "mu" not in f:
+                raise KeyError(f"No statistics for resolution {resolution} in {stats_path}")
+            return f["mu"][:], f["sigma"][:]
+
+    @staticmethod
+    def load_features(stats_path, resolution=None):
+        """Reference features from a stats bundle, or None if it has none (e.g. a single-resolution file)."""
+        with np.load(stats_path) as f:
+            key = f"features_{resolution}"
+            return f[key].astype(np.float32) if key in f else None
+
+    def compute(self, stats_path, resolution=None):
+        """
+        FID between the accumulated features and the reference statistics of a stats file.
+
+        Returns None, with a warning, for fewer images than feature dimensions.
+        """
+        if self.num_images < self.dims:
+            # The covariance would be rank-deficient, and the FID biased upwards
+            print(f"Warning: the FID needs at least {self.dims} images, got {self.num_images}. Skipping it.")
+            return None
+        mu, sigma = self.statistics()
+        ref_mu, ref_sigma = self.load_statistics(stats_path, resolution)
+        return float(calculate_frechet_distance(mu, sigma, ref_mu, ref_sigma))
+
+    def compute_metrics(self, stats_path, resolution=None):
+        """
+        FID, KID and precision and recall of the accumulated features, against a stats file.
+
+        Returns:
+        ----------
+        dict: The metrics, by name (see metric_names). Only the FID is computed when the file has no reference features,
+            and the FID is None for fewer images than feature dimensions.
+        """
+        metrics = {"fid": self.compute(stats_path, resolution)}
+        reference = self.load_features(stats_path, resolution)
+        if reference is not None and self.samples:
+            reference = torch.from_numpy(reference).to(self.device)
+            samples = torch.cat(self.samples)
+            metrics["kid"] = kernel_inception_distance(reference, samples)
+            metrics["precision"], metrics["recall"] = precision_recall(reference, samples)
+        return metrics
+
+    def evaluate(self, batches, stats_path, resolution=None):
+        """
+        FID of a stream of image batches.
+
+        Parameters:
+        ----------
+        batches : iterable of torch.Tensor
+            Batches of images in [0, 1], consumed one at a time.
+        stats_path : str
+            Path of the reference statistics.
+        resolution : int
+            Resolution of the reference statistics, when stats_path is a bundle.
+
+        Returns:
+        ----------
+        float: The FID score, or None for fewer images than feature dimensions.
+        """
+        self.reset()
+        for images in batches:
+            self.update(images)
+        return self.compute(stats_path, resolution)
+
+    def evaluate_metrics(self, batches, stats_path, resolution=None):
+        """
+        FID, KID and precision and recall of a stream of image batches, from a single feature extraction.
+
+        Parameters:
+        ----------
+        batches : iterable of torch.Tensor
+            Batches of images in [0, 1], consumed one at a time.
+        stats_path : str
+            Path of the reference statistics.
+        resolution : int
+            Resolution of the reference statistics, when stats_path is a bundle.
+
+        Returns:
+        ----------
+        dict: The metrics, by name (see compute_metrics).
+        """
+        self.reset()
+        for images in batches:
+            self.update(images)
+        return self.compute_metrics(stats_path, resolution)
+
+
+class AsyncFIDEvaluator:
+    """
+    Run FID evaluations, with the other metrics of evaluate_metrics, on a background thread.
+
+    The evaluations are off the training critical path.
+    At most one evaluation is in flight: submitting a new one first waits for the previous one.
+    On CUDA, the evaluation runs on its own stream, so that it overlaps with the training kernels.
+    The networks used by an evaluation must be snapshots, which the training loop does not modify.
+
+    Parameters:
+    ----------
+    evaluator : FIDEvaluator
+        Evaluator used by the background thread, and only by it.
+    """
+
+    def __init__(self, evaluator):
+        self.evaluator = evaluator
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fid")
+        self.stream = torch.cuda.Stream(evaluator.device) if evaluator.device.type == "cuda" else None
+        self.pending = None
+
+    def submit(self, batches, stats_path, tag=None, resolution=None):
+        """
+        Start an evaluation, after waiting for the one in flight.
+
+        Parameters:
+        ----------
+        batches : callable
+            Function returning the iterable of image batches, called on the background thread.
+        stats_path : str
+            Path of the reference statistics.
+        tag : object
+            Identifies the evaluation in the results, e.g. the epoch.
+        resolution : int
+            Resolution of the reference statistics, when stats_path is a bundle.
+
+        Returns:
+        ----------
+        list of tuple: The (tag, metrics) result of the previous evaluation, if any.
+        """
+        results = self.wait()
+        if self.stream is not None:
+            # The snapshots may have been written by kernels that are still queued on the training stream
+            self.stream.wait_stream(torch.cuda.current_stream(self.evaluator.device))
+        self.pending = (tag, self.executor.submit(self._run, batches, stats_path, resolution))
+        return results
+
+    def _run(self, batches, stats_path, resolution):
+        """Evaluation on the background thread (gradient and stream contexts are thread-local)."""
+        with torch.no_grad(), torch.cuda.stream(self.stream) if self.stream is not None else nullcontext():
+            metrics = self.evaluator.evaluate_metrics(batches(), stats_path, resolution)
+        if self.stream is not None:
+            self.stream.synchronize()
+        return metrics
+
+    def poll(self):
+        """The (tag, metrics) result of the evaluation in flight if it has finished, without blocking."""
+        if self.pending is None or not self.pending[1].done():
+            return []
+        return self.wait()
+
+    def wait(self):
+        """The (tag, metrics) result of the evaluation in flight, waiting for it to finish."""
+        if self.pending is None:
+            return []
+        tag, future = self.pending
+        self.pending = None
+        return [(tag, future.result())]
+
+
+class _MultiResolutionImages(Dataset):
+    """Images of a folder, decoded once and returned as uint8 tensors at several resolutions."""
+
+    def __init__(self, root_dir, resolutions):
+        self.root_dir = root_dir
+        try:
+            self.image_files = sorted(f for f in os.listdir(root_dir) if os.path.isfile(os.path.join(root_dir, f)))
+        except FileNotFoundError:
+            raise FileNotFoundError("Please download the data first, using the download-all-ffhq command.")
+        self.resolutions = resolutions
+
+    def __getitem__(self, idx):
+        """The image at every resolution, resized like the reference statistics of pytorch_gan_metrics."""
+        image = Image.open(os.path.join(self.root_dir, self.image_files[idx])).convert("RGB")
+        return [
+            pil_to_tensor(image if image.size == (res, res) else image.resize((res, res), Image.BILINEAR))
+            for res in self.resolutions
+        ]
+
+    def __len__(self):
+        return len(self.image_files)
+
+
+def create_fid_stats(
+    dataset_name,
+    device=None,
+    batch_size=250,
+    num_workers=None,
+    other_data_folder=None,
+    resolutions=fid_resolutions,
+    dims=2048,
+    feature_extractor=None,
+    num_features=2048,
+):
+    """
+    Compute the FID reference statistics of a dataset at all the progressive resolutions, in a single pass.
+
+    Every image is decoded once and resized to all the resolutions in the loader workers,
+    and the Inception features are accumulated per resolution. The statistics are written to one bundle
+    (see fid_stats_path), with mu_<resolution> and sigma_<resolution> arrays, and the features of a random subset
+    of num_features images in features_<resolution> (float16), for the KID and the precision and recall.
+
+    Parameters:
+    ----------
+    dataset_name : str
+        Name of the dataset folder (e.g. "ffhq_raw").
+    device : torch.device
+        Device running the Inception network. Defaults to CUDA when available.
+    batch_size : int
+        Number of images per Inception batch, at each resolution.
+    num_workers : int
+        Number of image decoding workers. Defaults to the number of CPUs minus one.
+    other_data_folder : str
+        Folder containing the dataset folder. If None, use the default data folder.
+    resolutions : list of int
+        Resolutions of the statistics.
+    dims : int
+        Dimension of the Inception features.
+    feature_extractor : torch.nn.Module
+        Network mapping images in [0, 1] to (batch_size, dims) features. Defaults to the FID InceptionV3.
+    num_features : int
+        Number of images whose features are stored.
+
+    Returns:
+    ----------
+    str: Path of the bundle.
+    """
+    device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    if num_workers is None:
+        num_workers = max((os.cpu_count() or 1) - 1, 0)
+
+    dataset = _MultiResolutionImages(f"{other_data_folder or data_folder}/{dataset_name}", resolutions)
+    # The images are shuffled, so that the first num_features images are a random subset of the dataset
+    loader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=True,
+        generator=torch.Generator().manual_seed(0),
+        num_workers=num_workers,
+        pin_memory=device.type == "cuda",
+    )
+    evaluator = FIDEvaluator(device, dims, feature_extractor)
+    running = {res: FeatureStatistics(evaluator.dims, device) for res in resolutions}
+    kept = {res: [] for res in resolutions}
+
+    for batch in tqdm(loader, desc=f"FID statistics of {dataset_name}"):
+        for res, images in zip(resolutions, batch):
+            images = images.to(device, non_blocking=True).float() / 255
+            features = evaluator.features(images)
+            running[res].update(features)
+            num_kept = sum(len(features) for features in kept[res])
+            if num_kept < num_features:
+                kept[res].append(features[: num_features - num_kept].half().cpu())
+
+    arrays = {}
+    for res in resolutions:
+        arrays[f"mu_{res}"], arrays[f"sigma_{res}"] = running[res].statistics()
+        arrays[f"features_{res}"] = torch.cat(kept[res]).numpy()
+
+    # Write to a temporary file first, so an interrupted run never leaves a partial bundle
+    stats_path = fid_stats_path(dataset_name, other_data_folder)
+    os.makedirs(os.path.dirname(stats_path) or ".", exist_ok=True)
+    tmp_path = f"{stats_path[:-len('.npz')]}.tmp.npz"
+    np.savez_compressed(tmp_path, **arrays)
+    os.replace(tmp_path, stats_path)
+
+    print(f"Saved the FID statistics of {len(dataset)} images at resolutions {resolutions} to {stats_path}")
+    return stats_path
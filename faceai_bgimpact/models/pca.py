@@ -0,0 +1,263 @@
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+import torch.nn as nn
+from joblib import dump, load
+from sklearn.decomposition import PCA
+
+
+class PCABasis(nn.Module):
+    """
+    PCA projection as float32 tensors, for editing latent vectors without leaving the device.
+
+    Holds the same quantities as a fitted sklearn PCA, and projects and reconstructs batches like
+    its transform and inverse_transform methods.
+
+    Parameters:
+    ----------
+    components : torch.Tensor
+        Principal axes, sorted by decreasing explained variance.
+        Shape: (n_components, n_features)
+    mean : torch.Tensor
+        Mean of the training data.
+        Shape: (n_features,)
+    explained_variance : torch.Tensor
+        Variance explained by each component.
+        Shape: (n_components,)
+    whiten : bool
+        Whether the projected coordinates have unit variance.
+    """
+
+    def __init__(self, components, mean, explained_variance, whiten=False):
+        super().__init__()
+        self.register_buffer("components", torch.as_tensor(components, dtype=torch.float32))
+        self.register_buffer("mean", torch.as_tensor(mean, dtype=torch.float32))
+        self.register_buffer("explained_variance", torch.as_tensor(explained_variance, dtype=torch.float32))
+        self.whiten = whiten
+
+    @classmethod
+    def from_sklearn(cls, pca):
+        """Build the basis of a fitted sklearn PCA, e.g. loaded from a joblib file."""
+        return cls(pca.components_, pca.mean_, pca.explained_variance_, whiten=pca.whiten)
+
+    @property
+    def n_components(self):
+        """Number of components."""
+        return self.components.shape[0]
+
+    def directions(self):
+        """
+        Latent direction of each component, i.e. the change of a reconstruction when its coordinate increases by 1.
+
+        Shape: (n_components, n_features)
+        """
+        if self.whiten:
+            return self.explained_variance.sqrt()[:, None] * self.components
+        return self.components
+
+    def project(self, x):
+        """
+        Coordinates of a batch of latent vectors in the basis, like PCA.transform.
+
+        Parameters:
+        ----------
+        x : torch.Tensor
+            Latent vectors, flattened to (batch_size, n_features).
+
+        Returns:
+        ----------
+        torch.Tensor: Coordinates.
+            Shape: (batch_size, n_components)
+        """
+        coordinates = (x.flatten(1).to(self.mean) - self.mean) @ self.components.t()
+        if self.whiten:
+            coordinates = coordinates / self.explained_variance.sqrt()
+        return coordinates
+
+    def reconstruct(self, coordinates):
+        """
+        Latent vectors from a batch of coordinates, like PCA.inverse_transform.
+
+        Parameters:
+        ----------
+        coordinates : torch.Tensor
+            Coordinates, the first ones if there are fewer than n_components (the others are zero).
+            Shape: (batch_size, <= n_components) or (<= n_components,) for a single vector
+
+        Returns:
+        ----------
+        torch.Tensor: Latent vectors.
+            Shape: (batch_size, n_features) or (n_features,)
+        """
+        coordinates = torch.as_tensor(coordinates).to(self.mean)
+        return coordinates @ self.directions()[: coordinates.shape[-1]] + self.mean
+
+
+class StreamingPCA:
+    """
+    Fit a PCA from batches of samples as they are produced, with a memory use independent of the number of samples.
+
+    The mean and covariance are accumulated in float64 on the device, and the principal axes are
+    the eigenvectors of the covariance matrix, as with a full PCA.
+
+    Parameters:
+    ----------
+    n_components : int
+        Number of components to keep.
+    device : torch.device
+        Device on which the statistics are accumulated.
+    """
+
+    def __init__(self, n_components, device="cpu"):
+        self.n_components = n_components
+        self.device = device
+        self.n_samples = 0
+        self.shift = None
+        self.sum = None
+        self.outer = None
+
+    def partial_fit(self, x):
+        """
+        Accumulate a batch of samples.
+
+        Parameters:
+        ----------
+        x : torch.Tensor
+            Samples, flattened to (batch_size, n_features).
+        """
+        x = x.detach().flatten(1).to(self.device, torch.float64)
+        if self.shift is None:
+            # Accumulating around a first estimate of the mean avoids cancellations in the covariance
+            self.shift = x.mean(0)
+            self.sum = torch.zeros_like(self.shift)
+            self.outer = torch.zeros(x.shape[1], x.shape[1], dtype=torch.float64, device=self.device)
+        x = x - self.shift
+        self.sum += x.sum(0)
+        self.outer.addmm_(x.t(), x)
+        self.n_samples += x.shape[0]
+        return self
+
+    def to_sklearn(self):
+        """
+        The fitted PCA, as a sklearn PCA object (e.g. to be saved with joblib or wrapped in a PCABasis).
+
+        Returns:
+        ----------
+        sklearn.decomposition.PCA: PCA with the same fitted attributes as PCA(n_components).fit(samples).
+        """
+        if self.n_samples < 2:
+            raise ValueError("At least 2 samples are needed to fit a PCA.")
+        centered_mean = self.sum / self.n_samples
+        covariance = (self.outer - self.n_samples * torch.outer(centered_mean, centered_mean)) / (self.n_samples - 1)
+        eigenvalues, eigenvectors = torch.linalg.eigh(covariance)
+
+        # Decreasing order, and the sign convention of sklearn (largest coefficient of each axis positive)
+        eigenvalues = eigenvalues.flip(0).clamp_min(0).cpu().numpy()
+        components = eigenvectors.flip(1).t()[: self.n_components]
+        signs = torch.sign(components.gather(1, components.abs().argmax(1, keepdim=True)))
+        components = (components * signs).cpu().numpy()
+
+        n_components, n_features = components.shape
+        pca = PCA(n_components=n_components)
+        pca.n_components_ = n_components
+        pca.n_samples_ = self.n_samples
+        pca.n_features_in_ = n_features
+        pca.components_ = components.astype(np.float32)
+        pca.mean_ = (self.shift + centered_mean).cpu().numpy().astype(np.float32)
+        pca.explained_variance_ = eigenvalues[:n_components].astype(np.float32)
+        pca.explained_variance_ratio_ = (eigenvalues[:n_components] / eigenvalues.sum()).astype(np.float32)
+        pca.singular_values_ = np.sqrt(pca.explained_variance_ * (self.n_samples - 1))
+        discarded = eigenvalues[n_components:]
+        pca.noise_variance_ = float(discarded.mean()) if len(discarded) else 0.0
+        return pca
+
+
+class PCACache:
+    """
+    Content-addressed cache of fitted PCAs.
+
+    A PCA is stored under a hash of the weights of the network producing the latent vectors
+    and of the fit parameters, so it is reused exactly when it would be fitted again on the same inputs.
+    When the cache grows beyond max_size bytes, the least recently used files are removed.
+
+    Parameters:
+    ----------
+    cache_dir : str
+        Folder of the cached PCA files.
+    max_size : int
+        Maximum total size of the cache, in bytes.
+    """
+
+    def __init__(self, cache_dir="models/pca_cache", max_size=256 * 2**20):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    @staticmethod
+    def key(module, **params):
+        """
+        Hash of the state of a module and of parameters.
+
+        Parameters:
+        ----------
+        module : torch.nn.Module
+            Network producing the latent vectors, e.g. the mapping network or the encoder.
+        **params
+            JSON-serializable fit parameters (number of samples and components, seed, dataset...).
+
+        Returns:
+        ----------
+        str: Hexadecimal SHA-256 digest.
+        """
+        sha = hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode())
+        for name, tensor in module.state_dict().items():
+            sha.update(f"{name}:{tensor.dtype}:{tuple(tensor.shape)}".encode())
+            sha.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+        return sha.hexdigest()
+
+    def path(self, key):
+        """Path of the cached PCA of a key."""
+        return os.path.join(self.cache_dir, f"{key}.joblib")
+
+    def load(self, key):
+        """Cached PCA of a key, or None if there is none."""
+        path = self.path(key)
+        try:
+            pca = load(path)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # Unreadable files (e.g. interrupted writes from an older version) are fitted again
+            os.remove(path)
+            return None
+        # Mark as recently used
+        os.utime(path)
+        return pca
+
+    def save(self, key, pca):
+        """Store the PCA of a key, then evict the least recently used files if the cache is too large."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.path(key)
+        # Write to a temporary file first, so concurrent readers never see a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        dump(pca, tmp_path)
+        os.replace(tmp_path, path)
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        """Remove the least recently used files until the cache fits in max_size (the keep file is never removed)."""
+        entries = []
+        for file in os.listdir(self.cache_dir):
+            if file.endswith(".joblib"):
+                path = os.path.join(self.cache_dir, file)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if path != keep:
+                os.remove(path)
+                total_size -= size
@@ -1,12 +1,8 @@
-import os
 import torch
 
-from pytorch_gan_metrics import get_fid
-from pytorch_gan_metrics.utils import calc_and_save_stats
-
-from faceai_bgimpact.data_processing.paths import data_folder
 from faceai_bgimpact.models.data_loader import get_dataloader, denormalize_image
 from faceai_bgimpact.models.abstract_model import AbstractModel
+from faceai_bgimpact.models.metrics import fid_stats_path, format_metrics, metric_names
 
 from provae import ProVAE as BaseProVAE
 
@@ -39,7 +35,7 @@ class ProVAE(BaseProVAE, AbstractModel):
 
         self.optimizer_config = {}
         self.latent_vector = torch.randn(64, self.latent_dim)
-        self.fids = {"level": [], "epoch": [], "fid": []}
+        self.fids = {"level": [], "epoch": [], **{name: [] for name in metric_names}}
 
     def train_init(self, lr):
         """
@@ -57,7 +53,7 @@ class ProVAE(BaseProVAE, AbstractModel):
         self.alpha = 1.0
         self.epoch_total = None
 
-    def train(self, lr, device, save_interval, image_interval):
+    def train(self, lr, device, save_interval, image_interval, eval_images=1000):
         """
         Train the model.
 
@@ -71,6 +67,9 @@ class ProVAE(BaseProVAE, AbstractModel):
             The number of epochs between saving checkpoints.
         image_interval : int
             The number of epochs between saving images.
+        eval_images : int
+            The number of generated images of each evaluation (FID, KID, precision and recall).
+            The FID is skipped below 2048, the dimension of the Inception features.
         """
         if hasattr(self, "current_epochs"):
             if self.current_epochs[self.level] == (
@@ -90,27 +89,30 @@ class ProVAE(BaseProVAE, AbstractModel):
             self.current_epochs = {level: 0 for level in range(self.config)}
             self.train_init(lr=lr)
 
+        # The loader and its workers are created once, and follow the resolution of each level
+        self.dataset, self.loader = get_dataloader(
+            self.dataset_name,
+            self.config[start_level]["batch_size"],
+            shuffle=True,
+            resolution=self.config[start_level]["resolution"],
+            alpha=self.alpha,
+            device=device,
+        )
+
+        # Computing FID stats for all the levels
+        self.make_fid_stats(device)
+
         for level in range(start_level, len(range(self.config))):
             # Set the resolution and alpha
             self.level = level
             self.resolution = self.config[level]["resolution"]
             self.batch_size = self.config[level]["batch_size"]
-
-            self.dataset, self.loader = get_dataloader(
-                self.dataset_name,
-                self.batch_size,
-                shuffle=True,
-                resolution=self.resolution,
-                alpha=self.alpha,
-            )
+            self.loader.update_resolution(self.resolution, self.batch_size)
 
             # Calculate total epochs for this level from configuration
             total_level_epochs = self.config[level]["transition_epochs"] + self.config[level]["stabilization_epochs"]
             start_epoch_for_level = start_epoch if level == start_level else 0
 
-            # Computing FID stats for current level
-            self.make_fid_stats(device)
-
             # Epoch loop for current level
             for epoch in range(start_epoch_for_level, total_level_epochs):
                 self.current_epochs[level] = epoch
@@ -119,7 +121,7 @@ class ProVAE(BaseProVAE, AbstractModel):
 
                 # Calculate FID score of epoch
                 if self.alpha == 1.0:
-                    self.calculate_fid(2048 + self.batch_size, self.batch_size, device)
+                    self.calculate_fid(eval_images, self.batch_size, device)
 
                 # Save checkpoint
                 if (self.epoch_total + 1) % save_interval == 0:
@@ -130,68 +132,36 @@ class ProVAE(BaseProVAE, AbstractModel):
             if level < len(self.config) - 1:
                 self.alpha = 0.0  # Reset alpha for the next level
 
-    def make_fid_stats(self, device, save_dir="outputs/ProVAE_fid_stats"):
+    def calculate_fid(self, num_images, batch_size, device):
         """
-        Calculate and save FID stats for the dataset.
+        Calculate the FID score and the other metrics of the same features, and record them in self.fids.
 
         Parameters
         ----------
+        num_images : int
+            Number of generated images.
+        batch_size : int
+            Number of images generated at once.
         device : torch.device
             Device to use for calculation.
-        save_dir : str
-            Directory to save the stats to.
         """
-        # If device is CPU, ignore and skip
-        print(device)
         if str(device) == "cpu":
             return
+        self.generator.eval()
 
-        dataset_folder = f"{data_folder}/{self.dataset_name}"
-        save_file = self.get_save_dir(save_dir) + f"{self.resolution}.npz"
-
-        # If the stats file already exists, skip
-        if os.path.exists(save_file):
-            return
-
-        print("Generating FID stats for resolution", self.resolution, "...")
-        calc_and_save_stats(
-            dataset_folder,
-            save_file,
-            batch_size=64,
-            img_size=self.resolution,
-            use_torch=True,
-            num_workers=os.cpu_count(),
-        )
-
-    def calculate_fid(self, num_images, batch_size, device, stats_dir="outputs/ProVAE_fid_stats"):
-        """
-        Calculate the FID score.
-
-        Parameters
-        ----------
-        device : torch.device
-            Device to use for calculation.
+        def batches():
+            for start in range(0, num_images, batch_size):
+                z = torch.randn(min(batch_size, num_images - start), self.latent_dim, device=device)
+                yield denormalize_image(self.generator(z, self.level, self.alpha))
 
-        Returns
-        -------
-        fid_score : float
-            Computed FID score.
-        """
-        if str(device) == "cpu":
-            return
-        self.generator.eval()
-        images = []
+        # The generated batches go straight through the Inception network, without being kept
+        stats_path = fid_stats_path(self.dataset_name)
         with torch.no_grad():
-            for _ in range(num_images // batch_size):
-                z = torch.randn(batch_size, self.latent_dim).to(device)
-                images.append(denormalize_image(self.generator(z, self.level, self.alpha).detach()).cpu())
+            metrics = self.fid_evaluator(device).evaluate_metrics(batches(), stats_path, self.resolution)
 
         self.generator.train()
-        imgs = torch.cat(images, dim=0)
-
-        stats_file = self.get_save_dir(stats_dir) + f"{self.resolution}.npz"
-        fid = get_fid(imgs, stats_file)
         self.fids["level"].append(self.level)
         self.fids["epoch"].append(self.epoch_total)
-        self.fids["fid"].append(fid)
-        print("Level", self.level, "Epoch", self.epoch_total, "FID", fid)
+        for name in metric_names:
+            self.fids[name].append(metrics.get(name))
+        print("Level", self.level, "Epoch", self.epoch_total, format_metrics(metrics))
@@ -1,3 +1,4 @@
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -35,9 +36,14 @@ class LastDiscriminatorBlock(nn.Module):
         self.conv3 = WSConv2d(in_channels, 1, 1, 1, 0, gain=1)
         self.activation = nn.LeakyReLU(negative_slope=0.2)
 
-    def forward(self, x):
-        """Forward pass."""
-        x = self.minibatch_stddev(x)
+    def forward(self, x, num_splits=1):
+        """
+        Forward pass.
+
+        The batch can be made of num_splits independent batches of the same size (e.g. real and fake images),
+        in which case the minibatch standard deviation is computed within each of them.
+        """
+        x = torch.cat([self.minibatch_stddev(chunk) for chunk in x.chunk(num_splits)])
         x = self.activation(self.conv1(x))
         x = self.activation(self.conv2(x))
         x = self.conv3(x)
@@ -76,7 +82,13 @@ class Discriminator(nn.Module):
 
         self.len_layers = len(self.downscale_blocks)
 
-    def forward(self, img, current_level, alpha):
+    def _downscale(self, level, x, num_splits):
+        """Apply the downscale block of a level."""
+        if level == self.len_layers - 1:
+            return self.downscale_blocks[level](x, num_splits)
+        return self.downscale_blocks[level](x)
+
+    def forward(self, img, current_level, alpha, num_splits=1):
         """
         Forward pass with progressive growing.
 
@@ -88,6 +100,10 @@ class Discriminator(nn.Module):
             Current resolution level for progressive growing (e.g., 0 for 4x4, 1 for 8x8, etc.).
         alpha : float
             Blending factor for progressive growing.
+        num_splits : int
+            Number of independent batches of the same size concatenated in img.
+            The minibatch statistics are computed separately for each of them,
+            so the scores are the same as with one forward pass per batch.
 
         Returns:
         ----------
@@ -103,7 +119,7 @@ class Discriminator(nn.Module):
 
             # Then, make the input image a latent vector and downsample the result
             vector = self.from_rgb_layers[first_layer](img)
-            downsampled_vector = self.downscale_blocks[first_layer](vector)
+            downsampled_vector = self._downscale(first_layer, vector, num_splits)
 
             # Blend the two latent vectors
             x = (1 - alpha) * vector_from_downsampled_image + alpha * downsampled_vector
@@ -112,11 +128,11 @@ class Discriminator(nn.Module):
             # Normal processing
             # rgb_img -> latent vector -> downsample
             x = self.from_rgb_layers[first_layer](img)
-            x = self.downscale_blocks[first_layer](x)
+            x = self._downscale(first_layer, x, num_splits)
 
         # Skipping level=first_layer because it is already processed above
         for level in range(first_layer + 1, self.len_layers):
-            x = self.downscale_blocks[level](x)
+            x = self._downscale(level, x, num_splits)
 
         # Flatten the output
         return x.view(x.shape[0], -1)
@@ -87,7 +87,7 @@ class SynthesisBlock(nn.Module):
         else:
             self.conv = WSConv2d(in_channel, out_channel, 3, 1, 1)
 
-    def forward(self, x, w1, w2, apply_noise):
+    def forward(self, x, style1, style2, apply_noise):
         """
         Forward pass for the StyleGAN convolutional block.
 
@@ -95,10 +95,11 @@ class SynthesisBlock(nn.Module):
         ----------
         x (torch.Tensor): Input tensor.
             Shape: (batch_size, in_channel, height, width)
-        w1 (torch.Tensor): Style tensor.
-            Shape: (batch_size, style_dim)
-        w2 (torch.Tensor): Style tensor. Will be the same as w1 except in layer analysis.
-            Shape: (batch_size, style_dim)
+        style1 (tuple of torch.Tensor): AdaIN (scale, bias) of the first layer, see SynthesisNetwork.compute_styles.
+            Shape: (batch_size, out_channel, 1, 1) each
+        style2 (tuple of torch.Tensor): AdaIN (scale, bias) of the second layer.
+            Will be the same as style1 except in layer analysis.
+            Shape: (batch_size, out_channel, 1, 1) each
         apply_noise (bool): Whether to add noise to the input tensor.
 
         Returns:
@@ -106,15 +107,15 @@ class SynthesisBlock(nn.Module):
         torch.Tensor: Output tensor.
             Shape: (batch_size, out_channel, height, width)
         """
-        if w2 is None:
-            w2 = w1
+        if style2 is None:
+            style2 = style1
         if not self.is_first_block:
-            x = F.interpolate(x, scale_factor=2, mode="bilinear", antialias=True)
+            x = F.interpolate(x, scale_factor=2, mode="bilinear")
             x = self.conv1(x)
 
         if apply_noise:
             x = x + self.noise1(x.shape[0], x.device)
-        x = self.adain(x, w1)
+        x = self.adain(x, style1)
         x = self.act(x)
 
         if not self.is_first_block:
@@ -123,7 +124,7 @@ class SynthesisBlock(nn.Module):
             x = self.conv(x)
         if apply_noise:
             x = x + self.noise2(x.shape[0], x.device)
-        x = self.adain(x, w2)
+        x = self.adain(x, style2)
         x = self.act(x)
 
         return x
@@ -168,15 +169,61 @@ class SynthesisNetwork(nn.Module):
             ]
         )
 
-    def forward(self, w, current_level, alpha, apply_noise):
+    def compute_styles(self, ws, current_level):
         """
-        Forward pass with progressive growing.
+        Compute the AdaIN styles of every layer up to a level with batched matrix products.
+
+        The scale and bias transforms of each AdaIN module are concatenated into one affine map, instead of running
+        two 1x1 convolutions per layer. A shared style vector goes through the maps of all the blocks at once,
+        and per-layer style vectors only through the map of their block.
 
         Parameters:
         ----------
-        w : torch.Tensor
-            Style tensor.
-            Shape: (batch_size, w_dim)
+        ws : torch.Tensor or list of torch.Tensor
+            Either a batch of style vectors used for all the layers,
+            or one batch per layer (2 per block, 2 * (current_level + 1) in total), e.g. for style mixing.
+            Shape: (batch_size, w_dim), (batch_size, w_dim, 1, 1) or (w_dim,) for a single vector
+        current_level : int
+            Current resolution level for progressive growing.
+
+        Returns:
+        ----------
+        list of tuple of torch.Tensor: The (scale, bias) pair of each layer, to be passed to synthesize.
+            Shape: (batch_size, channels, 1, 1) each
+        """
+        adains = [self.init_block.adain] + [block.adain for block in self.upscale_blocks[:current_level]]
+        weights, biases = zip(*[adain.style_weights() for adain in adains])
+
+        if torch.is_tensor(ws):
+            # The two layers of a block share the style, and all the blocks are computed at once
+            weight, bias = torch.cat(weights), torch.cat(biases)
+            block_styles = torch.addmm(bias, ws.reshape(-1, weight.shape[1]), weight.t())
+            block_styles = block_styles.split([2 * adain.dim for adain in adains], dim=1)
+            layer_styles = [style for block_style in block_styles for style in (block_style, block_style)]
+        else:
+            if len(ws) != 2 * len(adains):
+                raise ValueError(f"Expected {2 * len(adains)} style vectors at level {current_level}, got {len(ws)}.")
+            # Each layer only needs the rows of its block: one product per block, for its two layers
+            layer_ws = [w.reshape(-1, weights[0].shape[1]) for w in ws]
+            layer_styles = []
+            for i, (weight, bias) in enumerate(zip(weights, biases)):
+                block_ws = torch.stack([layer_ws[2 * i], layer_ws[2 * i + 1]])
+                layer_styles.extend(torch.matmul(block_ws, weight.t()) + bias)
+
+        styles = []
+        for layer_style in layer_styles:
+            scale, shift = layer_style.chunk(2, dim=1)
+            styles.append((scale[:, :, None, None], shift[:, :, None, None]))
+        return styles
+
+    def synthesize(self, styles, current_level, alpha, apply_noise):
+        """
+        Generate images from precomputed styles, with progressive growing.
+
+        Parameters:
+        ----------
+        styles : list of tuple of torch.Tensor
+            The (scale, bias) pair of each layer, as returned by compute_styles.
         current_level : int
             Current resolution level for progressive growing.
         alpha : float
@@ -188,42 +235,41 @@ class SynthesisNetwork(nn.Module):
         ----------
         torch.Tensor: Generated image tensor.
         """
-        x = self.learned_constant.repeat(w.shape[0], 1, 1, 1)
+        x = self.learned_constant.repeat(styles[0][0].shape[0], 1, 1, 1)
 
-        x = self.init_block(x, w, w, apply_noise=apply_noise)
+        x = self.init_block(x, styles[0], styles[1], apply_noise=apply_noise)
 
         # Get the initial RGB image at 4x4 resolution
         if current_level <= 1:
             rgb = self.to_rgb_layers[0](x)
 
         for level in range(1, current_level + 1):
-            x = self.upscale_blocks[level - 1](x, w, w, apply_noise=apply_noise)
+            x = self.upscale_blocks[level - 1](x, styles[2 * level], styles[2 * level + 1], apply_noise=apply_noise)
 
             if alpha < 1.0 and level == current_level:
                 # Interpolate between the new RGB image of the current resolution
                 # and the upscaled RGB image of the previous resolution
                 new_rgb = self.to_rgb_layers[level](x)
-                rgb = F.interpolate(rgb, scale_factor=2, mode="bilinear", antialias=True)
+                # Antialiasing has no effect when upscaling, and is not implemented for all autocast dtypes
+                rgb = F.interpolate(rgb, scale_factor=2, mode="bilinear")
                 rgb = alpha * new_rgb + (1 - alpha) * rgb
             else:
                 rgb = self.to_rgb_layers[level](x)
         return rgb
 
-    def predict_modified_layer(self, new_ws, current_level, apply_noise):
+    def forward(self, w, current_level, alpha, apply_noise):
         """
-        Generate an image using base_w for all layers except specified layers where new_w is used.
-
-        Assumes alpha = 1.0.
+        Forward pass with progressive growing.
 
         Parameters:
         ----------
-        new_ws : torch.Tensor
-            New style tensor to be used in specified layers.
-            Shape: (n_layers, batch_size, w_dim)
-        new_w_layers : list of int
-            List of layer indices where new_w should be used.
+        w : torch.Tensor
+            Style tensor.
+            Shape: (batch_size, w_dim)
         current_level : int
             Current resolution level for progressive growing.
+        alpha : float
+            Blending factor for progressive growing.
         apply_noise : bool
             Whether to add noise to the input tensor.
 
@@ -231,21 +277,29 @@ class SynthesisNetwork(nn.Module):
         ----------
         torch.Tensor: Generated image tensor.
         """
-        w1 = new_ws[0].unsqueeze(0).unsqueeze(2).unsqueeze(3)
-        w2 = new_ws[1].unsqueeze(0).unsqueeze(2).unsqueeze(3)
-        x = self.learned_constant.repeat(w1.shape[0], 1, 1, 1)
+        return self.synthesize(self.compute_styles(w, current_level), current_level, alpha, apply_noise)
 
-        x = self.init_block(x, w1, w2, apply_noise=apply_noise)
+    def predict_modified_layer(self, new_ws, current_level, apply_noise):
+        """
+        Generate an image with a different style vector for each layer.
 
-        for level in range(1, current_level + 1):
-            w1 = new_ws[2 * level].unsqueeze(0).unsqueeze(2).unsqueeze(3)
-            w2 = new_ws[2 * level + 1].unsqueeze(0).unsqueeze(2).unsqueeze(3)
-            x = self.upscale_blocks[level - 1](x, w1, w2, apply_noise=apply_noise)
+        Assumes alpha = 1.0.
 
-            if level == current_level:
-                rgb = self.to_rgb_layers[level](x)
+        Parameters:
+        ----------
+        new_ws : list of torch.Tensor
+            Style vector of each layer (2 per block, 2 * (current_level + 1) in total).
+            Shape: (w_dim,) or (batch_size, w_dim) each
+        current_level : int
+            Current resolution level for progressive growing.
+        apply_noise : bool
+            Whether to add noise to the input tensor.
 
-        return rgb
+        Returns:
+        ----------
+        torch.Tensor: Generated image tensor.
+        """
+        return self.synthesize(self.compute_styles(new_ws, current_level), current_level, 1.0, apply_noise)
 
 
 class Generator(nn.Module):
@@ -256,6 +310,14 @@ class Generator(nn.Module):
         self.mapping = MappingNetwork(latent_dim, style_layers, w_dim)
         self.synthesis = SynthesisNetwork(w_dim)
 
+    def freeze_for_inference(self):
+        """
+        Switch the generator to inference: eval mode, and no gradient for the parameters.
+
+        The weight-scaled layers then reuse their scaled weights between calls, until the weights change.
+        """
+        return self.eval().requires_grad_(False)
+
     def forward(self, z, current_level, alpha, apply_noise=True):
         """
         Forward pass for the StyleGAN generator.
@@ -1,14 +1,41 @@
 from abc import ABC, abstractmethod
 import torch
 import torch.nn as nn
+from faceai_bgimpact.models.utils import MixedPrecision
 
 
 class GANLoss(ABC):
-    """Abstract base class for GAN Losses."""
+    """
+    Abstract base class for GAN Losses.
+
+    The amp attribute holds the MixedPrecision of the training loop, used for the gradient penalties.
 
-    def __init__(self, G, D):
+    Parameters:
+    ----------
+    G : torch.nn.Module
+        Generator network.
+    D : torch.nn.Module
+        Discriminator network.
+    fused : bool
+        Whether to score the real and fake images in a single discriminator pass.
+    """
+
+    def __init__(self, G, D, fused=False):
         self.G = G
         self.D = D
+        self.fused = fused
+        self.amp = MixedPrecision()
+
+    def _scores(self, level, alpha, *images):
+        """
+        Discriminator scores of batches of images of the same size.
+
+        When fused, the batches are concatenated into a single discriminator pass,
+        which keeps the minibatch statistics of each batch separate.
+        """
+        if not self.fused:
+            return [self.D(batch, level, alpha) for batch in images]
+        return self.D(torch.cat(images), level, alpha, num_splits=len(images)).chunk(len(images))
 
     @abstractmethod
     def d_loss(self, real_images, fake_images, level, alpha):
@@ -24,13 +51,12 @@ class GANLoss(ABC):
 class WGAN(GANLoss):
     """Wasserstein GAN (WGAN) loss."""
 
-    def __init__(self, G, D):
-        super().__init__(G, D)
+    def __init__(self, G, D, fused=False):
+        super().__init__(G, D, fused)
 
     def d_loss(self, real_images, fake_images, level, alpha):
         """Discriminator loss."""
-        real_scores = self.D(real_images, level, alpha)
-        fake_scores = self.D(fake_images, level, alpha)
+        real_scores, fake_scores = self._scores(level, alpha, real_images, fake_images)
         loss = torch.mean(fake_scores) - torch.mean(real_scores)
         return loss
 
@@ -54,22 +80,24 @@ class WGAN_GP(GANLoss):
         Gradient penalty coefficient.
     drift : float
         Drift coefficient.
+    fused : bool
+        Whether to score the real, fake and interpolated images in a single discriminator pass.
     """
 
-    def __init__(self, G, D, lambda_gp=10, drift=0.001):
-        super().__init__(G, D)
+    def __init__(self, G, D, lambda_gp=10, drift=0.001, fused=False):
+        super().__init__(G, D, fused)
         self.drift = drift
         self.lambda_gp = lambda_gp
 
     def d_loss(self, real_images, fake_images, level, alpha):
         """Discriminator loss."""
-        real_scores = self.D(real_images, level, alpha)
-        fake_scores = self.D(fake_images, level, alpha)
+        merged = self._interpolate(real_images, fake_images)
+        real_scores, fake_scores, merged_scores = self._scores(level, alpha, real_images, fake_images, merged)
 
         loss = torch.mean(fake_scores) - torch.mean(real_scores) + (self.drift * torch.mean(real_scores**2))
 
         # calculate the WGAN-GP (gradient penalty)
-        gp = self._gradient_penalty(real_images, fake_images, level, alpha, real_images.device)
+        gp = self._gradient_penalty(merged, merged_scores)
         loss += gp
 
         return loss
@@ -79,31 +107,23 @@ class WGAN_GP(GANLoss):
         fake_scores = self.D(fake_images, level, alpha)
         return -torch.mean(fake_scores)
 
-    def _gradient_penalty(self, real_images, fake_images, level, alpha, device):
-        """Calculates the gradient penalty loss for WGAN GP."""
+    def _interpolate(self, real_images, fake_images):
+        """Random interpolation between real and fake samples, on which the gradient penalty is computed."""
         batch_size = real_images.shape[0]
 
         # generate random epsilon
-        epsilon = torch.rand((batch_size, 1, 1, 1)).to(device)
+        epsilon = torch.rand((batch_size, 1, 1, 1)).to(real_images.device)
 
         # create the merge of both real and fake samples
-        merged = epsilon * real_images + ((1 - epsilon) * fake_images)
-        merged.requires_grad_(True)
+        merged = epsilon * real_images.detach() + ((1 - epsilon) * fake_images.detach())
+        return merged.requires_grad_(True)
 
-        # forward pass
-        op = self.D(merged, level, alpha)
-
-        # perform backward pass from op to merged for obtaining the gradients
-        gradient = torch.autograd.grad(
-            outputs=op,
-            inputs=merged,
-            grad_outputs=torch.ones_like(op),
-            create_graph=True,
-            retain_graph=True,
-            only_inputs=True,
-        )[0]
+    def _gradient_penalty(self, merged, merged_scores):
+        """Calculates the gradient penalty loss for WGAN GP."""
+        # perform backward pass from the scores to merged for obtaining the gradients
+        gradient = self.amp.grad(merged_scores.sum(), merged)
 
-        gradient = gradient.view(gradient.shape[0], -1)
+        gradient = gradient.float().view(gradient.shape[0], -1)
 
         return self.lambda_gp * ((gradient.norm(p=2, dim=1) - 1) ** 2).mean()
 
@@ -112,6 +132,9 @@ class R1Regularization(GANLoss):
     """
     R1 Regularization for the Discriminator.
 
+    With r1_interval > 1, the penalty is only computed every r1_interval discriminator steps
+    and scaled by r1_interval (lazy regularization, as in StyleGAN2).
+
     Parameters:
     ----------
     G : torch.nn.Module
@@ -120,23 +143,36 @@ class R1Regularization(GANLoss):
         Discriminator network.
     lambda_r1 : float
         Coefficient for the R1 regularization term.
+    r1_interval : int
+        Number of discriminator steps between two R1 penalties.
+    fused : bool
+        Whether to score the real and fake images in a single discriminator pass.
     """
 
-    def __init__(self, G, D, lambda_r1=10):
-        super().__init__(G, D)
+    def __init__(self, G, D, lambda_r1=10, r1_interval=1, fused=False):
+        super().__init__(G, D, fused)
         self.lambda_r1 = lambda_r1
+        self.r1_interval = r1_interval
+        self.num_d_steps = 0
 
     def d_loss(self, real_images, fake_images, level, alpha):
         """Discriminator loss with R1 regularization."""
-        real_scores = torch.mean(self.D(real_images, level, alpha))
-        fake_scores = torch.mean(self.D(fake_images, level, alpha))
+        apply_r1 = self.num_d_steps % self.r1_interval == 0
+        self.num_d_steps += 1
+
+        if apply_r1:
+            # Requires grad enables automatic differentiation for real_images, without modifying the caller's batch
+            real_images = real_images.detach().requires_grad_(True)
+
+        # The real scores are used by both the loss and the penalty
+        real_scores, fake_scores = self._scores(level, alpha, real_images, fake_images)
 
         # Standard GAN loss
-        loss = fake_scores - real_scores
+        loss = torch.mean(fake_scores) - torch.mean(real_scores)
 
         # R1 regularization
-        r1_penalty = self._r1_penalty(real_images, level, alpha)
-        loss += r1_penalty
+        if apply_r1:
+            loss += self.r1_interval * self._r1_penalty(real_images, real_scores)
         return loss
 
     def g_loss(self, _, fake_images, level, alpha):
@@ -144,21 +180,13 @@ class R1Regularization(GANLoss):
         fake_scores = torch.mean(self.D(fake_images, level, alpha))
         return -fake_scores
 
-    def _r1_penalty(self, real_images, level, alpha):
+    def _r1_penalty(self, real_images, real_scores):
         """Calculates the R1 regularization term."""
-        # Requires grad enables automatic differentiation for real_images
-        real_images.requires_grad_(True)
-
-        # Forward pass
-        real_scores = self.D(real_images, level, alpha)
-
         # Calculate gradients
-        real_gradients = torch.autograd.grad(
-            outputs=real_scores.sum(), inputs=real_images, create_graph=True, retain_graph=True, only_inputs=True
-        )[0]
+        real_gradients = self.amp.grad(real_scores.sum(), real_images)
 
         # Compute the R1 penalty
-        r1_penalty = self.lambda_r1 * real_gradients.pow(2).view(real_gradients.shape[0], -1).sum(1).mean()
+        r1_penalty = self.lambda_r1 * real_gradients.float().pow(2).view(real_gradients.shape[0], -1).sum(1).mean()
 
         return r1_penalty
 
@@ -166,18 +194,18 @@ class R1Regularization(GANLoss):
 class BasicGANLoss(GANLoss):
     """Basic GAN Loss using Binary Cross-Entropy (BCE) loss."""
 
-    def __init__(self, G, D):
-        super().__init__(G, D)
+    def __init__(self, G, D, fused=False):
+        super().__init__(G, D, fused)
         self.loss_fn = nn.BCEWithLogitsLoss()
 
     def d_loss(self, real_images, fake_images, level, alpha):
         """Discriminator loss."""
+        real_scores, fake_scores = self._scores(level, alpha, real_images, fake_images)
+
         # Real images should be classified as real (label=1)
-        real_scores = self.D(real_images, level, alpha)
         real_loss = self.loss_fn(real_scores, torch.ones_like(real_scores))
 
         # Fake images should be classified as fake (label=0)
-        fake_scores = self.D(fake_images, level, alpha)
         fake_loss = self.loss_fn(fake_scores, torch.zeros_like(fake_scores))
 
         # Total discriminator loss
@@ -1,4 +1,6 @@
 import os
+import copy
+import time
 import torch
 import torch.optim as optim
 import numpy as np
@@ -7,14 +9,13 @@ from tqdm import tqdm
 from joblib import dump, load
 from torchvision.utils import save_image
 from torchvision.transforms import Resize
-from pytorch_gan_metrics import get_fid
-from pytorch_gan_metrics.utils import calc_and_save_stats
-from sklearn.decomposition import PCA
 from plotly.subplots import make_subplots
 
-from faceai_bgimpact.data_processing.paths import data_folder
-from faceai_bgimpact.models.data_loader import get_dataloader, denormalize_image
+from faceai_bgimpact.models.data_loader import get_dataloader, denormalize_image, fade_in
 from faceai_bgimpact.models.abstract_model import AbstractModel
+from faceai_bgimpact.models.metrics import fid_stats_path, metric_names
+from faceai_bgimpact.models.utils import MixedPrecision
+from faceai_bgimpact.models.pca import PCABasis, PCACache, StreamingPCA
 from faceai_bgimpact.models.stylegan_.generator import Generator
 from faceai_bgimpact.models.stylegan_.discriminator import Discriminator
 from faceai_bgimpact.models.stylegan_.loss import (
@@ -54,10 +55,16 @@ class StyleGAN(AbstractModel):
 
         self.optimizer_G_config = {}
         self.optimizer_D_config = {}
+        self.amp = MixedPrecision()
+        self.reuse_fakes = False
+        self.d_steps = 1
+        self.generator_ema = None
+        self.ema_beta = 0.999
 
         self.latent_vector = torch.randn(64, self.latent_dim)
         self.pca = None
-        self.fids = {"level": [], "epoch": [], "fid": []}
+        self.pca_basis = None
+        self.fids = {"level": [], "epoch": [], **{name: [] for name in metric_names}}
 
     def sigmoid_lr_scheduler(self, epoch, config, k=10):
         """
@@ -105,6 +112,23 @@ class StyleGAN(AbstractModel):
         self.optimizer_G.param_groups[1]["lr"] = base_glr * lambda_
         self.optimizer_D.param_groups[0]["lr"] = base_dlr * lambda_
 
+    def init_ema(self):
+        """Create the exponential moving average (EMA) of the generator, starting from its current weights."""
+        self.generator_ema = copy.deepcopy(self.generator).freeze_for_inference()
+        # The buffers of the generator are constant, only the parameters are averaged
+        self._ema_params = list(self.generator_ema.parameters())
+        self._params = list(self.generator.parameters())
+
+    @torch.no_grad()
+    def update_ema(self):
+        """Move the EMA generator towards the current generator, with one fused update of all the parameters."""
+        torch._foreach_lerp_(self._ema_params, self._params, 1 - self.ema_beta)
+
+    @property
+    def sampling_generator(self):
+        """Generator used for evaluation and samples: the EMA generator when there is one."""
+        return self.generator if self.generator_ema is None else self.generator_ema
+
     def train_init(self, glr, mlr, dlr, loss):
         """
         Initialize the training process.
@@ -142,16 +166,56 @@ class StyleGAN(AbstractModel):
         self.lambda_ = 1.0
         self.last_fid = 1000.0
 
-        self.loss = {
+        self.init_loss(loss)
+
+    def init_loss(self, loss, r1_interval=1, fused_d=False):
+        """
+        Create the loss function.
+
+        Parameters
+        ----------
+        loss : str
+            Loss function to use for training.
+        r1_interval : int
+            Number of discriminator steps between two R1 penalties (only used by the "r1" loss).
+        fused_d : bool
+            Whether to score the real and fake images in a single discriminator pass.
+        """
+        loss_class = {
             "wgan": WGAN,
             "wgan-gp": WGAN_GP,
             "basic": BasicGANLoss,
             "r1": R1Regularization,
-        }.get(
-            loss.lower().replace("-", "_"), WGAN_GP
-        )(self.generator, self.discriminator)
-
-    def train(self, glr, mlr, dlr, device, save_interval, image_interval, level_epochs, loss):
+        }.get(loss.lower().replace("-", "_"), WGAN_GP)
+        loss_kwargs = {"r1_interval": r1_interval} if loss_class is R1Regularization else {}
+        # The lazy R1 schedule continues from the previous loss, e.g. the one restored from a checkpoint
+        num_d_steps = getattr(getattr(self, "loss", None), "num_d_steps", 0)
+        self.loss = loss_class(self.generator, self.discriminator, fused=fused_d, **loss_kwargs)
+        if loss_class is R1Regularization:
+            self.loss.num_d_steps = num_d_steps
+
+    def train(
+        self,
+        glr,
+        mlr,
+        dlr,
+        device,
+        save_interval,
+        image_interval,
+        level_epochs,
+        loss,
+        cache_dataset=False,
+        storage="folder",
+        precision="fp32",
+        r1_interval=1,
+        fused_d=False,
+        reuse_fakes=False,
+        d_steps=1,
+        ema_beta=0.999,
+        async_fid=False,
+        eval_images=1000,
+        keep_checkpoints=None,
+    ):
         """
         Main training loop for StyleGAN.
 
@@ -170,7 +234,35 @@ class StyleGAN(AbstractModel):
         loss : str
             Loss function to use for training.
             ["wgan-gp", "wgan", "basic"]
+        cache_dataset : bool
+            Whether to decode the dataset once and keep it in memory at all resolutions.
+        storage : str
+            How the dataset is stored on disk ("folder", "memmap" or "shards").
+        precision : str
+            Training precision: "fp32", or mixed precision with "fp16" or "bf16".
+        r1_interval : int
+            Number of discriminator steps between two R1 penalties (lazy regularization).
+        fused_d : bool
+            Whether to score the real and fake images in a single discriminator pass.
+        reuse_fakes : bool
+            Whether the generator step reuses the fake images of the discriminator step,
+            instead of running the generator a second time.
+        d_steps : int
+            Number of discriminator steps per generator step.
+        ema_beta : float
+            Decay of the exponential moving average of the generator, updated after every generator step.
+        async_fid : bool
+            Whether to compute the FID of each epoch in the background, on a snapshot of the generator,
+            while the next epoch trains. The scores are recorded when they are ready.
+        eval_images : int
+            Number of generated images of each evaluation (FID, KID, precision and recall).
+            The FID is skipped below 2048, the dimension of the Inception features.
+        keep_checkpoints : int
+            Number of latest checkpoints to keep, besides the best FID and the latest of each level.
+            If None, all the checkpoints are kept.
         """
+        self.keep_checkpoints = keep_checkpoints
+
         # Check if loading from a checkpoint
         if hasattr(self, "current_epochs"):
             # Check if checkpoint was the last epoch of the level
@@ -191,25 +283,42 @@ class StyleGAN(AbstractModel):
             self.current_epochs = {level: 0 for level in level_epochs.keys()}
             self.train_init(glr=glr, mlr=mlr, dlr=dlr, loss=loss)
 
+        # Recreated with the training options, also when resuming from a checkpoint
+        self.init_loss(loss, r1_interval=r1_interval, fused_d=fused_d)
+
+        # Shared by the training steps and the gradient penalties of the loss
+        self.amp = MixedPrecision(precision, device)
+        self.loss.amp = self.amp
+        self.reuse_fakes = reuse_fakes
+        self.d_steps = d_steps
+        self.ema_beta = ema_beta
+        if self.generator_ema is None:
+            self.init_ema()
+
+        # The loader and its workers are created once, and follow the resolution of each level
+        self.dataset, self.loader = get_dataloader(
+            self.dataset_name,
+            level_epochs[start_level]["batch_size"],
+            shuffle=True,
+            resolution=4 * (2**start_level),
+            cache=cache_dataset,
+            storage=storage,
+            device=device,
+        )
+
+        # Computing FID stats for all the levels
+        self.make_fid_stats(device)
+
         for level in range(start_level, max(level_epochs.keys()) + 1):
             self.level = level
             self.resolution = 4 * (2**level)
             self.batch_size = level_epochs[level]["batch_size"]
-            self.dataset, self.loader = get_dataloader(
-                self.dataset_name,
-                self.batch_size,
-                shuffle=True,
-                resolution=self.resolution,
-                alpha=self.alpha,
-            )
+            self.loader.update_resolution(self.resolution, self.batch_size)
 
             # Calculate total epochs for this level from configuration
             total_level_epochs = level_epochs[level]["transition"] + level_epochs[level]["stabilization"]
             start_epoch_for_level = start_epoch if level == start_level else 0
 
-            # Computing FID stats for current level
-            self.make_fid_stats(device)
-
             # Epoch loop for current level
             for epoch in range(start_epoch_for_level, total_level_epochs):
                 self.current_epochs[level] = epoch
@@ -220,86 +329,108 @@ class StyleGAN(AbstractModel):
                 self.update_lr(glr, mlr, dlr, self.lambda_)
 
                 self._train_one_epoch(level_epochs[level], epoch, image_interval, device)
-
-                # Calculate FID score of epoch
-                self.calculate_fid(2048 + self.batch_size, self.batch_size, device)
-
-                # Save checkpoint
-                if (self.epoch_total + 1) % save_interval == 0:
-                    self.current_epochs[level] = epoch + 1
-                    self.save_checkpoint(self.epoch_total + 1, self.current_epochs)
-
-                # Update FID graph
-                self.graph_fid()
+                self._end_epoch(level, epoch, save_interval, eval_images, device, async_fid)
 
             # Update for next level
             if level < max(level_epochs.keys()):
                 self.alpha = 0.0  # Reset alpha for the next level
 
-    def make_fid_stats(self, device, save_dir="outputs/StyleGAN_fid_stats"):
+        # Wait for the last background FID evaluation and checkpoint
+        if self.collect_fids(wait=True):
+            self.graph_fid()
+        self.checkpoint_writer().wait()
+
+    def _end_epoch(self, level, epoch, save_interval, eval_images, device, async_fid):
+        """Save the checkpoint of an epoch if it is due, then evaluate the model and update the FID graph."""
+        # Save checkpoint, before the score of its model is recorded in the index
+        if (self.epoch_total + 1) % save_interval == 0:
+            self.current_epochs[level] = epoch + 1
+            self.save_checkpoint(self.epoch_total + 1, self.current_epochs, asynchronous=True)
+
+        # Calculate FID score of epoch
+        self.calculate_fid(eval_images, self.batch_size, device, asynchronous=async_fid)
+
+        # Update FID graph
+        self.collect_fids()
+        if self.fids["fid"]:
+            self.graph_fid()
+
+    def calculate_fid(self, num_images, batch_size, device, asynchronous=False):
         """
-        Calculate and save FID stats for the dataset.
+        Calculate the FID score and the other metrics of the same features, and record them in self.fids.
 
         Parameters
         ----------
+        num_images : int
+            Number of generated images.
+        batch_size : int
+            Number of images generated at once.
         device : torch.device
             Device to use for calculation.
-        save_dir : str
-            Directory to save the stats to.
+        asynchronous : bool
+            Whether to evaluate a snapshot of the generator in the background, and return immediately.
+            The score is recorded by a later call to calculate_fid or collect_fids.
         """
-        # If device is CPU, ignore and skip
         if str(device) == "cpu":
             return
-
-        dataset_folder = f"{data_folder}/{self.dataset_name}"
-        save_file = self.get_save_dir(save_dir) + f"{self.resolution}.npz"
-
-        # If the stats file already exists, skip
-        if os.path.exists(save_file):
+        if asynchronous:
+            generator = copy.deepcopy(self.sampling_generator).freeze_for_inference()
+        else:
+            generator = self.sampling_generator
+            generator.eval()
+        level, alpha, resolution = self.level, self.alpha, self.resolution
+
+        def batches():
+            for start in range(0, num_images, batch_size):
+                z = torch.randn(min(batch_size, num_images - start), self.latent_dim, device=device)
+                yield denormalize_image(generator(z, level, alpha))
+
+        # The generated batches go straight through the Inception network, without being kept
+        stats_path = fid_stats_path(self.dataset_name)
+        if asynchronous:
+            evaluator = self.async_fid_evaluator(device)
+            self._record_fids(
+                evaluator.submit(batches, stats_path, tag=(level, self.epoch_total), resolution=resolution)
+            )
             return
 
-        print("Generating FID stats for resolution", self.resolution, "...")
-        calc_and_save_stats(
-            dataset_folder,
-            save_file,
-            batch_size=10,
-            img_size=self.resolution,
-            use_torch=True,
-            num_workers=os.cpu_count() - 1,
-        )
+        with torch.no_grad():
+            metrics = self.fid_evaluator(device).evaluate_metrics(batches(), stats_path, resolution)
+        self.generator.train()
+        self._record_fids([((level, self.epoch_total), metrics)])
 
-    def calculate_fid(self, num_images, batch_size, device, stats_dir="outputs/StyleGAN_fid_stats"):
+    def collect_fids(self, wait=False):
         """
-        Calculate the FID score.
+        Record the score of the background FID evaluation, if it is finished.
 
         Parameters
         ----------
-        device : torch.device
-            Device to use for calculation.
+        wait : bool
+            Whether to wait for the evaluation in flight.
 
         Returns
         -------
-        fid_score : float
-            Computed FID score.
+        bool
+            Whether a score was recorded.
         """
-        if str(device) == "cpu":
-            return
-        self.generator.eval()
-        images = []
-        with torch.no_grad():
-            for _ in range(num_images // batch_size):
-                z = torch.randn(batch_size, self.latent_dim).to(device)
-                images.append(denormalize_image(self.generator(z, self.level, self.alpha).detach()).cpu())
-
-        self.generator.train()
-        imgs = torch.cat(images, dim=0)
-
-        stats_file = self.get_save_dir(stats_dir) + f"{self.resolution}.npz"
-        fid = get_fid(imgs, stats_file)
-        self.fids["level"].append(self.level)
-        self.fids["epoch"].append(self.epoch_total)
-        self.fids["fid"].append(fid)
-        self.last_fid = fid
+        evaluator = getattr(self, "_async_fid_evaluator", None)
+        if evaluator is None:
+            return False
+        results = evaluator.wait() if wait else evaluator.poll()
+        self._record_fids(results)
+        return len(results) > 0
+
+    def _record_fids(self, results):
+        """Record ((level, epoch), metrics) results."""
+        for (level, epoch), metrics in results:
+            self.fids["level"].append(level)
+            self.fids["epoch"].append(epoch)
+            for name in metric_names:
+                self.fids.setdefault(name, []).append(metrics.get(name))
+            if metrics.get("fid") is not None:
+                self.last_fid = metrics["fid"]
+            # The model scored after epoch is the one of the checkpoint saved with epoch_total = epoch + 1
+            self.record_checkpoint_fid(epoch + 1, metrics.get("fid"))
 
     def _train_one_epoch(self, level_config, epoch, image_interval, device):
         """Training loop for one epoch."""
@@ -309,7 +440,7 @@ class StyleGAN(AbstractModel):
         # Calculate alpha step if in transition phase
         alpha_step = 1.0 / (len(self.loader) * level_config["transition"]) if is_transition_phase else 0
 
-        def tqdm_description(self, epoch, total_epochs, g_loss=0, d_loss=0):
+        def tqdm_description(self, epoch, total_epochs, g_loss=0, d_loss=0, images_per_second=0):
             return (
                 f"Lvl {' ' * (3 - len(str(self.resolution))) * 2}{self.level} ({self.resolution}x{self.resolution}) "
                 + f"Epoch {epoch+1}/{total_epochs} ({self.epoch_total}) "
@@ -317,6 +448,7 @@ class StyleGAN(AbstractModel):
                 + f"GL={g_loss*100:.1f} DL={d_loss*100:.1f} "
                 + f"λ={self.lambda_:.3f} "
                 + f"FID={self.last_fid:.3f} "
+                + f"{images_per_second:.0f} img/s "
             )
 
         total_epochs = level_config["transition"] + level_config["stabilization"]
@@ -326,26 +458,32 @@ class StyleGAN(AbstractModel):
             desc=tqdm_description(self, epoch, total_epochs),
         )
 
+        start_time = time.perf_counter()
+        num_images = 0
+        g_loss = 0
         for i, imgs in epoch_iter:
             # Update alpha
             self.alpha = min(self.alpha + alpha_step, 1.0)
 
-            # Update dataset alpha
-            self.dataset.update_alpha(self.alpha)
+            # Blend the real images (already prefetched to the device) with their low-resolution version
+            imgs = fade_in(imgs, self.alpha)
 
-            # Train on batch
-            imgs = imgs.to(device)
-            g_loss, d_loss = self.perform_train_step(imgs, device, self.level, self.alpha)
+            # Train on batch, the generator only once every d_steps batches
+            train_generator = (i + 1) % self.d_steps == 0
+            step_g_loss, d_loss = self.perform_train_step(imgs, device, self.level, self.alpha, train_generator)
+            g_loss = g_loss if step_g_loss is None else step_g_loss
 
             # Update tqdm description
-            epoch_iter.desc = tqdm_description(self, epoch, total_epochs, g_loss, d_loss)
+            num_images += imgs.size(0)
+            images_per_second = num_images / (time.perf_counter() - start_time)
+            epoch_iter.desc = tqdm_description(self, epoch, total_epochs, g_loss, d_loss, images_per_second)
 
             if i % image_interval == 0:
                 epoch_total = sum(self.current_epochs.values())
                 iter_ = (epoch_total * len(self.loader)) + i
                 self.generate_images(iter_, epoch, device, latent_vector=self.latent_vector)
 
-    def perform_train_step(self, real_imgs, device, current_level, alpha):
+    def perform_train_step(self, real_imgs, device, current_level, alpha, train_generator=True):
         """
         Perform a single training step, including forward and backward passes for G and D.
 
@@ -359,12 +497,14 @@ class StyleGAN(AbstractModel):
             Current resolution level of the model.
         alpha : float
             Blending factor for the progressive growing.
+        train_generator : bool
+            Whether to also train the generator, after the discriminator.
 
         Returns
         -------
-        g_loss : torch.Tensor
-            Generator loss for the step.
-        d_loss : torch.Tensor
+        g_loss : float
+            Generator loss for the step, or None if the generator was not trained.
+        d_loss : float
             Discriminator loss for the step.
         """
         # On the last batch of the epoch, the number of images may be less than the batch size
@@ -374,19 +514,34 @@ class StyleGAN(AbstractModel):
         self.optimizer_D.zero_grad()
         self.optimizer_G.zero_grad()
 
-        # Train discriminator
+        # Generate the fake images. When they are reused for the generator step, their graph is kept
+        # (holding on to the generator activations during the discriminator step) to skip a second generator pass
+        reuse_fakes = self.reuse_fakes and train_generator
         z = torch.randn(current_batch_size, self.latent_dim, device=device)
-        detached_fake_imgs = self.generator(z, current_level, alpha).detach()
-        d_loss = self.loss.d_loss(real_imgs, detached_fake_imgs, current_level, alpha)
-        d_loss.backward()
-        self.optimizer_D.step()
+        with self.amp.autocast(), torch.set_grad_enabled(reuse_fakes):
+            fake_imgs = self.generator(z, current_level, alpha)
+
+        # Train discriminator
+        with self.amp.autocast():
+            d_loss = self.loss.d_loss(real_imgs, fake_imgs.detach(), current_level, alpha)
+        self.amp.backward(d_loss)
+        self.amp.step(self.optimizer_D)
+
+        if not train_generator:
+            self.amp.update()
+            return None, d_loss.item()
 
         # Train generator
-        z = torch.randn(current_batch_size, self.latent_dim, device=device)
-        fake_imgs = self.generator(z, current_level, alpha)
-        g_loss = self.loss.g_loss(None, fake_imgs, current_level, alpha)
-        g_loss.backward()
-        self.optimizer_G.step()
+        with self.amp.autocast():
+            if not reuse_fakes:
+                z = torch.randn(current_batch_size, self.latent_dim, device=device)
+                fake_imgs = self.generator(z, current_level, alpha)
+            g_loss = self.loss.g_loss(None, fake_imgs, current_level, alpha)
+        self.amp.backward(g_loss)
+        self.amp.step(self.optimizer_G)
+        self.amp.update()
+        if self.generator_ema is not None:
+            self.update_ema()
 
         # Compute distances
         # self.real_distance = pairwise_euclidean_distance(real_imgs)
@@ -423,7 +578,7 @@ class StyleGAN(AbstractModel):
 
         return int(completed_fraction)
 
-    def save_checkpoint(self, epoch_total, current_epochs, save_dir="outputs/StyleGAN_checkpoints"):
+    def save_checkpoint(self, epoch_total, current_epochs, save_dir="outputs/StyleGAN_checkpoints", asynchronous=False):
         """
         Save a checkpoint of the current state, including models, optimizers, and training parameters.
 
@@ -437,6 +592,8 @@ class StyleGAN(AbstractModel):
             Device to use for training.
         save_dir : str
             Directory to save the checkpoint to.
+        asynchronous : bool
+            Whether to write the checkpoint in the background, and return as soon as it is copied.
         """
         save_folder = self.get_save_dir(save_dir)
         os.makedirs(save_folder, exist_ok=True)
@@ -457,8 +614,17 @@ class StyleGAN(AbstractModel):
             "fids": self.fids,
             "latent_vector": self.latent_vector,
             "lambda_": self.lambda_,
+            "num_d_steps": getattr(self.loss, "num_d_steps", 0),
         }
-        torch.save(checkpoint, checkpoint_path)
+        if self.generator_ema is not None:
+            checkpoint["generator_ema_state_dict"] = self.generator_ema.state_dict()
+        # The FID of the saved model is recorded in the index when its score arrives (see _record_fids)
+        # The FID is not computed on CPU (see calculate_fid)
+        pending = next(self.generator.parameters()).is_cuda
+        entry = dict(epoch=epoch_total, level=self.level, alpha=self.alpha, pending=pending)
+        self.checkpoint_writer().save(
+            checkpoint, checkpoint_path, asynchronous, index=self.checkpoint_index(save_folder), entry=entry
+        )
 
     @classmethod
     def from_checkpoint(
@@ -470,6 +636,7 @@ class StyleGAN(AbstractModel):
         latent_dim=None,
         w_dim=None,
         style_layers=None,
+        use_ema=False,
     ):
         """
         Create a StyleGAN instance from a checkpoint.
@@ -491,6 +658,9 @@ class StyleGAN(AbstractModel):
             Dimension of the W space.
         style_layers : int
             Number of layers in the style mapping network.
+        use_ema : bool
+            Whether to load the EMA weights into the generator, for inference.
+            Otherwise, the EMA generator is restored next to the generator, to resume training.
         """
         checkpoint = torch.load(checkpoint_path, map_location=device)
 
@@ -503,10 +673,13 @@ class StyleGAN(AbstractModel):
         latent_dim = checkpoint.get("latent_dim", latent_dim)
         style_layers = checkpoint.get("style_layers", style_layers)
         fids = checkpoint.get("fids", {"level": [], "epoch": [], "fid": []})
+        # Checkpoints from before the KID and precision and recall only have FIDs
+        for name in metric_names:
+            fids.setdefault(name, [None] * len(fids["level"]))
         latent_vector = checkpoint.get("latent_vector", torch.randn(64, latent_dim))
         lambda_ = checkpoint.get("lambda_", 1.0)
 
-        last_fid = fids["fid"][-1] if len(fids["fid"]) > 0 else 1000.0
+        last_fid = next((fid for fid in reversed(fids["fid"]) if fid is not None), 1000.0)
 
         # Create a new StyleGAN instance
         instance = cls(dataset_name, latent_dim, w_dim, style_layers, device)
@@ -519,6 +692,12 @@ class StyleGAN(AbstractModel):
         instance.discriminator.load_state_dict(checkpoint["discriminator_state_dict"])
         instance.optimizer_G.load_state_dict(checkpoint["optimizer_G_state_dict"])
         instance.optimizer_D.load_state_dict(checkpoint["optimizer_D_state_dict"])
+        if "generator_ema_state_dict" in checkpoint:
+            if use_ema:
+                instance.generator.load_state_dict(checkpoint["generator_ema_state_dict"])
+            else:
+                instance.init_ema()
+                instance.generator_ema.load_state_dict(checkpoint["generator_ema_state_dict"])
 
         # Set current step, level, epoch tracking, fids and latent vector
         instance.level = level
@@ -530,6 +709,8 @@ class StyleGAN(AbstractModel):
         instance.latent_vector = latent_vector
         instance.lambda_ = lambda_
         instance.last_fid = last_fid
+        if isinstance(instance.loss, R1Regularization):
+            instance.loss.num_d_steps = checkpoint.get("num_d_steps", 0)
 
         return instance
 
@@ -568,7 +749,7 @@ class StyleGAN(AbstractModel):
             real_images = []
             for _ in range(min(len(self.dataset), 64)):
                 real_images.append(self.dataset[_])
-            real_images = torch.stack(real_images).to(device)
+            real_images = fade_in(torch.stack(real_images).to(device), self.alpha)
 
             # Resize if necessary
             if real_images.size(-1) != 128:
@@ -585,7 +766,7 @@ class StyleGAN(AbstractModel):
             )
 
             # Generate images
-            fake_images = self.generator(z, self.level, self.alpha).detach().cpu()
+            fake_images = self.sampling_generator(z, self.level, self.alpha).detach().cpu()
 
             # Check if upscaling is needed
             current_size = fake_images.size(-1)
@@ -605,10 +786,13 @@ class StyleGAN(AbstractModel):
     def fit_pca(
         self,
         num_samples=10000,
-        batch_size=100,
+        batch_size=10000,
         n_components=50,
         save_file="models/StyleGAN_PCA",
         use_saved=True,
+        device=None,
+        seed=0,
+        cache_dir="models/pca_cache",
         **kwargs,
     ):
         """
@@ -622,40 +806,52 @@ class StyleGAN(AbstractModel):
             Batch size for processing.
         n_components : int
             Number of components for PCA.
-        save : bool
-            Whether to save the PCA model.
+        save_file : str
+            File the fitted PCA model is exported to (see load_pca).
         use_saved : bool
-            Whether to use a saved PCA model.
+            Whether to use a cached PCA model, fitted with the same mapping network weights and parameters.
+        device : torch.device
+            Device on which the W vectors are generated and the PCA is fitted. Defaults to the generator device.
+        seed : int
+            Seed of the latent vectors the PCA is fitted on.
+        cache_dir : str
+            Folder of the PCA cache.
         """
+        generator_device = next(self.generator.parameters()).device
+        device = generator_device if device is None else device
+
+        # The latent vectors drawn from the seed depend on the device and on how they are split in batches
+        cache = PCACache(cache_dir)
+        cache_key = cache.key(
+            self.generator.mapping,
+            model="StyleGAN",
+            num_samples=num_samples,
+            batch_size=batch_size,
+            n_components=n_components,
+            seed=seed,
+            device=torch.device(device).type,
+        )
         if use_saved:
-            try:
-                self.load_pca(save_file)
-                # Check if the loaded PCA has the correct number of components and samples
-                if self.pca.n_components_ == n_components and self.pca.n_samples_ == num_samples:
-                    print("Loaded PCA from saved file.")
-                    return
-                else:
-                    print("Saved PCA does not match the requested parameters. Fitting new PCA...")
-            except FileNotFoundError:
-                print("No saved PCA found. Fitting new PCA...")
-
-        self.generator.eval()
-        all_w = []
-        self.n_components = n_components
-
-        # Process in batches
-        for _ in tqdm(range(0, num_samples, batch_size), desc="Generating W vectors"):
-            z = torch.randn(batch_size, self.latent_dim, device="cpu")
+            pca = cache.load(cache_key)
+            if pca is not None:
+                print("Loaded PCA from cache.")
+                self._set_pca(pca)
+                return
+            print("No cached PCA for these weights and parameters. Fitting new PCA...")
+
+        mapping = self.generator.mapping.to(device).eval()
+        rng = torch.Generator(device=device).manual_seed(seed)
+
+        # Fit the PCA on the W vectors as they are generated, without keeping them
+        fitter = StreamingPCA(n_components, device=device)
+        for start in tqdm(range(0, num_samples, batch_size), desc="Generating W vectors"):
+            z = torch.randn(min(batch_size, num_samples - start), self.latent_dim, device=device, generator=rng)
             with torch.no_grad():
-                w = self.generator.mapping(z).cpu()  # Get W vectors
-            all_w.append(w)
+                fitter.partial_fit(mapping(z))
+        self.generator.mapping.to(generator_device)
 
-        all_w = torch.cat(all_w, dim=0)[:num_samples]  # Ensure exact number of samples
-        all_w_flat = all_w.view(num_samples, -1)  # Flatten for PCA
-
-        # Fit PCA
-        self.pca = PCA(n_components=n_components)
-        self.pca.fit(all_w_flat.numpy())
+        self._set_pca(fitter.to_sklearn())
+        cache.save(cache_key, self.pca)
 
         # Save PCA model as parquet file
         full_save_file = self.get_save_dir(save_file) + ".joblib"
@@ -671,8 +867,13 @@ class StyleGAN(AbstractModel):
             File to load the PCA model from.
         """
         full_save_file = self.get_save_dir(save_file) + ".joblib"
-        self.pca = load(full_save_file)
-        self.n_components = self.pca.n_components_
+        self._set_pca(load(full_save_file))
+
+    def _set_pca(self, pca):
+        """Use a fitted sklearn PCA, and its basis on the generator device."""
+        self.pca = pca
+        self.n_components = pca.n_components_
+        self.pca_basis = PCABasis.from_sklearn(pca).to(next(self.generator.parameters()).device)
 
     def manipulate_w(self, adjustment_factors, w_vectors):
         """
@@ -695,17 +896,14 @@ class StyleGAN(AbstractModel):
         if len(adjustment_factors) > self.pca.n_components_:
             raise ValueError("Length of adjustment_factors exceeds the number of PCA components.")
 
-        # Reshape and process the batch of W vectors
-        original_w_flat = w_vectors.view(w_vectors.size(0), -1).cpu().numpy()  # Flatten for PCA
-        w_pca = self.pca.transform(original_w_flat)
+        # Project the batch of W vectors on the PCA basis
+        w_pca = self.pca_basis.project(w_vectors)
 
         # Manipulate specified components for all vectors in the batch
-        for i, factor in enumerate(adjustment_factors):
-            w_pca[:, i] = factor
+        w_pca[:, : len(adjustment_factors)] = torch.as_tensor(adjustment_factors, dtype=w_pca.dtype)
 
         # Inverse PCA transformation and reshape back to original W vector shape
-        adjusted_w_flat = self.pca.inverse_transform(w_pca)
-        adjusted_w = torch.tensor(adjusted_w_flat, dtype=torch.float32).view_as(w_vectors).to(w_vectors.device)
+        adjusted_w = self.pca_basis.reconstruct(w_pca).view_as(w_vectors).to(w_vectors.device)
 
         return adjusted_w
 
@@ -716,34 +914,55 @@ class StyleGAN(AbstractModel):
         Parameters:
         ----------
         base_w (tensor): Base latent vector.
+        x1 (tensor): Unused, kept for API compatibility: the eigenvector offsets do not depend on the PCA
+            coordinates of base_w.
         x_list (list of floats): List of strengths for each eigenvector.
         layers_list (list of list of ints): List of layer indices for each eigenvector.
-        num_layers (int): Total number of layers in the generator.
         apply_noise (bool): Whether to add noise to the input tensor.
 
         Returns:
         -------
-        list of tensors: A list of blended latent vectors, one for each layer.
+        tensor: The blended image, with a batch size of 1.
         """
-        # Initialize a list of w vectors, one for each layer, starting with the base_w
-        blended_w = [base_w.clone() for _ in range(2 * (self.level + 1))]
+        return self.blend_styles_batch(base_w, [x_list], layers_list, apply_noise)
 
-        # Apply each eigenvector strength to its corresponding layers
-        for i, x_strength in enumerate(x_list):
-            if x_strength == 0 and len(layers_list[i]) == 5:
-                continue
-            # Create a zero tensor and set the ith element to the eigenvector strength
-            x_tensor = x1.clone()
-            x_tensor[i] += x_strength
+    @torch.no_grad()
+    def blend_styles_batch(self, base_w, x_batch, layers_list, apply_noise):
+        """
+        Render many slider configurations at once, blending eigenvector offsets on the base latent vector.
 
-            # Transform the control vector using the PCA transformation
-            w_offset = torch.tensor(self.pca.inverse_transform(x_tensor.unsqueeze(0)).squeeze(0))
+        The W offsets of all the configurations and layers are computed with one product against the PCA basis,
+        and all the images are rendered in a single synthesis batch.
 
-            # Apply this transformed control vector to the specified layers
-            for layer in layers_list[i]:
-                blended_w[layer] += w_offset - base_w
+        Parameters:
+        ----------
+        base_w (tensor): Base latent vector, of shape (w_dim,).
+        x_batch (tensor or list of list of floats): Strengths for each eigenvector, one row per configuration.
+            Shape: (n_configurations, n_eigenvectors)
+        layers_list (list of list of ints): List of layer indices for each eigenvector, shared by all configurations.
+        apply_noise (bool): Whether to add noise to the input tensor.
 
-        return self.generator.synthesis.predict_modified_layer(blended_w, self.level, apply_noise=apply_noise)
+        Returns:
+        -------
+        tensor: The blended images, one per configuration.
+        """
+        if self.pca_basis is None:
+            raise ValueError("PCA not fitted. Call fit_pca first.")
+        device = next(self.generator.parameters()).device
+        components = self.pca_basis.to(device).directions()
+        x_batch = torch.as_tensor(x_batch, dtype=torch.float32, device=device).reshape(-1, len(layers_list))
+        n_layers = 2 * (self.level + 1)
+
+        # layer_mask[i, l] is 1 when eigenvector i is applied to layer l
+        layer_mask = torch.zeros(len(layers_list), n_layers, device=device)
+        for i, layers in enumerate(layers_list):
+            layer_mask[i, layers] = 1
+
+        # (n_layers, n_configurations, w_dim)
+        offsets = torch.einsum("ci,il,iw->lcw", x_batch, layer_mask, components[: len(layers_list)])
+        ws = base_w.to(device, torch.float32).flatten() + offsets
+
+        return self.generator.synthesis.predict_modified_layer(list(ws), self.level, apply_noise=apply_noise)
 
     def graph_fid(self, save_dir="outputs/StyleGAN_fid_plots"):
         """
@@ -814,12 +1033,7 @@ class StyleGAN(AbstractModel):
         torch.Tensor
             Generated image.
         """
-        # Create a zero tensor and set the ith element to the eigenvector strength
-        x_tensor = torch.zeros(self.n_components)
-        for i, eig in enumerate(eigenvalues):
-            x_tensor[i] = eig
-
-        # Transform the control vector using the PCA transformation
-        w = torch.tensor(self.pca.inverse_transform(x_tensor.unsqueeze(0))).unsqueeze(2).unsqueeze(3)
+        # Transform the control vector using the PCA transformation, the missing eigenvalues being zero
+        w = self.pca_basis.reconstruct(torch.tensor([eigenvalues])).unsqueeze(2).unsqueeze(3)
         # Predict image
         return (self.generator.predict_from_style(w, self.level, self.alpha, apply_noise=apply_noise) + 1) / 2
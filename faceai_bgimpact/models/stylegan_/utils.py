@@ -7,7 +7,38 @@ import torch.nn.functional as F
 sqrt_2 = np.sqrt(2)
 
 
-class WSConv2d(nn.Module):
+class WeightScaledLayer(nn.Module):
+    """
+    Base class for layers whose weight is multiplied by a constant scale at runtime (equalized learning rate).
+
+    When the weight is frozen (inference, or snapshots and EMA copies with requires_grad=False), the scaled weight
+    is cached. The cache is invalidated whenever the weight is modified in place, replaced or moved.
+    Trainable weights are never cached, even under no_grad, so that no stale copy is kept on the device.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._cached_weight = None
+        self._cache_key = None
+
+    def scaled_weight(self):
+        """The weight multiplied by its scale."""
+        if self.weight.requires_grad:
+            if self._cached_weight is not None:
+                # The layer was unfrozen: release the cached copy
+                self._cached_weight = self._cache_key = None
+            return self.weight * self.scale
+
+        # The version counter changes on every in-place update (optimizer steps, load_state_dict, EMA updates)
+        key = (self.weight._version, self.weight.data_ptr(), self.scale._version, self.scale.data_ptr())
+        if key != self._cache_key:
+            with torch.no_grad():
+                self._cached_weight = self.weight * self.scale
+            self._cache_key = key
+        return self._cached_weight
+
+
+class WSConv2d(WeightScaledLayer):
     """Weight scaled convolutional layer."""
 
     def __init__(self, in_channels, out_channels, kernel_size, stride, padding, gain=sqrt_2):
@@ -24,11 +55,10 @@ class WSConv2d(nn.Module):
 
     def forward(self, x):
         """Forward pass."""
-        scaled_weight = self.weight * self.scale
-        return F.conv2d(x, scaled_weight, self.bias, self.stride, self.padding)
+        return F.conv2d(x, self.scaled_weight(), self.bias, self.stride, self.padding)
 
 
-class WSConvTranspose2d(nn.Module):
+class WSConvTranspose2d(WeightScaledLayer):
     """Weight scaled transposed convolutional layer."""
 
     def __init__(self, in_channels, out_channels, kernel_size, stride, padding, gain=sqrt_2):
@@ -45,8 +75,7 @@ class WSConvTranspose2d(nn.Module):
 
     def forward(self, x):
         """Forward pass."""
-        scaled_weight = self.weight * self.scale
-        return F.conv_transpose2d(x, scaled_weight, self.bias, self.stride, self.padding)
+        return F.conv_transpose2d(x, self.scaled_weight(), self.bias, self.stride, self.padding)
 
 
 class PixelNorm(nn.Module):
@@ -79,7 +108,12 @@ class BlurLayer(nn.Module):
 
 
 class AdaIN(nn.Module):
-    """Adaptive instance normalization."""
+    """
+    Adaptive instance normalization.
+
+    The style (scale and bias) is an affine function of w. It is computed outside of the module,
+    so that the styles of all the layers of a network can be computed at once (see SynthesisNetwork.compute_styles).
+    """
 
     def __init__(self, dim, w_dim):
         super().__init__()
@@ -88,14 +122,16 @@ class AdaIN(nn.Module):
         self.scale_transform = WSConv2d(w_dim, dim, 1, 1, 0, gain=1)
         self.bias_transform = WSConv2d(w_dim, dim, 1, 1, 0, gain=1)
 
-    def forward(self, x, w):
-        """Forward pass."""
-        x = F.instance_norm(x, eps=self.epsilon)
-
-        # scale
-        scale = self.scale_transform(w)
-        bias = self.bias_transform(w)
+    def style_weights(self):
+        """Scale and bias transforms as a single affine map: weight (2 * dim, w_dim) and bias (2 * dim)."""
+        weight = torch.cat([self.scale_transform.scaled_weight(), self.bias_transform.scaled_weight()])
+        bias = torch.cat([self.scale_transform.bias, self.bias_transform.bias])
+        return weight.flatten(1), bias
 
+    def forward(self, x, style):
+        """Forward pass, with style the (scale, bias) pair of shape (batch_size, dim, 1, 1) each."""
+        x = F.instance_norm(x, eps=self.epsilon)
+        scale, bias = style
         return scale * x + bias
 
 
@@ -55,3 +55,63 @@ def pairwise_euclidean_distance(batch):
         mean_dist = dist_matrix.mean()
 
         return mean_dist
+
+
+def _grad_scaler(enabled):
+    """Create a CUDA gradient scaler, with the API of the installed torch version."""
+    if hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler("cuda", enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+class MixedPrecision:
+    """
+    Autocast and gradient scaling for mixed-precision training.
+
+    With "fp32", every method falls back to the plain full-precision behavior.
+
+    Parameters:
+    ----------
+    precision : str
+        "fp32", "fp16" or "bf16".
+    device : torch.device
+        Device the models are trained on.
+    """
+
+    dtypes = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+    def __init__(self, precision="fp32", device="cpu"):
+        if precision not in self.dtypes:
+            raise ValueError(f"Unknown precision {precision}. Available: {list(self.dtypes)}")
+        self.precision = precision
+        self.device_type = torch.device(device).type
+        # float16 gradients underflow without loss scaling, bfloat16 has the range of float32 and does not need it
+        self.scaler = _grad_scaler(enabled=precision == "fp16" and self.device_type == "cuda")
+
+    def autocast(self):
+        """Context manager running the forward passes in the training precision."""
+        return torch.autocast(self.device_type, dtype=self.dtypes[self.precision], enabled=self.precision != "fp32")
+
+    def backward(self, loss):
+        """Backward pass of a (scaled) loss."""
+        self.scaler.scale(loss).backward()
+
+    def step(self, optimizer):
+        """Optimizer step on the unscaled gradients, skipped if they overflowed."""
+        self.scaler.step(optimizer)
+
+    def update(self):
+        """Update the loss scale. Call once per iteration, after all the optimizer steps."""
+        self.scaler.update()
+
+    def grad(self, output, inputs):
+        """
+        Gradient of a scalar output with respect to the inputs, keeping the graph for a gradient penalty.
+
+        The output is scaled before differentiating, so that float16 gradients do not underflow,
+        and the gradient is unscaled afterwards.
+        """
+        gradient = torch.autograd.grad(outputs=self.scaler.scale(output), inputs=inputs, create_graph=True)[0]
+        if self.scaler.is_enabled():
+            gradient = gradient / self.scaler.get_scale()
+        return gradient
@@ -1,19 +1,18 @@
 import os
+import copy
 import torch
 import torch.optim as optim
 import plotly.graph_objects as go
 
 from tqdm import tqdm
 from torchvision.utils import save_image
-from pytorch_gan_metrics import get_fid
-from pytorch_gan_metrics.utils import calc_and_save_stats
-from sklearn.decomposition import PCA
 from joblib import dump, load
 
-from faceai_bgimpact.data_processing.paths import data_folder
 from faceai_bgimpact.models.abstract_model import AbstractModel
+from faceai_bgimpact.models.metrics import fid_stats_path, format_metrics
 from faceai_bgimpact.models.data_loader import get_dataloader, denormalize_image
-from faceai_bgimpact.models.utils import weights_init
+from faceai_bgimpact.models.utils import weights_init, MixedPrecision
+from faceai_bgimpact.models.pca import PCABasis, PCACache, StreamingPCA
 
 from faceai_bgimpact.models.vae_.decoder import Decoder
 from faceai_bgimpact.models.vae_.encoder import Encoder
@@ -49,10 +48,12 @@ class VAE(AbstractModel):
 
         self.start_epoch = 0
         self.optimizer_config = {}
+        self.amp = MixedPrecision()
 
         # Add for PCA
         # self.latent_vector = torch.randn(64, self.latent_dim)
         self.pca = None
+        self.pca_basis = None
 
     def loss_function(self, recon_x, x, mu, logvar):
         """VAE loss function."""
@@ -71,12 +72,26 @@ class VAE(AbstractModel):
         z = mu + eps * std
         return z
 
-    def train_init(self, lr, batch_size):
+    def train_init(self, lr, batch_size, storage="folder", device=None):
         """Initialize the training parameters and optimizer."""
-        self.dataset, self.loader = get_dataloader(self.dataset_name, batch_size)
+        self.dataset, self.loader = get_dataloader(self.dataset_name, batch_size, storage=storage, device=device)
+        self.storage = storage
         self.optimizer = optim.Adam(list(self.encoder.parameters()) + list(self.decoder.parameters()), lr=lr)
 
-    def train(self, num_epochs, lr, batch_size, device, save_interval=1, image_interval=50):
+    def train(
+        self,
+        num_epochs,
+        lr,
+        batch_size,
+        device,
+        save_interval=1,
+        image_interval=50,
+        storage="folder",
+        precision="fp32",
+        async_fid=False,
+        eval_images=1000,
+        keep_checkpoints=None,
+    ):
         """
         Trains the VAE model.
 
@@ -94,9 +109,25 @@ class VAE(AbstractModel):
             Number of epochs to wait before saving the models. Defaults to 1.
         image_interval : int
             Number of iterations to wait before saving generated images. Defaults to 50.
+        storage : str
+            How the dataset is stored on disk ("folder", "memmap" or "shards").
+        precision : str
+            Training precision: "fp32", or mixed precision with "fp16" or "bf16".
+        async_fid : bool
+            Whether to compute the FID of each epoch in the background, on a snapshot of the model,
+            while the next epoch trains. The scores are recorded when they are ready.
+        eval_images : int
+            Number of reconstructed images of each evaluation (FID, KID, precision and recall).
+            The FID is skipped below 2048, the dimension of the Inception features.
+        keep_checkpoints : int
+            Number of latest checkpoints to keep besides the best FID.
+            If None, all the checkpoints are kept.
         """
+        self.keep_checkpoints = keep_checkpoints
+
         # Initialize training parameters and optimizer
-        self.train_init(lr, batch_size)
+        self.train_init(lr, batch_size, storage, device)
+        self.amp = MixedPrecision(precision, device)
 
         # Make FID stats
         self.make_fid_stats(device)
@@ -124,16 +155,20 @@ class VAE(AbstractModel):
 
             if ((epoch + 1) % save_interval == 0) or (epoch <= 3):
                 print(f"Saving checkpoint at epoch {epoch+1}...")
-                self.save_checkpoint(epoch)
-
-            # Evaluate the FID score, and log it as 'test' loss
-            # FID needs at least 2048 images to compare the final average pooling features
-            # C.f. https://github.com/mseitzer/pytorch-fid
-            # We use 2048 + batch_size to ensure that ((2048 + batch_size) // batch_size) * batch_size > 2048
-            fid_score = self.calculate_fid(2048 + batch_size, batch_size, device)
-            self.epoch_losses["test"].append(fid_score)
-            print(f"FID: {fid_score:.2f}")
+                self.save_checkpoint(epoch, asynchronous=True)
+
+            # Evaluate the FID score, and log it as 'test' loss (with the KID, precision and recall)
+            if async_fid:
+                self.calculate_fid(eval_images, batch_size, device, asynchronous=True, epoch=epoch)
+            else:
+                self._record_fids([(epoch, self.calculate_fid(eval_images, batch_size, device))])
+            if self.epoch_losses["test"]:
+                self.graph_fid(epoch)
+
+        # Wait for the last background FID evaluation and checkpoint
+        if self.collect_fids(wait=True):
             self.graph_fid(epoch)
+        self.checkpoint_writer().wait()
 
     def perform_train_step(self, real_imgs):
         """
@@ -144,54 +179,26 @@ class VAE(AbstractModel):
         real_imgs : torch.Tensor
             Tensor of shape (batch_size, 3, 128, 128) containing the real images.
         """
-        mu, logvar = self.encoder(real_imgs)
-        z = self.reparameterize(mu, logvar)
-        recon_imgs = self.decoder(z)
+        with self.amp.autocast():
+            mu, logvar = self.encoder(real_imgs)
+            z = self.reparameterize(mu, logvar)
+            recon_imgs = self.decoder(z)
 
-        loss = self.loss_function(recon_imgs, real_imgs, mu, logvar)
+        # The loss (and its exp) is computed in float32, outside of autocast
+        loss = self.loss_function(recon_imgs.float(), real_imgs, mu.float(), logvar.float())
 
         # Backward pass and optimization
 
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self.amp.backward(loss)
+        self.amp.step(self.optimizer)
+        self.amp.update()
 
         return loss
 
-    def make_fid_stats(self, device):
-        """
-        Calculate and save FID stats for the dataset.
-
-        Parameters
-        ----------
-        device : torch.device
-            Device to use for calculation.
-        """
-        # If device is CPU, ignore and skip
-        if str(device) == "cpu":
-            print("Skipping FID stats for CPU")
-            return
-
-        dataset_folder = f"{data_folder}/{self.dataset_name}"
-        stats_path = f"{data_folder}/{self.dataset_name}_statistics.npz"
-
-        # If the stats file already exists, skip
-        if os.path.exists(stats_path):
-            return
-
-        print("Generating FID stats for the dataset...")
-        calc_and_save_stats(
-            dataset_folder,
-            stats_path,
-            batch_size=10,
-            img_size=128,
-            use_torch=True,
-            num_workers=os.cpu_count() - 1,
-        )
-
-    def calculate_fid(self, num_images, batch_size, device):
+    def calculate_fid(self, num_images, batch_size, device, asynchronous=False, epoch=None):
         """
-        Calculate the FID score.
+        Calculate the FID score and the other metrics of the same features.
 
         Parameters
         ----------
@@ -201,39 +208,80 @@ class VAE(AbstractModel):
             Number of images used in a sample.
         device : torch.device
             Device to use for calculation.
+        asynchronous : bool
+            Whether to evaluate a snapshot of the model in the background, and return immediately.
+            The metrics are then recorded in epoch_losses by a later call to calculate_fid or collect_fids.
+        epoch : int
+            Epoch of the evaluation, reported with the asynchronous scores.
 
         Returns
         -------
-        fid_score : float
-            Computed FID score.
+        metrics : dict
+            Computed metrics, by name (see FIDEvaluator.compute_metrics), None when asynchronous.
         """
-        self.encoder.eval()
-        generated_images = []
-
-        with torch.no_grad():
-            num_batches = num_images // batch_size
-
-            data_iter = enumerate(self.loader)
-
-            for i, imgs in data_iter:
+        if asynchronous:
+            # The training loader keeps being used by the training loop. This one reads the few evaluation batches
+            # in the background thread, without worker processes that would stay alive next to the training ones
+            loader = getattr(self, "_fid_loader", None)
+            if loader is None or loader.batch_size != batch_size:
+                _, self._fid_loader = get_dataloader(self.dataset_name, batch_size, storage=self.storage, num_workers=0)
+            encoder, decoder = copy.deepcopy(self.encoder).eval(), copy.deepcopy(self.decoder).eval()
+            loader = self._fid_loader
+        else:
+            encoder, decoder, loader = self.encoder, self.decoder, self.loader
+            self.encoder.eval()
+
+        def batches():
+            num_left = num_images
+            for imgs in loader:
                 # Stop if we have enough samples
-                if i >= num_batches:
+                if num_left <= 0:
                     break
-                imgs = imgs.to(device)
-                mu, logvar = self.encoder(imgs)
+                imgs = imgs[:num_left].to(device)
+                num_left -= len(imgs)
+                mu, logvar = encoder(imgs)
                 z = self.reparameterize(mu, logvar)
-                recon_imgs = self.decoder(z)
-                generated_images.append(recon_imgs.detach().cpu())
+                yield denormalize_image(decoder(z))
+
+        # The reconstructed batches go straight through the Inception network, without being kept
+        stats_path = fid_stats_path(self.dataset_name)
+        if asynchronous:
+            self._record_fids(self.async_fid_evaluator(device).submit(batches, stats_path, tag=epoch, resolution=128))
+            return
+
+        with torch.no_grad():
+            metrics = self.fid_evaluator(device).evaluate_metrics(batches(), stats_path, resolution=128)
 
         self.decoder.train()
-        # Concatenate the image
-        generated_images = torch.cat(generated_images, dim=0)
+        return metrics
 
-        # Denormalized the image
-        denormalized_imgs = denormalize_image(generated_images)
+    def collect_fids(self, wait=False):
+        """
+        Record the metrics of the background FID evaluation in epoch_losses, if it is finished.
 
-        stats_path = f"{data_folder}/{self.dataset_name}_statistics.npz"
-        return get_fid(denormalized_imgs, stats_path)
+        Parameters
+        ----------
+        wait : bool
+            Whether to wait for the evaluation in flight.
+
+        Returns
+        -------
+        bool
+            Whether a score was recorded.
+        """
+        evaluator = getattr(self, "_async_fid_evaluator", None)
+        if evaluator is None:
+            return False
+        results = evaluator.wait() if wait else evaluator.poll()
+        self._record_fids(results)
+        return len(results) > 0
+
+    def _record_fids(self, results):
+        """Record (epoch, metrics) results, the FID as test loss."""
+        for epoch, metrics in results:
+            self.record_test_metrics(metrics)
+            self.record_checkpoint_fid(epoch + 1, metrics.get("fid"))
+            print(f"Epoch {epoch + 1} - {format_metrics(metrics)}")
 
     def generate_images(self, iter_, epoch, device, save_dir="outputs/VAE_images"):
         """
@@ -282,7 +330,7 @@ class VAE(AbstractModel):
         denormalized_image = denormalize_image(fake_image)
         save_image(denormalized_image, os.path.join(save_folder, filename), normalize=False)
 
-    def save_checkpoint(self, epoch, save_dir="outputs/VAE_checkpoints"):
+    def save_checkpoint(self, epoch, save_dir="outputs/VAE_checkpoints", asynchronous=False):
         """
         Save a checkpoint of the current state. This includes the models, optimizers, FIDs, and training params.
 
@@ -292,6 +340,8 @@ class VAE(AbstractModel):
             Current epoch.
         save_dir : str
             Directory to save the checkpoint to.
+        asynchronous : bool
+            Whether to write the checkpoint in the background, and return as soon as it is copied.
         """
         save_folder = self.get_save_dir(save_dir)
         os.makedirs(save_folder, exist_ok=True)
@@ -306,8 +356,11 @@ class VAE(AbstractModel):
             "dataset_name": self.dataset_name,
             "latent_dim": self.latent_dim,
         }
-        torch.save(checkpoint, checkpoint_path)
-        return checkpoint_path
+        # The FID of the saved model is recorded in the index when its score arrives
+        entry = dict(epoch=epoch + 1, pending=True)
+        return self.checkpoint_writer().save(
+            checkpoint, checkpoint_path, asynchronous, index=self.checkpoint_index(save_folder), entry=entry
+        )
 
     @classmethod
     def from_checkpoint(cls, checkpoint_path, device):
@@ -355,6 +408,8 @@ class VAE(AbstractModel):
         use_saved=True,
         device="cpu",
         other_data_folder=None,
+        seed=0,
+        cache_dir="models/pca_cache",
     ):
         """Fit PCA to the latent space of the VAE.
 
@@ -366,69 +421,81 @@ class VAE(AbstractModel):
             Batch size for processing.
         n_components : int
             Number of components for PCA.
-        save : bool
-            Whether to save the PCA model.
+        save_file : str
+            File the fitted PCA model is exported to (see load_pca).
         use_saved : bool
-            Whether to use a saved PCA model.
+            Whether to use a cached PCA model, fitted with the same encoder weights, data and parameters.
         device : torch.device
             Device to use for training.
         other_data_folder : str
             Path to the folder containing the dataset. If None, use the default folder.
+        seed : int
+            Seed of the image order and latent sampling the PCA is fitted on.
+        cache_dir : str
+            Folder of the PCA cache.
         """
+        # The latent vectors sampled from the seed depend on the device and on how the images are split in batches
+        cache = PCACache(cache_dir)
+        cache_key = cache.key(
+            self.encoder,
+            model="VAE",
+            dataset_name=self.dataset_name,
+            other_data_folder=other_data_folder,
+            num_samples=num_samples,
+            batch_size=batch_size,
+            n_components=n_components,
+            seed=seed,
+            device=torch.device(device).type,
+        )
         if use_saved:
-            try:
-                self.load_pca(save_file)
-                # Check if the loaded PCA has the correct number of components and samples
-                if self.pca.n_components_ == n_components and self.pca.n_samples_ == num_samples:
-                    print("Loaded PCA from saved file.")
-                    return
-                else:
-                    print(f"Saved PCA ({self.pca.n_components_}, {self.pca.n_samples_}).")
-                    print(
-                        f"Does not match the requested parameters ({n_components}, {num_samples}). Fitting new PCA..."
-                    )
-            except FileNotFoundError:
-                print("No saved PCA found. Fitting new PCA...")
+            pca = cache.load(cache_key)
+            if pca is not None:
+                print("Loaded PCA from cache.")
+                self._set_pca(pca)
+                return
+            print("No cached PCA for these weights and parameters. Fitting new PCA...")
+
+        with torch.random.fork_rng():
+            torch.manual_seed(seed)
+            pca = self._fit_pca(num_samples, batch_size, n_components, device, other_data_folder)
+        self._set_pca(pca)
+        cache.save(cache_key, self.pca)
+
+        # Save PCA as parquet file
+        full_save_file = self.get_save_dir(save_file) + ".joblib"
+        dump(self.pca, full_save_file)
 
+    def _fit_pca(self, num_samples, batch_size, n_components, device, other_data_folder):
+        """Fit a PCA on the latent vectors of num_samples images, see fit_pca."""
         self.encoder.eval()
-        all_z = []
-        self.n_components = n_components
+        fitter = StreamingPCA(n_components, device=device)
 
         # In the VAE, you want to encode the real images and then sample from the latent space
         self.dataset, self.loader = get_dataloader(self.dataset_name, batch_size, other_data_folder=other_data_folder)
         if num_samples > len(self.dataset):
             raise ValueError(f"num_samples ({num_samples}) must be <= len(dataset) ({len(self.dataset)})")
 
-        n_batches = num_samples // batch_size
-        data_iter = tqdm(enumerate(self.loader), total=len(self.loader), desc="Fitting PCA for VAE")
+        n_batches = -(-num_samples // batch_size)
+        data_iter = tqdm(self.loader, total=n_batches, desc="Fitting PCA for VAE")
 
-        # Process in batches
-        for i, imgs in data_iter:
+        # Fit the PCA on the latent vectors as they are encoded, without keeping them
+        for imgs in data_iter:
             # Stop if we have enough samples
-            if i >= n_batches:
+            remaining = num_samples - fitter.n_samples
+            if remaining <= 0:
                 break
 
             # Sample real images
-            real_imgs = imgs.to(device)
+            real_imgs = imgs[:remaining].to(device)
 
             # Get the latent space representation
             with torch.no_grad():
                 mu, logvar = self.encoder(real_imgs)
                 z = self.reparameterize(mu, logvar)
 
-            all_z.append(z.cpu())
+            fitter.partial_fit(z)
 
-        # Concatenate all the latent vectors
-        all_z = torch.cat(all_z, dim=0)[:num_samples]  # Ensure exact number of samples
-        all_z_flat = all_z.view(num_samples, -1).numpy()  # Flatten for PCA
-
-        # Fit PCA
-        self.pca = PCA(n_components=n_components)
-        self.pca.fit(all_z_flat)
-
-        # Save PCA as parquet file
-        full_save_file = self.get_save_dir(save_file) + ".joblib"
-        dump(self.pca, full_save_file)
+        return fitter.to_sklearn()
 
     def load_pca(self, save_file="outputs/VAE_PCA"):
         """
@@ -440,8 +507,13 @@ class VAE(AbstractModel):
             File to load the PCA model from.
         """
         full_save_file = self.get_save_dir(save_file) + ".joblib"
-        self.pca = load(full_save_file)
-        self.n_components = self.pca.n_components_
+        self._set_pca(load(full_save_file))
+
+    def _set_pca(self, pca):
+        """Use a fitted sklearn PCA, and its basis on the decoder device."""
+        self.pca = pca
+        self.n_components = pca.n_components_
+        self.pca_basis = PCABasis.from_sklearn(pca).to(next(self.decoder.parameters()).device)
 
     def image_from_eigenvector_strengths(self, eigenvector_strengths: list):
         """
@@ -464,11 +536,8 @@ class VAE(AbstractModel):
                 f"Length of eigenvector_strengths ({len(eigenvector_strengths)}) must be <= ({self.pca.n_components})"
             )
 
-        # Sample z = V x
-        x = torch.zeros(self.pca.n_components)
-        for i, strength in enumerate(eigenvector_strengths):
-            x[i] = strength
-        z = torch.tensor(self.pca.inverse_transform(x.view(1, -1)))
+        # Sample z = V x, the missing strengths being zero
+        z = self.pca_basis.reconstruct(torch.tensor([eigenvector_strengths]))
 
         # Generate image
         self.decoder.eval()
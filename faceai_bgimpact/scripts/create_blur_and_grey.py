@@ -1,11 +1,7 @@
-from faceai_bgimpact.data_processing.create_blur_and_grey import create_blurred_and_grey_images, compress_folder
-from faceai_bgimpact.data_processing.paths import blur_folder_name, grey_folder_name
+from faceai_bgimpact.data_processing.create_blur_and_grey import create_blurred_and_grey_images
 
 
-def create_blur_and_grey(zip_: bool = True):
+def create_blur_and_grey(zip_: bool = True, num_workers: int = None, png_compression: int = 1):
     """Create blurred and grey images."""
-    create_blurred_and_grey_images()
-    if zip_:
-        print("Compressing blurred and grey folders...")
-        compress_folder(blur_folder_name)
-        compress_folder(grey_folder_name)
+    # The archives are written while the images are created, without a second pass over the folders
+    create_blurred_and_grey_images(num_workers=num_workers, png_compression=png_compression, zip_=zip_)
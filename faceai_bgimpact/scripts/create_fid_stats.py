@@ -0,0 +1,2 @@
+# flake8: noqa
+from faceai_bgimpact.models.metrics import create_fid_stats
@@ -0,0 +1,2 @@
+# flake8: noqa
+from faceai_bgimpact.data_processing.pack_ffhq import pack_ffhq
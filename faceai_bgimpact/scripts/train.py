@@ -4,24 +4,38 @@ import os
 import torch
 from faceai_bgimpact.models import DCGAN, StyleGAN, VAE
 from faceai_bgimpact.configs import configs
+from faceai_bgimpact.models.checkpoint import CheckpointIndex
 
 
 def list_checkpoints(checkpoint_dir):
     """List available checkpoints in the directory."""
-    checkpoints = [f for f in os.listdir(checkpoint_dir) if f.endswith(".pth")]
     print("\nAvailable checkpoints:")
+    if CheckpointIndex.exists(checkpoint_dir):
+        for entry in sorted(CheckpointIndex(checkpoint_dir).load().values(), key=lambda entry: entry["epoch"]):
+            details = "".join(
+                f", {name} {entry[name]:.4g}" for name in ["level", "alpha", "fid"] if entry.get(name) is not None
+            )
+            print(f"- Epoch {entry['epoch']}{details}: {entry['file']}")
+    else:
+        # Folders written before the index
+        checkpoints = [f for f in os.listdir(checkpoint_dir) if f.endswith(".pth")]
 
-    def epoch(path):
-        return int(path.split("_")[1])
+        def epoch(path):
+            return int(path.split("_")[1])
 
-    for checkpoint in checkpoints:
-        print(f"- Epoch {epoch(checkpoint)}: {checkpoint}")
+        for checkpoint in checkpoints:
+            print(f"- Epoch {epoch(checkpoint)}: {checkpoint}")
     print()
     return int(input("Enter the epoch to resume from: "))
 
 
 def find_checkpoint_path(checkpoint_dir, epoch):
     """Find the checkpoint path for a given epoch."""
+    checkpoint_path = CheckpointIndex(checkpoint_dir).find(epoch)
+    if checkpoint_path is not None:
+        return checkpoint_path
+
+    # Folders written before the index
     for file in os.listdir(checkpoint_dir):
         if file.startswith(f"step_{epoch}_") or file.startswith(f"checkpoint_epoch_{epoch}."):
             return os.path.join(checkpoint_dir, file)
@@ -41,6 +55,8 @@ def train_function(
     list_checkpoints_flag,
     checkpoint_path,
     checkpoint_epoch,
+    storage="folder",
+    precision="fp32",
 ):
     """Train a model."""
     # Load the default configuration
@@ -90,6 +106,10 @@ def train_function(
             lr=config["lr"],
             device=device,
             save_interval=config["save_interval"],
+            eval_images=config["eval_images"],
+            keep_checkpoints=config["keep_checkpoints"],
+            storage=storage,
+            precision=precision,
         )
     elif model.lower() == "stylegan":
         if checkpoint_path is None:
@@ -121,6 +141,17 @@ def train_function(
             save_interval=config["save_interval"],
             image_interval=config["image_interval"],
             level_epochs={int(k): v for (k, v) in config["level_epochs"].items()},
+            cache_dataset=config["cache_dataset"],
+            r1_interval=config["r1_interval"],
+            fused_d=config["fused_d"],
+            reuse_fakes=config["reuse_fakes"],
+            d_steps=config["d_steps"],
+            ema_beta=config["ema_beta"],
+            async_fid=config["async_fid"],
+            eval_images=config["eval_images"],
+            keep_checkpoints=config["keep_checkpoints"],
+            storage=storage,
+            precision=precision,
         )
     elif model.lower() == "vae":
         if checkpoint_path is None:
@@ -141,6 +172,11 @@ def train_function(
             device=device,
             save_interval=config["save_interval"],
             image_interval=config["image_interval"],
+            async_fid=config["async_fid"],
+            eval_images=config["eval_images"],
+            keep_checkpoints=config["keep_checkpoints"],
+            storage=storage,
+            precision=precision,
         )
     else:
         raise ValueError("Invalid model type")
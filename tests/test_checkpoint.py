@@ -0,0 +1,118 @@
+# flake8: noqa
+
+import os
+import torch
+from functools import partial
+from faceai_bgimpact.models.checkpoint import CheckpointWriter
+
+
+def test_checkpoint_writer(tmp_path):
+    """The saved checkpoint is the state at save time, written atomically, even if training goes on."""
+    model = torch.nn.Linear(4, 4)
+    optimizer = torch.optim.Adam(model.parameters())
+    model(torch.randn(2, 4)).sum().backward()
+    optimizer.step()
+    fids = {"fid": [10.0]}
+
+    writer = CheckpointWriter()
+    path = str(tmp_path / "checkpoint.pth")
+    expected = {k: v.clone() for k, v in model.state_dict().items()}
+    writer.save({"model": model.state_dict(), "optimizer": optimizer.state_dict(), "fids": fids}, path)
+
+    # Training modifies the live state while the checkpoint is written
+    with torch.no_grad():
+        model.weight.add_(1.0)
+    fids["fid"].append(5.0)
+
+    saved_path, size, elapsed = writer.wait()
+    assert saved_path == path and size == os.path.getsize(path) and elapsed >= 0
+    assert os.listdir(tmp_path) == ["checkpoint.pth"]
+    checkpoint = torch.load(path)
+    assert all(torch.equal(checkpoint["model"][k], v) for k, v in expected.items())
+    assert checkpoint["fids"] == {"fid": [10.0]}
+    assert checkpoint["optimizer"]["state"][0]["step"] == 1
+    assert writer.wait() is None
+
+
+def test_checkpoint_index_retention(tmp_path):
+    """The index finds checkpoints by epoch, and keeps the latest ones, the best FID and the latest of each level."""
+    from faceai_bgimpact.models.checkpoint import CheckpointIndex
+
+    index = CheckpointIndex(str(tmp_path), keep_last=2)
+    fids = [50.0, 20.0, 30.0, 40.0, 35.0, 45.0]
+    for epoch, fid in enumerate(fids, 1):
+        path = tmp_path / f"step_{epoch}.pth"
+        path.write_bytes(b"")
+        CheckpointWriter._write({}, str(path), None, index, dict(epoch=epoch, level=int(epoch > 3), fid=fid))
+
+    # Epoch 2 has the best FID, epoch 3 is the latest of level 0, epochs 5 and 6 are the latest
+    assert sorted(int(key) for key in index.load()) == [2, 3, 5, 6]
+    assert sorted(os.listdir(tmp_path)) == ["index.json", "step_2.pth", "step_3.pth", "step_5.pth", "step_6.pth"]
+    assert index.find(5) == str(tmp_path / "step_5.pth")
+    assert index.find(4) is None
+
+
+def test_checkpoint_fid_matches_epoch(tmp_path):
+    """The FID of each indexed checkpoint is the score of the model it contains, even when scores arrive late."""
+    from faceai_bgimpact.models import VAE
+    from faceai_bgimpact.models.checkpoint import CheckpointIndex
+
+    model = VAE("ffhq_raw", 16, "cpu")
+    model.optimizer = torch.optim.Adam(model.encoder.parameters())
+    model.keep_checkpoints = 1
+    save_dir = str(tmp_path / "checkpoints")
+    fids = [40.0, 10.0, 30.0, 20.0]
+
+    # Like asynchronous evaluations: the score of an epoch is recorded after the checkpoint of the next one is saved
+    for epoch, fid in enumerate(fids):
+        model.save_checkpoint(epoch, save_dir=save_dir, asynchronous=True)
+        if epoch > 0:
+            model._record_fids([(epoch - 1, {"fid": fids[epoch - 1]})])
+    model._record_fids([(len(fids) - 1, {"fid": fids[-1]})])
+    model.checkpoint_writer().wait()
+
+    # The best model was trained for 2 epochs, and is kept with the latest one
+    entries = CheckpointIndex(str(tmp_path / "checkpoints_ffhq_raw")).load()
+    assert {int(key): entry["fid"] for key, entry in entries.items()} == {2: 10.0, 4: 20.0}
+    assert sorted(os.listdir(tmp_path / "checkpoints_ffhq_raw")) == [
+        "checkpoint_epoch_2.pth",
+        "checkpoint_epoch_4.pth",
+        "index.json",
+    ]
+
+
+def test_stylegan_checkpoint_fid_matches_epoch(tmp_path, monkeypatch):
+    """With synchronous evaluations, the score of each StyleGAN checkpoint is recorded after its index entry."""
+    from faceai_bgimpact.models import StyleGAN
+    from faceai_bgimpact.models.checkpoint import CheckpointIndex
+
+    model = StyleGAN("ffhq_raw", 256, 256, 2, "cpu")
+    model.train_init(0, 0, 0, "r1")
+    model.keep_checkpoints = 1
+    model.batch_size = 4
+    model.current_epochs = {0: 0}
+    save_dir = str(tmp_path / "checkpoints")
+    fids = [40.0, 10.0, 30.0, 20.0]
+
+    # Scores the model as soon as it is evaluated, like a synchronous evaluation
+    def calculate_fid(num_images, batch_size, device, asynchronous=False):
+        model._record_fids([((model.level, model.epoch_total), {"fid": fids[model.epoch_total]})])
+
+    monkeypatch.setattr(model, "calculate_fid", calculate_fid)
+    monkeypatch.setattr(model, "graph_fid", lambda: None)
+    monkeypatch.setattr(model, "save_checkpoint", partial(model.save_checkpoint, save_dir=save_dir))
+    for epoch in range(len(fids)):
+        model.current_epochs[0] = epoch
+        model.epoch_total = epoch
+        model._end_epoch(0, epoch, save_interval=1, eval_images=4, device="cpu", async_fid=False)
+    model.checkpoint_writer().wait()
+
+    # The best model was trained for 2 epochs, and is kept with the latest one
+    entries = CheckpointIndex(str(tmp_path / "checkpoints_ffhq_raw")).load()
+    assert {int(key): entry["fid"] for key, entry in entries.items()} == {2: 10.0, 4: 20.0}
+    assert not any(entry["pending"] for entry in entries.values())
+    assert sorted(os.listdir(tmp_path / "checkpoints_ffhq_raw")) == [
+        "index.json",
+        "step_2_0_1.00.pth",
+        "step_4_0_1.00.pth",
+    ]
@@ -0,0 +1,30 @@
+# flake8: noqa
+
+import numpy as np
+import pytest
+
+
+@pytest.mark.parametrize("mask_value", [0, 255, None])
+def test_blend_matches_float_reference(tmp_path, monkeypatch, mask_value):
+    # The module creates its output folders when imported
+    monkeypatch.chdir(tmp_path)
+    from faceai_bgimpact.data_processing.create_blur_and_grey import _blend
+
+    rng = np.random.default_rng(0)
+    foreground = rng.integers(0, 256, size=(32, 32, 3), dtype=np.uint8)
+    background = rng.integers(0, 256, size=(32, 32, 3), dtype=np.uint8)
+    if mask_value is None:
+        mask = rng.integers(0, 256, size=(32, 32), dtype=np.uint8)
+    else:
+        mask = np.full((32, 32), mask_value, dtype=np.uint8)
+
+    blended = _blend(foreground, background, mask)
+    alpha = mask[:, :, None] / 255.0
+    reference = np.round(foreground * alpha + background * (1.0 - alpha))
+
+    assert blended.dtype == np.uint8
+    assert np.abs(blended.astype(np.float64) - reference).max() <= 1
+    if mask_value == 0:
+        assert np.array_equal(blended, background)
+    elif mask_value == 255:
+        assert np.array_equal(blended, foreground)
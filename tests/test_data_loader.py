@@ -1,7 +1,8 @@
 # flake8: noqa
 
 import pytest
-from faceai_bgimpact.models.data_loader import get_dataloader
+import torch
+from faceai_bgimpact.models.data_loader import get_dataloader, fade_in
 
 
 @pytest.mark.parametrize("dataset_name", ["ffhq_raw", "ffhq_blur", "ffhq_grey"])
@@ -22,3 +23,111 @@ def test_dataset_loading(dataset_name):
         resolution,
         resolution,
     ), f"Image batch size or dimensions are incorrect for {dataset_name}"
+
+
+@pytest.fixture
+def fake_data_folder(tmp_path):
+    """Folder with a small dataset of random 128x128 images, laid out like ffhq_data."""
+    import numpy as np
+    from PIL import Image
+
+    dataset_folder = tmp_path / "ffhq_raw"
+    dataset_folder.mkdir()
+    rng = np.random.default_rng(0)
+    for i in range(12):
+        image = rng.integers(0, 256, size=(128, 128, 3), dtype=np.uint8)
+        Image.fromarray(image).save(dataset_folder / f"{i:05d}.png")
+    return str(tmp_path)
+
+
+@pytest.mark.parametrize("resolution,alpha", [(4, 1.0), (16, 0.5), (128, 1.0)])
+def test_cached_dataset_matches_uncached(fake_data_folder, resolution, alpha):
+    dataset, _ = get_dataloader(
+        "ffhq_raw", batch_size=4, resolution=resolution, alpha=alpha, other_data_folder=fake_data_folder
+    )
+    cached_dataset, _ = get_dataloader(
+        "ffhq_raw", batch_size=4, resolution=resolution, alpha=alpha, other_data_folder=fake_data_folder, cache=True
+    )
+
+    image, cached_image = dataset[3], cached_dataset[3]
+    assert cached_image.shape == image.shape == (3, resolution, resolution)
+    # Both are quantized to uint8 at the target resolution, the blend may differ slightly in rounding
+    assert (cached_image - image).abs().max() < 0.1
+
+
+@pytest.mark.parametrize("resolution,alpha", [(8, 0.5), (128, 1.0)])
+def test_memmap_dataset_matches_folder(fake_data_folder, resolution, alpha):
+    from faceai_bgimpact.data_processing.pack_ffhq import pack_ffhq
+
+    pack_ffhq("ffhq_raw", other_data_folder=fake_data_folder)
+    dataset, _ = get_dataloader(
+        "ffhq_raw", batch_size=4, resolution=resolution, alpha=alpha, other_data_folder=fake_data_folder
+    )
+    memmap_dataset, loader = get_dataloader(
+        "ffhq_raw",
+        batch_size=4,
+        resolution=resolution,
+        alpha=alpha,
+        other_data_folder=fake_data_folder,
+        storage="memmap",
+    )
+
+    assert len(memmap_dataset) == len(dataset)
+    idx = memmap_dataset.image_files.index(dataset.image_files[5])
+    assert (memmap_dataset[idx] - dataset[5]).abs().max() < 0.1
+    assert next(iter(loader)).shape == (4, 3, resolution, resolution)
+
+
+@pytest.mark.parametrize("alpha", [0.0, 0.3, 1.0])
+def test_fade_in(alpha):
+    # Pixel-level checkerboard: all of its detail disappears at half resolution
+    checkerboard = (torch.arange(16).view(1, 16) + torch.arange(16).view(16, 1)) % 2 * 2.0 - 1.0
+    images = checkerboard.expand(4, 3, 16, 16)
+    blended = fade_in(images, alpha)
+
+    assert blended.shape == images.shape
+    assert torch.allclose(blended, alpha * images)
+
+
+def test_loader_follows_resolution_updates(fake_data_folder):
+    dataset, loader = get_dataloader(
+        "ffhq_raw", batch_size=4, resolution=8, other_data_folder=fake_data_folder, num_workers=2
+    )
+    assert len(loader) == 3
+    assert next(iter(loader)).shape == (4, 3, 8, 8)
+
+    # The persistent workers were forked at resolution 8, and must still follow the update
+    loader.update_resolution(16, 5)
+    batches = list(loader)
+    assert len(loader) == len(batches) == 3
+    assert batches[0].shape == (5, 3, 16, 16)
+    assert dataset[0].shape == (3, 16, 16)
+
+
+def test_shard_dataset_streams_every_image_once(fake_data_folder):
+    from faceai_bgimpact.data_processing.create_shards import create_shards
+
+    create_shards("ffhq_raw", shard_size=5, other_data_folder=fake_data_folder)
+    dataset, _ = get_dataloader("ffhq_raw", batch_size=4, resolution=16, other_data_folder=fake_data_folder)
+    shard_dataset, loader = get_dataloader(
+        "ffhq_raw", batch_size=4, resolution=16, other_data_folder=fake_data_folder, storage="shards", num_workers=2
+    )
+    assert len(shard_dataset) == len(dataset) == 12
+
+    # Direct access reads the same image as the folder dataset
+    idx = sorted(dataset.image_files).index(dataset.image_files[7])
+    assert (shard_dataset[idx] - dataset[7]).abs().max() < 1e-6
+
+    # Each of the 3 shards is read by exactly one of the workers, which yields its own partial last batch:
+    # 5 + 2 images for the first one, 5 for the second one
+    batches = list(loader)
+    assert len(loader) == len(batches) == 4
+    streamed = torch.cat(batches)
+    expected = torch.stack([dataset[i] for i in range(len(dataset))])
+    assert streamed.shape == expected.shape == (12, 3, 16, 16)
+    assert torch.allclose(streamed.sum(dim=(1, 2, 3)).sort().values, expected.sum(dim=(1, 2, 3)).sort().values)
+
+    loader.update_resolution(8, 6)
+    batches = list(loader)
+    assert len(loader) == len(batches) == 3
+    assert batches[0].shape[1:] == (3, 8, 8)
@@ -0,0 +1,143 @@
+# flake8: noqa
+
+import numpy as np
+import torch
+from pytorch_gan_metrics.core import calculate_frechet_distance
+from faceai_bgimpact.models.metrics import FIDEvaluator
+
+
+class ToyFeatures(torch.nn.Module):
+    """Small stand-in for the Inception network, mapping images to 8 features."""
+
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv2d(3, 8, 3)
+
+    def forward(self, x):
+        return self.conv(x).mean([2, 3])
+
+
+def test_streaming_fid_matches_full_features(tmp_path):
+    """The FID from streamed batches matches the FID computed from all the features at once."""
+    torch.manual_seed(0)
+    evaluator = FIDEvaluator("cpu", dims=8, feature_extractor=ToyFeatures())
+    real, fake = torch.rand(300, 3, 16, 16), torch.rand(300, 3, 16, 16) ** 2
+
+    real_features = evaluator.features(real).double().numpy()
+    stats_path = str(tmp_path / "stats.npz")
+    np.savez_compressed(stats_path, mu=real_features.mean(0), sigma=np.cov(real_features, rowvar=False))
+
+    fake_features = evaluator.features(fake).double().numpy()
+    expected = calculate_frechet_distance(
+        fake_features.mean(0),
+        np.cov(fake_features, rowvar=False),
+        real_features.mean(0),
+        np.cov(real_features, rowvar=False),
+    )
+    assert np.isclose(evaluator.evaluate(fake.split(64), stats_path), expected, rtol=1e-4)
+
+    # Evaluations are independent
+    assert evaluator.evaluate(real.split(50), stats_path) < 1e-3
+
+    # Fewer images than features give a rank-deficient covariance: the FID is skipped
+    assert evaluator.evaluate([real[:5]], stats_path) is None
+
+
+def test_async_fid_evaluator(tmp_path):
+    """Background evaluations give the same scores as synchronous ones, one at a time and in order."""
+    from faceai_bgimpact.models.metrics import AsyncFIDEvaluator
+
+    torch.manual_seed(0)
+    features = ToyFeatures()
+    images = [torch.rand(100, 3, 16, 16) ** (i + 1) for i in range(3)]
+    stats_path = str(tmp_path / "stats.npz")
+    real_features = features(torch.rand(200, 3, 16, 16)).detach().double().numpy()
+    np.savez_compressed(stats_path, mu=real_features.mean(0), sigma=np.cov(real_features, rowvar=False))
+
+    evaluator = FIDEvaluator("cpu", dims=8, feature_extractor=features)
+    expected = [evaluator.evaluate(batch.split(25), stats_path) for batch in images]
+
+    async_evaluator = AsyncFIDEvaluator(FIDEvaluator("cpu", dims=8, feature_extractor=features))
+    results = []
+    for i, batch in enumerate(images):
+        results += async_evaluator.submit(lambda batch=batch: batch.split(25), stats_path, tag=i)
+        assert async_evaluator.pending is not None
+    results += async_evaluator.wait()
+    assert [tag for tag, _ in results] == [0, 1, 2]
+    assert np.allclose([metrics["fid"] for _, metrics in results], expected)
+    assert async_evaluator.poll() == []
+
+
+def test_create_fid_stats(tmp_path):
+    """The multi-resolution bundle holds the statistics of the images resized to each resolution."""
+    from PIL import Image
+    from faceai_bgimpact.models.metrics import create_fid_stats, fid_stats_path
+
+    torch.manual_seed(0)
+    rng = np.random.default_rng(0)
+    (tmp_path / "toy").mkdir()
+    for i in range(12):
+        Image.fromarray(rng.integers(0, 256, (32, 32, 3), dtype=np.uint8)).save(tmp_path / "toy" / f"{i:05d}.png")
+
+    extractor = ToyFeatures()
+    stats_path = create_fid_stats(
+        "toy",
+        "cpu",
+        batch_size=5,
+        num_workers=0,
+        other_data_folder=str(tmp_path),
+        resolutions=[8, 32],
+        dims=8,
+        feature_extractor=extractor,
+    )
+    assert stats_path == fid_stats_path("toy", str(tmp_path))
+
+    evaluator = FIDEvaluator("cpu", dims=8, feature_extractor=extractor)
+    for resolution in [8, 32]:
+        images = [Image.open(tmp_path / "toy" / f"{i:05d}.png").convert("RGB") for i in range(12)]
+        images = [np.asarray(image.resize((resolution, resolution), Image.BILINEAR)) for image in images]
+        features = evaluator.features(torch.tensor(np.stack(images)).permute(0, 3, 1, 2).float() / 255).double()
+        mu, sigma = FIDEvaluator.load_statistics(stats_path, resolution)
+        assert np.allclose(mu, features.mean(0).numpy(), atol=1e-5)
+        assert np.allclose(sigma, np.cov(features.numpy(), rowvar=False), atol=1e-5)
+        assert FIDEvaluator.load_features(stats_path, resolution).shape == (12, 8)
+
+
+def test_kid_and_precision_recall(tmp_path):
+    """The KID matches the unbiased MMD estimate, and the metrics come from the features of a single pass."""
+    from faceai_bgimpact.models.metrics import kernel_inception_distance, precision_recall
+
+    torch.manual_seed(0)
+    real, fake = torch.randn(50, 8, dtype=torch.float64), torch.randn(60, 8, dtype=torch.float64) + 0.5
+
+    # With one subset of all the samples, the estimate does not depend on the sampling
+    x, y = real.numpy(), fake[:50].numpy()
+    k_xx, k_yy, k_xy = [(a @ b.T / 8 + 1) ** 3 for a, b in [(x, x), (y, y), (x, y)]]
+    n = len(x)
+    expected = (k_xx.sum() - np.trace(k_xx) + k_yy.sum() - np.trace(k_yy)) / (n * (n - 1)) - 2 * k_xy.mean()
+    assert np.isclose(kernel_inception_distance(real, fake[:50], num_subsets=1), expected)
+    same = kernel_inception_distance(real, torch.randn(60, 8, dtype=torch.float64))
+    assert abs(same) < kernel_inception_distance(real, fake)
+    assert precision_recall(real, real) == (1.0, 1.0)
+
+    # The evaluator keeps the features of the first images for these metrics
+    features = ToyFeatures()
+    real_features = features(torch.rand(200, 3, 16, 16)).detach()
+    stats_path = str(tmp_path / "stats.npz")
+    np.savez_compressed(
+        stats_path,
+        mu_16=real_features.double().mean(0).numpy(),
+        sigma_16=np.cov(real_features.double().numpy(), rowvar=False),
+        features_16=real_features.half().numpy(),
+    )
+    evaluator = FIDEvaluator("cpu", dims=8, feature_extractor=features, max_features=100)
+    metrics = evaluator.evaluate_metrics(torch.rand(150, 3, 16, 16).split(40), stats_path, resolution=16)
+    assert sum(len(samples) for samples in evaluator.samples) == 100
+    assert set(metrics) == {"fid", "kid", "precision", "recall"}
+    assert metrics["fid"] == evaluator.compute(stats_path, 16)
+    assert 0 <= metrics["precision"] <= 1 and 0 <= metrics["recall"] <= 1
+
+    # The other metrics are still computed when there are too few images for the FID
+    metrics = evaluator.evaluate_metrics([torch.rand(6, 3, 16, 16)], stats_path, resolution=16)
+    assert metrics["fid"] is None
+    assert metrics["kid"] is not None and 0 <= metrics["precision"] <= 1
@@ -0,0 +1,102 @@
+# flake8: noqa
+
+import numpy as np
+import pytest
+import torch
+from sklearn.decomposition import PCA
+from faceai_bgimpact.models.pca import PCABasis
+
+
+@pytest.mark.parametrize("whiten", [False, True])
+def test_pca_basis_matches_sklearn(whiten):
+    """The projection and reconstruction of the basis match the sklearn PCA it is built from."""
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(200, 16)).astype(np.float32) @ rng.normal(size=(16, 16)).astype(np.float32)
+    pca = PCA(n_components=6, whiten=whiten).fit(data)
+    basis = PCABasis.from_sklearn(pca)
+
+    x = torch.from_numpy(data[:10])
+    assert torch.allclose(basis.project(x), torch.from_numpy(pca.transform(data[:10])).float(), atol=1e-3)
+
+    coordinates = rng.normal(size=(10, 6)).astype(np.float32)
+    expected = torch.from_numpy(pca.inverse_transform(coordinates)).float()
+    assert torch.allclose(basis.reconstruct(torch.from_numpy(coordinates)), expected, atol=1e-3)
+
+    # Missing coordinates are zero
+    padded = np.concatenate([coordinates[:1, :2], np.zeros((1, 4), dtype=np.float32)], axis=1)
+    assert torch.allclose(
+        basis.reconstruct(coordinates[0, :2].tolist()),
+        torch.from_numpy(pca.inverse_transform(padded)[0]).float(),
+        atol=1e-3,
+    )
+
+
+def test_streaming_pca_matches_sklearn():
+    """The PCA fitted from batches has the same axes and variances as a full sklearn PCA."""
+    from faceai_bgimpact.models.pca import StreamingPCA
+
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(1000, 12)) * np.linspace(5, 0.5, 12) @ np.linalg.qr(rng.normal(size=(12, 12)))[0] + 3.0
+    expected = PCA(n_components=4).fit(data)
+
+    fitter = StreamingPCA(4)
+    for batch in np.array_split(data, 7):
+        fitter.partial_fit(torch.from_numpy(batch))
+    pca = fitter.to_sklearn()
+
+    assert pca.n_samples_ == 1000 and pca.n_components_ == 4
+    assert np.allclose(pca.mean_, expected.mean_, atol=1e-4)
+    assert np.allclose(pca.explained_variance_, expected.explained_variance_, rtol=1e-4)
+    assert np.allclose(np.abs(pca.components_ @ expected.components_.T), np.eye(4), atol=1e-4)
+    assert np.allclose(
+        pca.inverse_transform(pca.transform(data[:5])),
+        expected.inverse_transform(expected.transform(data[:5])),
+        atol=1e-3,
+    )
+
+
+def test_pca_cache(tmp_path):
+    """Cached PCAs are keyed on the weights and parameters, and the least recently used ones are evicted."""
+    import os
+    from faceai_bgimpact.models.pca import PCACache
+
+    module = torch.nn.Linear(4, 4)
+    cache = PCACache(str(tmp_path), max_size=10**9)
+    key = cache.key(module, num_samples=100, seed=0)
+    assert key == cache.key(module, seed=0, num_samples=100)
+    assert key != cache.key(module, num_samples=100, seed=1)
+    assert cache.load(key) is None
+
+    pca = PCA(n_components=2).fit(np.random.default_rng(0).normal(size=(20, 4)))
+    cache.save(key, pca)
+    assert np.array_equal(cache.load(key).components_, pca.components_)
+
+    # Different weights never hit the cached PCA
+    with torch.no_grad():
+        module.weight.add_(1e-3)
+    assert cache.load(cache.key(module, num_samples=100, seed=0)) is None
+
+    # Only the most recently used entries are kept
+    cache.max_size = 2 * os.path.getsize(cache.path(key))
+    keys = [cache.key(module, seed=seed) for seed in range(3)]
+    os.utime(cache.path(key), (0, 0))
+    for i, other_key in enumerate(keys):
+        cache.save(other_key, pca)
+        os.utime(cache.path(other_key), (i + 1, i + 1))
+    assert [os.path.exists(cache.path(k)) for k in [key] + keys] == [False, False, True, True]
+
+
+def test_stylegan_pca_cache_key(tmp_path):
+    """A cached StyleGAN PCA is only reused with the batch size and device it was fitted with."""
+    import os
+    from faceai_bgimpact.models import StyleGAN
+
+    model = StyleGAN("ffhq_raw", 256, 256, 2, "cpu")
+    fit_options = dict(num_samples=64, n_components=4, save_file=str(tmp_path / "pca"), cache_dir=str(tmp_path))
+    model.fit_pca(batch_size=32, device="cpu", **fit_options)
+    model.fit_pca(batch_size=32, device="cpu", **fit_options)
+    # The exported PCA and a single cache entry
+    assert len([name for name in os.listdir(tmp_path) if name.endswith(".joblib")]) == 2
+
+    model.fit_pca(batch_size=16, device="cpu", **fit_options)
+    assert len([name for name in os.listdir(tmp_path) if name.endswith(".joblib")]) == 3
@@ -55,3 +55,221 @@ class TestStyleGANDiscriminator:
             output = discriminator(image, current_level, alpha)
 
         assert output.shape == (batch_size, 1)
+
+
+class TestStyleGANLoss:
+    def test_lazy_r1_penalty(self):
+        """The R1 penalty is only added every r1_interval steps, scaled by the interval."""
+        from faceai_bgimpact.models.stylegan_.loss import R1Regularization
+
+        torch.manual_seed(0)
+        discriminator = Discriminator()
+        real_images, fake_images = torch.randn(2, 3, 8, 8), torch.randn(2, 3, 8, 8)
+        every_step = R1Regularization(None, discriminator)
+        lazy = R1Regularization(None, discriminator, r1_interval=4)
+
+        unregularized = (discriminator(fake_images, 1, 1.0).mean() - discriminator(real_images, 1, 1.0).mean()).item()
+        penalty = every_step.d_loss(real_images, fake_images, 1, 1.0).item() - unregularized
+
+        losses = [lazy.d_loss(real_images, fake_images, 1, 1.0).item() for _ in range(5)]
+        assert losses[0] == pytest.approx(unregularized + 4 * penalty, rel=1e-4)
+        assert losses[1:4] == pytest.approx([unregularized] * 3, rel=1e-4)
+        assert losses[4] == pytest.approx(losses[0], rel=1e-4)
+        assert not real_images.requires_grad
+
+    @pytest.mark.parametrize("loss_name", ["WGAN", "WGAN_GP", "R1Regularization", "BasicGANLoss"])
+    @pytest.mark.parametrize("level,alpha", [(0, 1.0), (2, 0.5)])
+    def test_fused_discriminator_pass(self, loss_name, level, alpha):
+        """Scoring real and fake images in one pass gives the same loss and gradients as two passes."""
+        from faceai_bgimpact.models.stylegan_ import loss as losses
+
+        discriminator = Discriminator()
+        resolution = 4 * 2**level
+        real_images, fake_images = torch.randn(8, 3, resolution, resolution), torch.randn(8, 3, resolution, resolution)
+
+        results = []
+        for fused in [False, True]:
+            torch.manual_seed(0)
+            discriminator.zero_grad()
+            loss = getattr(losses, loss_name)(None, discriminator, fused=fused).d_loss(
+                real_images, fake_images, level, alpha
+            )
+            loss.backward()
+            results.append((loss.item(), discriminator.downscale_blocks[-1].conv1.weight.grad.clone()))
+
+        assert results[0][0] == pytest.approx(results[1][0], rel=1e-4, abs=1e-5)
+        assert torch.allclose(results[0][1], results[1][1], rtol=1e-3, atol=1e-5)
+
+
+class TestStyleGANModel:
+    def test_ema_generator(self, tmp_path):
+        """The EMA generator follows the generator, and is saved and loaded with the checkpoints."""
+        from faceai_bgimpact.models import StyleGAN
+
+        model = StyleGAN("ffhq_raw", 256, 256, 2, "cpu")
+        model.train_init(0, 0, 0, "r1")
+        model.init_ema()
+        model.ema_beta = 0.9
+        with torch.no_grad():
+            for param in model.generator.parameters():
+                param.add_(1.0)
+        expected = [0.9 * ema + 0.1 * param for ema, param in zip(model._ema_params, model._params)]
+        model.update_ema()
+        assert all(torch.allclose(ema, exp) for ema, exp in zip(model._ema_params, expected))
+
+        model.current_epochs = {0: 1}
+        model.save_checkpoint(1, model.current_epochs, save_dir=str(tmp_path / "checkpoints"))
+        checkpoint_path = next((tmp_path / f"checkpoints_ffhq_raw").glob("*.pth"))
+
+        resumed = StyleGAN.from_checkpoint("ffhq_raw", checkpoint_path, "r1", "cpu")
+        assert all(torch.equal(a, b) for a, b in zip(resumed._ema_params, model._ema_params))
+        inference = StyleGAN.from_checkpoint("ffhq_raw", checkpoint_path, "r1", "cpu", use_ema=True)
+        assert inference.generator_ema is None
+        assert all(torch.equal(a, b) for a, b in zip(inference.generator.parameters(), model._ema_params))
+
+    def test_r1_schedule_resumes(self, tmp_path):
+        """The number of discriminator steps of the lazy R1 penalty is saved and restored with the checkpoints."""
+        from faceai_bgimpact.models import StyleGAN
+
+        model = StyleGAN("ffhq_raw", 256, 256, 2, "cpu")
+        model.train_init(0, 0, 0, "r1")
+        model.loss.num_d_steps = 3
+        model.current_epochs = {0: 1}
+        model.save_checkpoint(1, model.current_epochs, save_dir=str(tmp_path / "checkpoints"))
+        checkpoint_path = next((tmp_path / f"checkpoints_ffhq_raw").glob("*.pth"))
+
+        resumed = StyleGAN.from_checkpoint("ffhq_raw", checkpoint_path, "r1", "cpu")
+        assert resumed.loss.num_d_steps == 3
+        # Training recreates the loss with its options, and keeps the schedule
+        resumed.init_loss("r1", r1_interval=4)
+        assert resumed.loss.num_d_steps == 3
+
+    @staticmethod
+    def _training_model(glr, dlr, reuse_fakes):
+        """StyleGAN at level 1, ready for perform_train_step."""
+        from faceai_bgimpact.models import StyleGAN
+        from faceai_bgimpact.models.utils import MixedPrecision
+
+        torch.manual_seed(0)
+        model = StyleGAN("ffhq_raw", 256, 256, 2, "cpu")
+        model.train_init(glr, glr, dlr, "wgan")
+        model.amp = model.loss.amp = MixedPrecision("fp32", "cpu")
+        model.reuse_fakes = reuse_fakes
+        return model
+
+    def test_discriminator_only_step(self):
+        """A step without the generator only updates the discriminator."""
+        model = self._training_model(0.01, 0.01, reuse_fakes=True)
+        generator_params = [param.clone() for param in model.generator.parameters()]
+        discriminator_params = [param.clone() for param in model.discriminator.parameters()]
+
+        g_loss, d_loss = model.perform_train_step(torch.randn(4, 3, 8, 8), "cpu", 1, 1.0, train_generator=False)
+        assert g_loss is None
+        assert isinstance(d_loss, float)
+        assert all(torch.equal(a, b) for a, b in zip(model.generator.parameters(), generator_params))
+        assert not all(torch.equal(a, b) for a, b in zip(model.discriminator.parameters(), discriminator_params))
+
+    def test_reused_fakes_generator_loss(self):
+        """The generator loss of the reused fake images is the one of a fresh pass, scored by the updated D."""
+        model = self._training_model(0.0, 0.01, reuse_fakes=True)
+        real_images = torch.randn(4, 3, 8, 8)
+
+        torch.manual_seed(1)
+        g_loss, _ = model.perform_train_step(real_images, "cpu", 1, 1.0)
+
+        # Same latent vectors and noise as the step, with the generator unchanged (zero learning rate)
+        torch.manual_seed(1)
+        z = torch.randn(4, 256)
+        with torch.no_grad():
+            expected = model.loss.g_loss(None, model.generator(z, 1, 1.0), 1, 1.0).item()
+        assert g_loss == pytest.approx(expected, rel=1e-4, abs=1e-5)
+
+    def test_scaled_weight_cache(self):
+        """The scaled weight of a frozen layer is cached, and recomputed when the weight changes."""
+        from faceai_bgimpact.models.stylegan_.utils import WSConv2d
+
+        conv = WSConv2d(4, 4, 3, 1, 1)
+        x = torch.randn(2, 4, 8, 8)
+
+        # A trainable weight is not cached, even without gradients
+        with torch.no_grad():
+            conv(x)
+        assert conv._cached_weight is None
+
+        conv.requires_grad_(False)
+        with torch.no_grad():
+            first = conv(x)
+            assert conv(x).equal(first)
+            assert conv.scaled_weight() is conv.scaled_weight()
+            conv.weight.mul_(2)
+            assert torch.allclose(conv(x) - conv.bias.view(1, -1, 1, 1), 2 * (first - conv.bias.view(1, -1, 1, 1)))
+
+        # Once unfrozen, the weight is scaled in the graph and the cache is released
+        conv.requires_grad_(True)
+        conv(x).sum().backward()
+        assert conv.weight.grad is not None
+        assert conv._cached_weight is None
+
+    @pytest.mark.parametrize("level", [0, 3])
+    def test_compute_styles(self, level):
+        """The styles computed in one matrix product match the AdaIN transforms, and per-layer styles mix."""
+        torch.manual_seed(0)
+        synthesis = SynthesisNetwork(256)
+        w = torch.randn(2, 256, 1, 1)
+
+        styles = synthesis.compute_styles(w, level)
+        blocks = [synthesis.init_block] + list(synthesis.upscale_blocks[:level])
+        assert len(styles) == 2 * len(blocks)
+        for i, (scale, bias) in enumerate(styles):
+            adain = blocks[i // 2].adain
+            assert torch.allclose(scale, adain.scale_transform(w), atol=1e-5)
+            assert torch.allclose(bias, adain.bias_transform(w), atol=1e-5)
+
+        # A different w per layer goes through the transforms of its own block only
+        layer_ws = [torch.randn(2, 256, 1, 1) for _ in range(len(styles))]
+        layer_styles = synthesis.compute_styles(layer_ws, level)
+        assert len(layer_styles) == len(styles)
+        for i, ((scale, bias), layer_w) in enumerate(zip(layer_styles, layer_ws)):
+            adain = blocks[i // 2].adain
+            assert torch.allclose(scale, adain.scale_transform(layer_w), atol=1e-5)
+            assert torch.allclose(bias, adain.bias_transform(layer_w), atol=1e-5)
+
+        # The same w in every layer gives the same image as the shared style
+        with torch.no_grad():
+            image = synthesis(w, level, 1.0, apply_noise=False)
+            mixed = synthesis.predict_modified_layer([w] * len(styles), level, apply_noise=False)
+        assert torch.allclose(image, mixed, atol=1e-5)
+
+    def test_blend_styles_batch(self):
+        """Rendering slider configurations in a batch matches blending them one at a time with the PCA."""
+        from sklearn.decomposition import PCA
+        from faceai_bgimpact.models import StyleGAN
+        from faceai_bgimpact.models.pca import PCABasis
+
+        torch.manual_seed(0)
+        model = StyleGAN("ffhq_raw", 256, 256, 2, "cpu")
+        model.level = 1
+        model.generator.freeze_for_inference()
+        with torch.no_grad():
+            model.pca = PCA(n_components=4).fit(model.generator.mapping(torch.randn(64, 256)).flatten(1).numpy())
+        model.pca_basis = PCABasis.from_sklearn(model.pca)
+
+        x1 = torch.randn(4)
+        base_w = torch.tensor(model.pca.inverse_transform(x1.unsqueeze(0).numpy())[0])
+        layers_list = [[0, 1, 2, 3], [1], [2, 3]]
+        x_batch = [[0.5, 0.0, -1.0], [0.0, 2.0, 1.0]]
+
+        images = model.blend_styles_batch(base_w, x_batch, layers_list, apply_noise=False)
+        assert images.shape == (2, 3, 8, 8)
+        for x_list, image in zip(x_batch, images):
+            ws = [base_w.clone() for _ in range(4)]
+            for i, (strength, layers) in enumerate(zip(x_list, layers_list)):
+                x = x1.clone()
+                x[i] += strength
+                w = torch.tensor(model.pca.inverse_transform(x.unsqueeze(0).numpy())[0])
+                for layer in layers:
+                    ws[layer] += w - base_w
+            with torch.no_grad():
+                expected = model.generator.synthesis.predict_modified_layer(ws, 1, apply_noise=False)
+            assert torch.allclose(image, expected[0], atol=1e-4)
+        assert torch.allclose(model.blend_styles(base_w, x1, x_batch[0], layers_list, False)[0], images[0], atol=1e-5)
@@ -30,16 +30,21 @@ class ModelManager:
                     checkpoint_path=f"models/StyleGAN_{dataset_name}.pth",
                     loss="r1",
                     device="cpu",
+                    use_ema=True,
                 )
+                self.models[model_name].generator.freeze_for_inference()
+                # The W vectors are cheap to generate, so the PCA is fitted in large batches
+                batch_size = 10000
             elif model_type == "VAE":
                 self.models[model_name] = VAE.from_checkpoint(
                     checkpoint_path=f"models/VAE_{dataset_name}.pth",
                     device="cpu",
                 )
+                batch_size = 256
             else:
                 raise ValueError(f"Unknown model type {model_type}.")
             self.models[model_name].fit_pca(
-                num_samples=num_pca_samples, batch_size=100, n_components=num_pca_components
+                num_samples=num_pca_samples, batch_size=batch_size, n_components=num_pca_components
             )
             print(f"Model {model_type} {dataset_name} loaded and PCA fitted.")
 
@@ -24,6 +24,15 @@ n_sliders = None
 latent_dim = 256
 
 
+def to_base64(image_tensor):
+    """Convert a generated image tensor to a Base64 JPEG image."""
+    image_tensor = (image_tensor.clamp(-1, 1) + 1) / 2  # Denormalize the image
+    pil_image = to_pil_image(image_tensor.cpu())
+    buffered = BytesIO()
+    pil_image.save(buffered, format="JPEG")
+    return base64.b64encode(buffered.getvalue()).decode()
+
+
 @api.route("/set-n-sliders")
 class SetNSliders(Resource):
     @api.expect(api.model("NSliders", {"n_sliders": fields.Integer(required=True)}))
@@ -67,7 +76,7 @@ class X1Sliders(Resource):
         global x1_others, x1, base_w
         model = model_manager[api.payload["model_name"].lower()]
         x1 = torch.cat([torch.tensor(api.payload["slider_values"]), x1_others])
-        base_w = torch.tensor(model.pca.inverse_transform(x1))
+        base_w = model.pca_basis.reconstruct(x1)
         return {"message": "Main slider values updated"}, 200
 
 
@@ -98,15 +107,39 @@ class GenerateImage(Resource):
 
         # Apply blend_styles to generate the blended latent vectors
         image_tensor = model.blend_styles(base_w, x1, eigenvector_strengths, layers_list, APPLY_NOISE)
-        image_tensor = (image_tensor.clamp(-1, 1) + 1) / 2  # Denormalize the image
 
-        # Convert tensor to Base64 image
-        pil_image = to_pil_image(image_tensor.squeeze(0))
-        buffered = BytesIO()
-        pil_image.save(buffered, format="JPEG")
-        img_base64 = base64.b64encode(buffered.getvalue()).decode()
+        return {"image": to_base64(image_tensor.squeeze(0))}, 200
+
+
+@api.route("/generate-images")
+class GenerateImages(Resource):
+    @api.expect(
+        api.model(
+            "GenerateImages",
+            {
+                "eigenvector_strengths": fields.List(
+                    fields.List(fields.Float),
+                    required=True,
+                    description="Strengths for each eigenvector, for each image",
+                ),
+                "layers_list": fields.List(
+                    fields.List(fields.Integer),
+                    required=True,
+                    description="Layer indices for each eigenvector",
+                ),
+                "model_name": fields.String(required=True, description="Model name"),
+            },
+        )
+    )
+    def post(self):
+        eigenvector_strengths = api.payload["eigenvector_strengths"]
+        layers_list = api.payload["layers_list"]
+        model = model_manager[api.payload["model_name"].lower()]
+
+        # Render all the slider configurations in a single batch
+        image_tensors = model.blend_styles_batch(base_w, eigenvector_strengths, layers_list, APPLY_NOISE)
 
-        return {"image": img_base64}, 200
+        return {"images": [to_base64(image_tensor) for image_tensor in image_tensors]}, 200
 
 
 # @api.route("/generate-transition-images")